@@ -0,0 +1,277 @@
+"""
+Approximate nearest-neighbor (ANN) indices for the year models.
+
+Each year model can have an inverted-file (IVF) index built over its
+normalized vectors, stored next to the model as <model>.ivf.faiss. When
+config.NEIGHBOR_ENGINE is 'ann', the NeighborEngine memory-maps these indices
+and searches them instead of scanning the whole vocabulary, falling back to
+the exact search for any year that doesn't have an index (or if faiss isn't
+installed).
+
+Usage, from the server folder:
+  # build an index for every year model in a corpus
+  python -m backend.ann build [--corpus pubtator] [--nlist 0] [--force]
+
+  # report recall@topn against the exact search and per-year latency for
+  # several nprobe settings, to choose a value for config.ANN_NPROBE
+  python -m backend.ann report [--corpus pubtator] [--nprobe 4,8,16,32,64]
+"""
+
+import argparse
+import logging
+import math
+import os
+import sys
+from pathlib import Path
+from timeit import default_timer
+
+import numpy as np
+
+from .tracking import ExecTimer
+
+try:
+    import faiss
+except ImportError:
+    faiss = None
+
+logging.basicConfig(stream=sys.stdout)
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def ann_index_path(model_path):
+    """
+    Returns the path of the ANN index that accompanies the model at
+    'model_path'.
+    """
+    return Path("%s.ivf.faiss" % model_path)
+
+
+def default_nlist(n_vectors):
+    """
+    Returns the number of IVF clusters to use for 'n_vectors' vectors, using
+    the usual rule of thumb of ~4 * sqrt(n).
+    """
+    return max(1, min(n_vectors // 39, int(4 * math.sqrt(n_vectors))))
+
+
+def build_ann_index(normed, nlist=None, max_training_vectors=None, seed=0):
+    """
+    Builds an IVF index over 'normed', a matrix of L2-normalized vectors, that
+    ranks by inner product (i.e., cosine similarity for normalized vectors).
+
+    'nlist' is the number of clusters, computed from the number of vectors if
+    unspecified. The clusters are trained on a random sample of at most
+    'max_training_vectors' vectors (default 256 per cluster).
+    """
+    if faiss is None:
+        raise RuntimeError("faiss is required to build ANN indices")
+
+    n_vectors, dims = normed.shape
+    nlist = nlist or default_nlist(n_vectors)
+    max_training_vectors = max_training_vectors or 256 * nlist
+
+    rng = np.random.default_rng(seed)
+    training_rows = np.sort(
+        rng.choice(n_vectors, size=min(n_vectors, max_training_vectors), replace=False)
+    )
+
+    quantizer = faiss.IndexFlatIP(dims)
+    index = faiss.IndexIVFFlat(quantizer, dims, nlist, faiss.METRIC_INNER_PRODUCT)
+    index.train(np.ascontiguousarray(normed[training_rows], dtype=np.float32))
+
+    # add in chunks, so a memory-mapped matrix is never fully copied
+    for start in range(0, n_vectors, 65536):
+        index.add(np.ascontiguousarray(normed[start : start + 65536], dtype=np.float32))
+
+    return index
+
+
+def write_ann_index(index, path):
+    tmp_path = "%s.tmp.%d" % (path, os.getpid())
+    faiss.write_index(index, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def load_ann_index(model_path, nprobe, use_mmap=True):
+    """
+    Loads the ANN index for the model at 'model_path', memory-mapped if
+    'use_mmap' is true, and configured to search 'nprobe' clusters per query.
+
+    Returns None if there's no index for the model, if it's older than the
+    model file (i.e., it has to be rebuilt), or if faiss isn't installed, in
+    which case callers should use the exact search.
+    """
+    index_path = ann_index_path(model_path)
+
+    if faiss is None:
+        logger.warning("faiss isn't installed, using exact search for %s" % model_path)
+        return None
+
+    if not index_path.exists():
+        logger.warning("No ANN index at %s, using exact search" % index_path)
+        return None
+
+    if index_path.stat().st_mtime < Path(model_path).stat().st_mtime:
+        logger.warning("%s is older than the model, using exact search" % index_path)
+        return None
+
+    index = faiss.read_index(str(index_path), faiss.IO_FLAG_MMAP if use_mmap else 0)
+    index.nprobe = nprobe
+
+    return index
+
+
+# ========================================================================
+# === command line interface
+# ========================================================================
+
+
+def build(args):
+    from .engine import load_normed_vectors
+    from .neighbors import word_models_by_year
+
+    model_paths = {
+        year: model_path
+        for year, _, model_path in word_models_by_year(
+            corpus=args.corpus, just_reference=True
+        )
+    }
+
+    for year, _, model in word_models_by_year(corpus=args.corpus):
+        model_path = model_paths[year]
+        index_path = ann_index_path(model_path)
+
+        if (
+            index_path.exists()
+            and index_path.stat().st_mtime >= Path(model_path).stat().st_mtime
+            and not args.force
+        ):
+            print("Index for %s already exists, skipping" % year, flush=True)
+            continue
+
+        with ExecTimer(verbose=True):
+            print("Building index for %s (%s)..." % (year, model_path), flush=True)
+            normed = load_normed_vectors(model_path, model)
+            write_ann_index(build_ann_index(normed, nlist=args.nlist or None), index_path)
+
+
+def report(args):
+    from .engine import YearIndex
+    from .neighbors import word_models_by_year
+
+    nprobes = [int(x) for x in args.nprobe.split(",")]
+    rng = np.random.default_rng(args.seed)
+
+    print("year,nprobe,recall_mean,recall_min,exact_ms,ann_ms,speedup", flush=True)
+
+    # nprobe => list of (recall_mean, speedup), one per year
+    summary = {nprobe: [] for nprobe in nprobes}
+
+    model_paths = {
+        year: model_path
+        for year, _, model_path in word_models_by_year(
+            corpus=args.corpus, just_reference=True
+        )
+    }
+
+    for year, _, model in word_models_by_year(corpus=args.corpus):
+        year_index = YearIndex(year, model_paths[year], model, ann_nprobe=max(nprobes))
+
+        if year_index.ann_index is None:
+            continue
+
+        rows = rng.choice(
+            len(year_index.index_to_key),
+            size=min(args.sample, len(year_index.index_to_key)),
+            replace=False,
+        )
+
+        # time single-token queries, since that's what a /neighbors request does
+        start = default_timer()
+        exact = [year_index.search_exact([row], args.topn)[0][0] for row in rows]
+        exact_ms = (default_timer() - start) * 1000 / len(rows)
+
+        for nprobe in nprobes:
+            year_index.ann_index.nprobe = nprobe
+
+            start = default_timer()
+            approx = [year_index.search_ann([row], args.topn)[0][0] for row in rows]
+            ann_ms = (default_timer() - start) * 1000 / len(rows)
+
+            recalls = [
+                len(set(e[e >= 0].tolist()) & set(a[a >= 0].tolist()))
+                / max(1, (e >= 0).sum())
+                for e, a in zip(exact, approx)
+            ]
+            summary[nprobe].append((np.mean(recalls), exact_ms / ann_ms))
+
+            print(
+                "%s,%d,%.4f,%.4f,%.2f,%.2f,%.1fx"
+                % (
+                    year,
+                    nprobe,
+                    np.mean(recalls),
+                    np.min(recalls),
+                    exact_ms,
+                    ann_ms,
+                    exact_ms / ann_ms,
+                ),
+                flush=True,
+            )
+
+    print("\nnprobe,worst_year_recall,mean_speedup")
+    for nprobe, results in summary.items():
+        if results:
+            print(
+                "%d,%.4f,%.1fx"
+                % (nprobe, min(r for r, _ in results), np.mean([s for _, s in results]))
+            )
+
+    acceptable = [
+        nprobe
+        for nprobe, results in summary.items()
+        if results and min(r for r, _ in results) >= args.threshold
+    ]
+    if acceptable:
+        print(
+            "\nSmallest nprobe with recall >= %.2f in every year: %d"
+            % (args.threshold, min(acceptable))
+        )
+    else:
+        print("\nNo nprobe setting reached recall >= %.2f in every year" % args.threshold)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Builds and evaluates ANN indices")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build_parser = subparsers.add_parser("build", help="build an index for each year model")
+    build_parser.add_argument("--corpus", default="pubtator")
+    build_parser.add_argument(
+        "--nlist", type=int, default=0, help="number of clusters (default: ~4*sqrt(vocab))"
+    )
+    build_parser.add_argument("--force", action="store_true", help="rebuild existing indices")
+    build_parser.set_defaults(func=build)
+
+    report_parser = subparsers.add_parser(
+        "report", help="compare recall and latency against the exact search"
+    )
+    report_parser.add_argument("--corpus", default="pubtator")
+    report_parser.add_argument("--nprobe", default="4,8,16,32,64")
+    report_parser.add_argument("--topn", type=int, default=25)
+    report_parser.add_argument(
+        "--sample", type=int, default=200, help="tokens sampled per year"
+    )
+    report_parser.add_argument(
+        "--threshold", type=float, default=0.95, help="minimum acceptable recall"
+    )
+    report_parser.add_argument("--seed", type=int, default=0)
+    report_parser.set_defaults(func=report)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
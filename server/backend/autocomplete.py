@@ -0,0 +1,451 @@
+"""
+The prefix index behind /autocomplete.
+
+The index holds the sorted, deduplicated vocabulary (from full_vocab.txt) and
+the sorted concept labels with their concept IDs (from all_concept_ids.tsv.xz)
+as StringTables, stored as sections of a single file. The file is
+memory-mapped, so opening it is nearly free and every process that serves
+/autocomplete shares one copy of it in the page cache. The entries starting
+with a prefix are found with a binary search over the sorted tables (see
+StringTable.prefix_range()).
+
+Suggestions are ranked by their total word count over every corpus' token
+frequency table; a concept label's count is that of its concept ID's tokens.
+Ranking a prefix's entries means finding the highest-scoring ones among all
+the entries that start with it, which for short prefixes can be most of the
+table, so the top entries of every prefix of MIN_PREFIX_LENGTH to
+PREFIX_DEPTH characters that has more than TOP_K entries are precomputed.
+Other prefixes have at most TOP_K entries (or are longer than PREFIX_DEPTH,
+so have few entries in practice), and are ranked when they're requested.
+
+The file layout is:
+- a fixed-size header: magic bytes and the number of sections
+- for each section, its name and the offset and length of its bytes
+- the sections' bytes, each starting on an 8-byte boundary
+
+The sections are, for each of 'vocab' and 'concepts':
+- <kind>: the sorted StringTable of entries (with the concept IDs as values)
+- <kind>_scores: the int64 score of each entry
+- <kind>_prefixes: the sorted StringTable of the precomputed prefixes
+- <kind>_top: an int32 (prefixes x TOP_K) matrix of the indices of each
+  prefix's top entries, highest-scoring first
+
+The index is built from the source files the first time it's loaded, or
+ahead of time with this module's command line interface.
+
+Usage, from the server folder:
+  python -m backend.autocomplete build [--depth 6] [--force]
+"""
+
+import argparse
+import logging
+import mmap
+import struct
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from .concepts import CONCEPTS_FILE, concept_labels, read_concepts
+from .frequencies import (
+    COLUMNAR_FOLDERS,
+    FREQUENCY_FILES,
+    has_columnar_table,
+    load_frequency_table,
+)
+from .neighbor_table import VOCAB_FILE, read_vocab
+from .strtable import StringTable, write_atomically
+from .tracking import ExecTimer
+
+logging.basicConfig(stream=sys.stdout)
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# relative to the data folder
+AUTOCOMPLETE_INDEX_FILE = Path("autocomplete.idx")
+
+MAGIC = b"WLACIDX2"
+HEADER = struct.Struct("<8sQ")
+SECTION = struct.Struct("<32sQQ")
+
+ALIGNMENT = 8
+
+# /autocomplete doesn't search for prefixes shorter than this
+MIN_PREFIX_LENGTH = 3
+# the longest prefixes whose top entries are precomputed
+PREFIX_DEPTH = 6
+# the number of top entries precomputed per prefix, i.e. the most that
+# /autocomplete returns of each kind
+TOP_K = 100
+
+KINDS = ("vocab", "concepts")
+
+
+def encode_sections(sections):
+    """
+    Returns the bytes of an index file holding 'sections', a dict of
+    {<name>: <bytes>, ...}.
+    """
+    offset = HEADER.size + SECTION.size * len(sections)
+    entries, blobs = [], []
+
+    for name, data in sections.items():
+        padding = -offset % ALIGNMENT
+        blobs.append(b"\0" * padding + data)
+        offset += padding
+        entries.append(SECTION.pack(name.encode("utf8"), offset, len(data)))
+        offset += len(data)
+
+    return b"".join([HEADER.pack(MAGIC, len(sections))] + entries + blobs)
+
+
+def decode_sections(buffer):
+    """
+    Returns a dict of {<name>: <memoryview>, ...} over the sections of the
+    index file in 'buffer', a bytes object or an mmap.
+    """
+    magic, count = HEADER.unpack_from(buffer, 0)
+
+    if magic != MAGIC:
+        raise ValueError("Not an autocomplete index (bad magic %r)" % magic)
+
+    view = memoryview(buffer)
+    sections = {}
+
+    for i in range(count):
+        name, offset, length = SECTION.unpack_from(buffer, HEADER.size + SECTION.size * i)
+        sections[name.rstrip(b"\0").decode("utf8")] = view[offset : offset + length]
+
+    return sections
+
+
+def top_indices(scores, limit):
+    """
+    Returns the indices of the 'limit' highest of 'scores', highest first,
+    breaking ties by index (i.e. alphabetically, for a slice of a table's
+    scores).
+
+    >>> top_indices(np.array([5, 1, 5, 9, 5]), 3).tolist()
+    [3, 0, 2]
+    >>> top_indices(np.array([1, 2]), 5).tolist()
+    [1, 0]
+    """
+    if limit <= 0:
+        return np.zeros(0, dtype=np.int64)
+
+    if limit < len(scores):
+        threshold = np.partition(scores, len(scores) - limit)[len(scores) - limit]
+        above = np.flatnonzero(scores > threshold)
+        tied = np.flatnonzero(scores == threshold)[: limit - len(above)]
+        candidates = np.concatenate([above, tied])
+    else:
+        candidates = np.arange(len(scores))
+
+    return candidates[np.lexsort((candidates, -scores[candidates]))]
+
+
+class RankedTable:
+    """
+    One kind of entry in the index, i.e. a sorted StringTable along with the
+    score of each entry and the precomputed top entries of its prefixes.
+    """
+
+    def __init__(self, table, scores, prefixes, top):
+        self.table = table
+        self.scores = scores
+        self.prefixes = prefixes
+        self.top = top
+
+    @classmethod
+    def from_sections(cls, sections, kind):
+        prefixes = StringTable(sections["%s_prefixes" % kind])
+
+        return cls(
+            StringTable(sections[kind]),
+            np.frombuffer(sections["%s_scores" % kind], dtype="<i8"),
+            prefixes,
+            np.frombuffer(sections["%s_top" % kind], dtype="<i4").reshape(
+                len(prefixes), -1
+            ),
+        )
+
+    def complete(self, prefix: str, limit: int):
+        """
+        Returns the indices of up to 'limit' of the entries that start with
+        'prefix', highest-scoring first.
+        """
+        if limit <= 0:
+            return []
+
+        idx = self.prefixes.find(prefix) if len(self.prefixes) > 0 else -1
+
+        if idx >= 0 and limit <= self.top.shape[1]:
+            return self.top[idx, :limit].tolist()
+
+        start, end = self.table.prefix_range(prefix)
+        return (start + top_indices(self.scores[start:end], limit)).tolist()
+
+
+class AutocompleteIndex:
+    """
+    The vocabulary and concept labels, searchable by prefix and ranked by
+    frequency; see this module's docstring for the format.
+    """
+
+    def __init__(self, buffer):
+        sections = decode_sections(buffer)
+        missing = [
+            "%s%s" % (kind, suffix)
+            for kind in KINDS
+            for suffix in ("", "_scores", "_prefixes", "_top")
+            if "%s%s" % (kind, suffix) not in sections
+        ]
+
+        if missing:
+            raise ValueError("Autocomplete index is missing sections %s" % missing)
+
+        self.buffer = buffer
+        self.vocab = RankedTable.from_sections(sections, "vocab")
+        # the concept labels, with their concept IDs as values
+        self.concepts = RankedTable.from_sections(sections, "concepts")
+
+    @classmethod
+    def open(cls, path):
+        """
+        Memory-maps the index at 'path' read-only.
+        """
+        with open(path, "rb") as fp:
+            return cls(mmap.mmap(fp.fileno(), length=0, access=mmap.ACCESS_READ))
+
+    def complete_vocab(self, prefix: str, limit: int):
+        """
+        Returns up to 'limit' (term, score) pairs for the vocabulary terms that
+        start with 'prefix', highest-scoring first.
+        """
+        return [
+            (self.vocab.table.key(idx), int(self.vocab.scores[idx]))
+            for idx in self.vocab.complete(prefix, limit)
+        ]
+
+    def complete_concepts(self, prefix: str, limit: int):
+        """
+        Returns up to 'limit' (label, concept ID, score) tuples for the concept
+        labels that start with 'prefix', highest-scoring first.
+        """
+        return [
+            (
+                self.concepts.table.key(idx),
+                self.concepts.table.value(idx),
+                int(self.concepts.scores[idx]),
+            )
+            for idx in self.concepts.complete(prefix, limit)
+        ]
+
+
+# ========================================================================
+# === building
+# ========================================================================
+
+
+def read_token_counts(data_folder):
+    """
+    Returns a Series of each token's total word count over every corpus'
+    frequency table in 'data_folder', indexed by token. Corpora without a
+    frequency table are skipped.
+    """
+    counts = []
+
+    for corpus, frequency_file in FREQUENCY_FILES.items():
+        if not (
+            (data_folder / frequency_file).exists()
+            or has_columnar_table(data_folder / COLUMNAR_FOLDERS[corpus])
+        ):
+            logger.warning("No frequency table for %s, skipping its counts" % corpus)
+            continue
+
+        table = load_frequency_table(corpus, data_folder)
+        counts.append(pd.Series(table.total_counts(), index=list(table.tokens.keys())))
+
+    if not counts:
+        return pd.Series([], dtype=np.int64)
+
+    return pd.concat(counts).groupby(level=0).sum()
+
+
+def concept_counts(token_counts):
+    """
+    Returns a Series of each concept ID's total word count, given the word
+    counts of every token. Like decorate_neighbors(), tokens for MeSH IDs are
+    counted toward the ID without their entity type prefix, e.g.
+    'disease_mesh_d000001' toward 'mesh_d000001'.
+
+    >>> counts = pd.Series({"disease_mesh_d1": 1, "chemical_mesh_d1": 2, "mcf-7": 4})
+    >>> concept_counts(counts).to_dict()
+    {'mcf-7': 4, 'mesh_d1': 3}
+    """
+    tokens = token_counts.index.to_series()
+    is_mesh = tokens.str.contains("mesh", regex=False)
+    concept_ids = tokens.where(~is_mesh, tokens.str.split("_", n=1).str[1].fillna(""))
+
+    return token_counts.groupby(concept_ids.to_numpy()).sum()
+
+
+def scores_for(keys, counts):
+    """
+    Returns an int64 array of the count of each of 'keys' in 'counts', a
+    Series indexed by key, or 0 for keys that aren't in it.
+    """
+    return counts.reindex(keys).fillna(0).to_numpy(dtype=np.int64)
+
+
+def precompute_top(keys, scores, depth=PREFIX_DEPTH, k=TOP_K):
+    """
+    Finds the top 'k' entries of every prefix of MIN_PREFIX_LENGTH to 'depth'
+    characters that more than 'k' of the sorted 'keys' start with. Returns a
+    pair of (sorted prefixes, int32 (prefixes x k) matrix of the indices of
+    their top entries).
+    """
+    top_by_prefix = {}
+
+    for length in range(MIN_PREFIX_LENGTH, depth + 1):
+        # keys shorter than 'length' have no prefix of that length
+        key_prefixes = np.array(
+            [key[:length] if len(key) >= length else None for key in keys],
+            dtype=object,
+        )
+        # the runs of keys that share a prefix, since the keys are sorted
+        starts = np.flatnonzero(
+            np.r_[True, key_prefixes[1:] != key_prefixes[:-1]]
+        )
+        ends = np.r_[starts[1:], len(keys)]
+
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            if end - start > k and key_prefixes[start] is not None:
+                top_by_prefix[key_prefixes[start]] = start + top_indices(
+                    scores[start:end], k
+                )
+
+    prefixes = sorted(top_by_prefix)
+    top = np.zeros((len(prefixes), k), dtype="<i4")
+
+    for i, prefix in enumerate(prefixes):
+        top[i] = top_by_prefix[prefix]
+
+    return prefixes, top
+
+
+def build_autocomplete_index(data_folder, path, depth=PREFIX_DEPTH, concepts=None):
+    """
+    Builds the autocomplete index from the vocabulary, concept ID, and token
+    frequency files in 'data_folder' and writes it to 'path'.
+
+    If 'concepts' is given, it's used instead of reading the concept ID file
+    (see concepts.read_concepts()).
+    """
+    data_folder = Path(data_folder)
+
+    logger.info("Building autocomplete index from %s..." % data_folder)
+
+    vocab = read_vocab(data_folder / VOCAB_FILE)
+    if concepts is None:
+        concepts = read_concepts(data_folder / CONCEPTS_FILE)
+
+    labels, concept_ids = concept_labels(concepts)
+
+    token_counts = read_token_counts(data_folder)
+    entries = {
+        "vocab": (
+            StringTable.encode(vocab, is_sorted=True),
+            vocab,
+            scores_for(vocab, token_counts),
+        ),
+        "concepts": (
+            StringTable.encode(labels, concept_ids, is_sorted=True),
+            labels,
+            scores_for(
+                [concept_id.lower() for concept_id in concept_ids],
+                concept_counts(token_counts),
+            ),
+        ),
+    }
+
+    sections = {}
+
+    for kind, (table, keys, scores) in entries.items():
+        prefixes, top = precompute_top(keys, scores, depth=depth)
+
+        sections[kind] = table
+        sections["%s_scores" % kind] = scores.astype("<i8").tobytes()
+        sections["%s_prefixes" % kind] = StringTable.encode(prefixes, is_sorted=True)
+        sections["%s_top" % kind] = top.tobytes()
+
+        logger.info(
+            " - %s: %d entries, %d precomputed prefixes" % (kind, len(keys), len(prefixes))
+        )
+
+    write_atomically(path, encode_sections(sections))
+
+    logger.info("...done!")
+
+
+def load_autocomplete_index(data_folder):
+    """
+    Memory-maps the autocomplete index in 'data_folder', building it first if
+    it doesn't exist yet or is from an older version of this module.
+    """
+    path = Path(data_folder) / AUTOCOMPLETE_INDEX_FILE
+
+    if path.exists():
+        try:
+            return AutocompleteIndex.open(path)
+        except ValueError as ex:
+            logger.warning("Rebuilding autocomplete index at %s: %s" % (path, ex))
+    else:
+        logger.info("No autocomplete index at %s, building it..." % path)
+
+    build_autocomplete_index(data_folder, path)
+
+    return AutocompleteIndex.open(path)
+
+
+def build(args):
+    data_folder = Path(args.data_folder)
+
+    path = data_folder / AUTOCOMPLETE_INDEX_FILE
+
+    if path.exists() and not args.force:
+        print("%s already exists (use --force to rebuild it)" % path)
+        return
+
+    with ExecTimer(verbose=True):
+        build_autocomplete_index(data_folder, path, depth=args.depth)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Builds the /autocomplete index")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build_parser = subparsers.add_parser(
+        "build",
+        help="write the index from full_vocab.txt, all_concept_ids.tsv.xz, and "
+        "the token frequency tables",
+    )
+    build_parser.add_argument(
+        "--depth",
+        type=int,
+        default=PREFIX_DEPTH,
+        help="longest prefixes whose top entries are precomputed",
+    )
+    build_parser.add_argument("--force", action="store_true", help="rebuild an existing index")
+    build_parser.add_argument(
+        "--data-folder", default="./data", help="the data folder (default: ./data)"
+    )
+    build_parser.set_defaults(func=build)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,957 @@
+import asyncio
+import hashlib
+import json
+import logging
+import re
+import struct
+import sys
+import time
+import uuid
+from collections import OrderedDict, namedtuple
+from datetime import datetime, timedelta
+
+import msgpack
+import zstandard
+
+from .config import CORPORA_SET
+
+logging.basicConfig(stream=sys.stdout)
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# prefix for the keys of cached responses; kept from when responses were
+# cached by fastapi_redis_cache, so that existing entries are still found
+CACHE_PREFIX = "wlc"
+
+# how long cached responses live, matching fastapi_redis_cache's default of one
+# year. entries need an expiry to be candidates for eviction under redis'
+# volatile-lfu policy (see services/redis/redis.conf)
+CACHE_EXPIRE_SECS = 60 * 60 * 24 * 365
+
+# header that tells clients whether a response came from the cache
+CACHE_HEADER = "X-FastAPI-Cache"
+
+HTTP_TIME = "%a, %d %b %Y %H:%M:%S GMT"
+
+# the number of cached responses is kept in this key, and the number per corpus
+# in this key followed by ':<corpus>'
+ENTRY_COUNT_KEY = "meta:cached_entry_count"
+
+# per-corpus sorted sets of the tokens requested from /neighbors, scored by the
+# number of requests and by the time of the last request, respectively; keys
+# are these prefixes followed by ':<corpus>'
+REQUEST_COUNTS_KEY = "meta:request_counts"
+LAST_ACCESS_KEY = "meta:last_access"
+
+# sets a cached response (KEYS[1]) to ARGV[1], expiring in ARGV[2] seconds,
+# and increments the entry counts (KEYS[2], KEYS[3]) if it wasn't cached yet
+SET_AND_COUNT_SCRIPT = """
+local is_new = redis.call('EXISTS', KEYS[1]) == 0
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+if is_new then
+    redis.call('INCR', KEYS[2])
+    redis.call('INCR', KEYS[3])
+    return 1
+end
+return 0
+"""
+
+
+# renames a cached response (KEYS[1]) to KEYS[2], moving it from the entry
+# count KEYS[3] to KEYS[4]. if KEYS[2] was already cached, it's replaced, so
+# the total entry count (KEYS[5]) is decremented instead
+RENAME_AND_COUNT_SCRIPT = """
+local replaces = redis.call('EXISTS', KEYS[2]) == 1
+redis.call('RENAME', KEYS[1], KEYS[2])
+redis.call('DECR', KEYS[3])
+if replaces then
+    redis.call('DECR', KEYS[5])
+    return 0
+end
+redis.call('INCR', KEYS[4])
+return 1
+"""
+
+
+def neighbors_cache_key(tok: str, corpus: str):
+    """
+    Returns the key under which the /neighbors response for 'tok' in 'corpus'
+    is cached, i.e. the key fastapi_redis_cache's @cache() decorator produced
+    for main.neighbors().
+    """
+    return f"{CACHE_PREFIX}:backend.main.neighbors(tok={tok},corpus={corpus})"
+
+
+NEIGHBORS_CACHE_KEY_RE = re.compile(
+    r"^%s:backend\.main\.neighbors\(tok=(?P<tok>.*),corpus=(?P<corpus>[^,)]*)\)$"
+    % CACHE_PREFIX
+)
+
+
+def parse_neighbors_cache_key(key):
+    """
+    Inverse of neighbors_cache_key(); returns the pair (tok, corpus) for 'key'
+    (a str or bytes), or None if it's not a /neighbors cache key.
+
+    >>> parse_neighbors_cache_key(b"wlc:backend.main.neighbors(tok=mouse,corpus=pubtator)")
+    ('mouse', 'pubtator')
+    >>> parse_neighbors_cache_key("meta:cached_entry_count") is None
+    True
+    """
+    if isinstance(key, bytes):
+        key = key.decode("utf8", errors="replace")
+
+    match = NEIGHBORS_CACHE_KEY_RE.match(key)
+
+    return match.group("tok", "corpus") if match else None
+
+
+def entry_count_key(corpus=None):
+    """
+    Returns the key holding the number of cached responses in 'corpus', or
+    in all corpora if 'corpus' is None.
+    """
+    return ENTRY_COUNT_KEY if corpus is None else "%s:%s" % (ENTRY_COUNT_KEY, corpus)
+
+
+def request_counts_key(corpus):
+    return "%s:%s" % (REQUEST_COUNTS_KEY, corpus)
+
+
+def last_access_key(corpus):
+    return "%s:%s" % (LAST_ACCESS_KEY, corpus)
+
+
+# ========================================================================
+# === encoding
+# ========================================================================
+
+# cached responses start with this byte, followed by the zstd-compressed
+# msgpack encoding of the response in columnar form. responses cached before
+# this encoding was introduced are plain JSON, and so start with '{'
+ENCODING_VERSION = b"\x01"
+
+# zstd level used to compress cached responses. entries are written once and
+# read many times, and decompression speed doesn't depend on the level
+COMPRESSION_LEVEL = 10
+
+NEIGHBOR_FIELDS = ("token", "tag_id", "score")
+
+
+def pack_scores(scores):
+    """
+    Packs a list of scores into bytes, as float32 if that represents all of
+    them exactly (which it does for the scores gensim and the NeighborEngine
+    produce, since the models are float32) or float64 otherwise.
+    """
+    packed = struct.pack("<%df" % len(scores), *scores)
+
+    if list(struct.unpack("<%df" % len(scores), packed)) == scores:
+        return "f", packed
+
+    return "d", struct.pack("<%dd" % len(scores), *scores)
+
+
+def to_columns(records):
+    """
+    Converts a list of dicts that all have the same keys, in the same order,
+    into a pair of (keys, list of columns), or returns None if they don't.
+    """
+    keys = list(records[0].keys()) if records else []
+
+    if any(list(record.keys()) != keys for record in records):
+        return None
+
+    return keys, [[record[key] for record in records] for key in keys]
+
+
+def encode_columnar(result):
+    """
+    Converts a /neighbors response into a compact, columnar form, where each
+    distinct neighbor token and tag id is stored just once and the neighbors'
+    scores are packed into bytes. Returns None if 'result' doesn't have the
+    expected shape.
+    """
+    neighbors = result.get("neighbors")
+    frequency = to_columns(result.get("frequency") or [])
+
+    if not isinstance(neighbors, dict) or frequency is None:
+        return None
+
+    strings, string_ids = [], {}
+
+    def intern(x):
+        if x not in string_ids:
+            string_ids[x] = len(strings)
+            strings.append(x)
+        return string_ids[x]
+
+    counts, tokens, tag_ids, scores = [], [], [], []
+
+    for year_neighbors in neighbors.values():
+        counts.append(len(year_neighbors))
+
+        for neighbor in year_neighbors:
+            if tuple(neighbor.keys()) != NEIGHBOR_FIELDS or not isinstance(
+                neighbor["score"], float
+            ):
+                return None
+
+            tokens.append(intern(neighbor["token"]))
+            tag_ids.append(-1 if neighbor["tag_id"] is None else intern(neighbor["tag_id"]))
+            scores.append(neighbor["score"])
+
+    score_type, packed_scores = pack_scores(scores)
+
+    return {
+        "strings": strings,
+        "years": list(neighbors.keys()),
+        "counts": counts,
+        "tokens": tokens,
+        "tag_ids": tag_ids,
+        "score_type": score_type,
+        "scores": packed_scores,
+        "frequency": frequency,
+        # any other fields are stored as they are
+        "rest": {
+            k: v for k, v in result.items() if k not in ("neighbors", "frequency")
+        },
+        "order": list(result.keys()),
+    }
+
+
+def decode_columnar(columnar):
+    """
+    Inverse of encode_columnar().
+    """
+    strings, tokens, tag_ids = columnar["strings"], columnar["tokens"], columnar["tag_ids"]
+    scores = struct.unpack(
+        "<%d%s" % (len(tokens), columnar["score_type"]), columnar["scores"]
+    )
+
+    neighbors, offset = {}, 0
+
+    for year, count in zip(columnar["years"], columnar["counts"]):
+        neighbors[year] = [
+            {
+                "token": strings[tokens[i]],
+                "tag_id": None if tag_ids[i] < 0 else strings[tag_ids[i]],
+                "score": scores[i],
+            }
+            for i in range(offset, offset + count)
+        ]
+        offset += count
+
+    keys, columns = columnar["frequency"]
+    fields = {
+        **columnar["rest"],
+        "neighbors": neighbors,
+        "frequency": [dict(zip(keys, values)) for values in zip(*columns)],
+    }
+
+    return {k: fields[k] for k in columnar["order"]}
+
+
+def encode_response(result):
+    """
+    Serializes 'result', a /neighbors response, to the bytes that are cached:
+    its columnar form (see encode_columnar()) packed with msgpack and
+    compressed with zstd, which is several times smaller than its JSON.
+    """
+    columnar = encode_columnar(result)
+    packed = msgpack.packb(
+        {"columnar": columnar} if columnar is not None else {"raw": result}
+    )
+
+    return ENCODING_VERSION + zstandard.ZstdCompressor(level=COMPRESSION_LEVEL).compress(
+        packed
+    )
+
+
+def is_legacy_value(value):
+    """
+    Returns True if 'value' is a response cached as JSON, before
+    encode_response() was introduced.
+    """
+    return value[:1] == b"{"
+
+
+def decode_response(value):
+    """
+    Inverse of encode_response(), which also accepts responses cached as JSON.
+    """
+    if is_legacy_value(value):
+        return json.loads(value)
+
+    if value[:1] != ENCODING_VERSION:
+        raise ValueError("Unknown cached response encoding %r" % value[:1])
+
+    unpacked = msgpack.unpackb(
+        zstandard.ZstdDecompressor().decompress(value[1:]), strict_map_key=False
+    )
+
+    if "raw" in unpacked:
+        return unpacked["raw"]
+
+    return decode_columnar(unpacked["columnar"])
+
+
+def response_json(value):
+    """
+    Returns the JSON body of the response cached as 'value'. Responses cached
+    as JSON are returned as they are.
+    """
+    if is_legacy_value(value):
+        return value
+
+    return result_json(decode_response(value))
+
+
+def result_json(result):
+    """
+    Returns the JSON body of 'result', a /neighbors response.
+    """
+    return json.dumps(result).encode("utf8")
+
+
+def write_cached_neighbors(r, tok: str, corpus: str, result):
+    """
+    Caches 'result' as the /neighbors response for 'tok' in 'corpus', using
+    the (non-async) redis connection 'r', which may be a pipeline.
+
+    If the response wasn't cached yet, the entry counts are incremented too.
+    """
+    set_and_count = r.register_script(SET_AND_COUNT_SCRIPT)
+    set_and_count(
+        keys=[neighbors_cache_key(tok, corpus), entry_count_key(), entry_count_key(corpus)],
+        args=[encode_response(result), CACHE_EXPIRE_SECS],
+        client=r,
+    )
+
+
+def rename_cached_neighbors(r, tok: str, old_corpus: str, new_corpus: str):
+    """
+    Moves the cached /neighbors response for 'tok' from 'old_corpus' to
+    'new_corpus', replacing any response already cached there, using the
+    (non-async) redis connection 'r'. The entry counts are adjusted to match.
+    """
+    rename_and_count = r.register_script(RENAME_AND_COUNT_SCRIPT)
+    rename_and_count(
+        keys=[
+            neighbors_cache_key(tok, old_corpus),
+            neighbors_cache_key(tok, new_corpus),
+            entry_count_key(old_corpus),
+            entry_count_key(new_corpus),
+            entry_count_key(),
+        ],
+        client=r,
+    )
+
+
+class NeighborsCache:
+    """
+    Reads and writes cached /neighbors responses using 'client', an async redis
+    client.
+    """
+
+    def __init__(self, client, expire=CACHE_EXPIRE_SECS):
+        self.client = client
+        self.expire = expire
+        self.set_and_count = client.register_script(SET_AND_COUNT_SCRIPT)
+
+    async def get(self, tok: str, corpus: str):
+        """
+        Returns a pair of (seconds until expiry, encoded response) for 'tok' in
+        'corpus', or (None, None) if it's not cached.
+        """
+        key = neighbors_cache_key(tok, corpus)
+
+        async with self.client.pipeline(transaction=False) as pipe:
+            ttl, value = await pipe.ttl(key).get(key).execute()
+
+        if value is None:
+            return None, None
+
+        # entries without an expiry report a ttl of -1
+        return (ttl if ttl > 0 else self.expire), value
+
+    async def get_many(self, toks, corpus: str):
+        """
+        Returns a dict mapping each token in 'toks' that has a cached /neighbors
+        response in 'corpus' to that response's JSON body (see
+        response_json()), fetched in a single round trip.
+        """
+        if not toks:
+            return {}
+
+        values = await self.client.mget([neighbors_cache_key(tok, corpus) for tok in toks])
+
+        return {
+            tok: response_json(value)
+            for tok, value in zip(toks, values)
+            if value is not None
+        }
+
+    async def set(self, tok: str, corpus: str, value):
+        """
+        Caches 'value', an encoded /neighbors response (see encode_response()),
+        for 'tok' in 'corpus'. If it wasn't cached yet, the entry counts are
+        incremented too.
+
+        Encoding a response takes a while, so callers on the event loop should
+        do it in a thread.
+        """
+        await self.set_and_count(
+            keys=[neighbors_cache_key(tok, corpus), entry_count_key(), entry_count_key(corpus)],
+            args=[value, self.expire],
+        )
+
+    async def entry_counts(self, corpora):
+        """
+        Returns a pair of (the number of cached responses, a dict mapping each
+        corpus in 'corpora' to its number of cached responses).
+        """
+        values = await self.client.mget(
+            [entry_count_key()] + [entry_count_key(corpus) for corpus in corpora]
+        )
+        counts = [max(0, int(value or 0)) for value in values]
+
+        return counts[0], dict(zip(corpora, counts[1:]))
+
+    async def most_requested(self, corpus: str, count: int, offset: int = 0, recent=False):
+        """
+        Returns up to 'count' of the tokens requested in 'corpus', skipping the
+        first 'offset', ordered by decreasing number of requests (or by
+        decreasing time of the last request, if 'recent' is true).
+
+        Returns a list of (token, number of requests, time of the last request
+        as a unix timestamp) tuples.
+        """
+        ranked_key, other_key = (
+            (last_access_key(corpus), request_counts_key(corpus))
+            if recent
+            else (request_counts_key(corpus), last_access_key(corpus))
+        )
+
+        ranked = await self.client.zrevrange(
+            ranked_key, offset, offset + count - 1, withscores=True
+        )
+
+        if not ranked:
+            return []
+
+        others = await self.client.zmscore(other_key, [tok for tok, _ in ranked])
+
+        results = []
+
+        for (tok, score), other in zip(ranked, others):
+            requests, last_access = (other, score) if recent else (score, other)
+            results.append((tok.decode("utf8"), int(requests or 0), last_access))
+
+        return results
+
+    async def lfu_freqs(self, entries):
+        """
+        Returns redis' LFU counter (see OBJECT FREQ) for the cache entry of each
+        (tok, corpus) pair in 'entries', fetched in a single round trip. The
+        counter is None for entries that aren't cached, or if redis isn't using
+        an LFU eviction policy.
+        """
+        async with self.client.pipeline(transaction=False) as pipe:
+            for tok, corpus in entries:
+                pipe.object("freq", neighbors_cache_key(tok, corpus))
+
+            freqs = await pipe.execute(raise_on_error=False)
+
+        return [freq if isinstance(freq, int) else None for freq in freqs]
+
+    async def touch(self, tok: str, corpus: str):
+        """
+        Returns whether 'tok' in 'corpus' is cached. Like reading the entry,
+        this counts as an access for redis' eviction policy.
+        """
+        return await self.client.touch(neighbors_cache_key(tok, corpus)) > 0
+
+
+# ========================================================================
+# === in-process tier
+# ========================================================================
+
+# a response held by LocalResponseCache: its JSON body, its ETag, and the
+# times (as unix timestamps) at which it expires from redis and at which this
+# copy is considered stale
+LocalEntry = namedtuple("LocalEntry", ["body", "etag", "expires_at", "stale_at"])
+
+# rough per-entry overhead of LocalResponseCache's bookkeeping, in bytes
+LOCAL_ENTRY_OVERHEAD = 256
+
+
+class LocalResponseCache:
+    """
+    A least-recently-used cache of response bodies held in the memory of each
+    API process, in front of the redis cache, so that popular responses are
+    served without going to redis or re-encoding them.
+
+    The cache holds at most 'max_bytes' of responses, evicting the least
+    recently used ones to make room. Entries are dropped 'ttl_secs' after
+    they're added, so that changes to the redis cache (e.g. from a hotfix) are
+    eventually picked up.
+    """
+
+    def __init__(self, max_bytes, ttl_secs):
+        self.max_bytes = max_bytes
+        self.ttl_secs = ttl_secs
+        # key => LocalEntry, from least to most recently used
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """
+        Returns the LocalEntry for 'key', or None if it's not cached (or stale).
+        """
+        entry = self.entries.get(key)
+
+        if entry is not None and entry.stale_at < time.time():
+            self.remove(key)
+            entry = None
+
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+
+        return entry
+
+    def put(self, key, body, etag, expires_at):
+        """
+        Caches the response 'body' for 'key' and returns its LocalEntry.
+        Responses larger than the whole cache aren't cached.
+        """
+        entry = LocalEntry(
+            body, etag, expires_at, min(expires_at, time.time() + self.ttl_secs)
+        )
+        entry_size = len(body) + LOCAL_ENTRY_OVERHEAD
+
+        self.remove(key)
+
+        if entry_size > self.max_bytes:
+            return entry
+
+        self.entries[key] = entry
+        self.size += entry_size
+
+        while self.size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted.body) + LOCAL_ENTRY_OVERHEAD
+            self.evictions += 1
+
+        return entry
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+
+        if entry is not None:
+            self.size -= len(entry.body) + LOCAL_ENTRY_OVERHEAD
+
+    def __contains__(self, key):
+        entry = self.entries.get(key)
+        return entry is not None and entry.stale_at >= time.time()
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self.entries),
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+        }
+
+
+class AccessRecorder:
+    """
+    Collects the requests made for each token in each corpus and writes them to
+    redis every 'interval' seconds in a single round trip, rather than once per
+    request: their counts and last access times (see
+    NeighborsCache.most_requested()), and a TOUCH of their cache entries.
+
+    The TOUCH keeps redis' eviction policy aware that entries served from a
+    LocalResponseCache are still in use, since those requests never read them
+    from redis.
+
+    'client' is an async redis client, e.g. redis.asyncio.Redis.
+    """
+
+    def __init__(self, client, interval=1.0):
+        self.client = client
+        self.interval = interval
+        # (tok, corpus) => (number of requests, time of the last request)
+        self.pending = {}
+        # (tok, corpus) pairs whose cache entries should be touched
+        self.touched = set()
+        self.task = None
+
+    def record(self, tok: str, corpus: str):
+        """
+        Records a request for 'tok' in 'corpus', and touches its cache entry.
+
+        Only requests for cached tokens should be recorded: tokens are removed
+        from the counts when their entries are evicted or expire (see
+        EntryCountKeeper), so the counts of tokens that were never cached
+        would otherwise stay around forever.
+        """
+        count, _ = self.pending.get((tok, corpus), (0, None))
+        self.pending[(tok, corpus)] = (count + 1, time.time())
+        self.touched.add((tok, corpus))
+
+    def touch(self, tok: str, corpus: str):
+        """
+        Touches the cache entry for 'tok' in 'corpus' without counting a request.
+        """
+        self.touched.add((tok, corpus))
+
+    async def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+
+        await self.flush()
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+
+            try:
+                await self.flush()
+            except Exception as ex:
+                logger.warning("Couldn't record accesses (%s)" % ex)
+
+    async def flush(self):
+        if not self.touched:
+            return
+
+        pending, self.pending = self.pending, {}
+        touched, self.touched = self.touched, set()
+
+        async with self.client.pipeline(transaction=False) as pipe:
+            for (tok, corpus), (count, last_access) in pending.items():
+                pipe.zincrby(request_counts_key(corpus), count, tok)
+                pipe.zadd(last_access_key(corpus), {tok: last_access})
+
+            pipe.touch(*[neighbors_cache_key(tok, corpus) for tok, corpus in touched])
+            await pipe.execute()
+
+
+# ========================================================================
+# === entry counts
+# ========================================================================
+
+
+# recounts the cached responses and sets the entry counts to match, in total
+# (KEYS[1]) and per corpus (KEYS[2...] are set to 0 first, and the count of
+# each corpus found is set at ARGV[3]:<corpus>). the keys matching ARGV[1]
+# whose corpus is captured by the Lua pattern ARGV[2] are counted. if ARGV[4]
+# is given, ARGV[5] is published to it when done.
+#
+# scripts run atomically, so no entry is written, removed or counted while
+# the keyspace is scanned, and the published marker separates the removal
+# notifications the counts already reflect from those that they don't.
+# returns the total followed by each corpus and its count
+RECOUNT_ENTRIES_SCRIPT = """
+local total, counts = 0, {}
+local cursor = '0'
+repeat
+    local reply = redis.call('SCAN', cursor, 'MATCH', ARGV[1], 'COUNT', 1000)
+    cursor = reply[1]
+    for _, key in ipairs(reply[2]) do
+        local corpus = string.match(key, ARGV[2])
+        if corpus then
+            total = total + 1
+            counts[corpus] = (counts[corpus] or 0) + 1
+        end
+    end
+until cursor == '0'
+redis.call('SET', KEYS[1], total)
+for i = 2, #KEYS do
+    redis.call('SET', KEYS[i], 0)
+end
+local result = {total}
+for corpus, count in pairs(counts) do
+    redis.call('SET', ARGV[3] .. ':' .. corpus, count)
+    table.insert(result, corpus)
+    table.insert(result, count)
+end
+if ARGV[4] ~= '' then
+    redis.call('PUBLISH', ARGV[4], ARGV[5])
+end
+return result
+"""
+
+# the Lua pattern equivalent of NEIGHBORS_CACHE_KEY_RE, capturing the corpus
+NEIGHBORS_CACHE_KEY_LUA_PATTERN = (
+    "^%s:backend%%.main%%.neighbors%%(tok=.*,corpus=([^,)]*)%%)$" % CACHE_PREFIX
+)
+
+
+def recount_entries(script, marker_channel="", marker=""):
+    """
+    Recounts the cached responses and overwrites the entry counts with the
+    result, in a single atomic step, by running 'script', which is
+    RECOUNT_ENTRIES_SCRIPT as registered on a (non-async or async) redis
+    client. If 'marker_channel' is given, 'marker' is published to it right
+    after.
+
+    This walks the whole keyspace while blocking redis, so it's only meant for
+    seeding the counts or for reconciling them when the process keeping them
+    changes; they're otherwise maintained as entries come and go.
+
+    Returns what 'script' returns: the reply of RECOUNT_ENTRIES_SCRIPT, or an
+    awaitable of it for an async client (see parse_recount()).
+    """
+    return script(
+        keys=[entry_count_key()] + [entry_count_key(corpus) for corpus in CORPORA_SET],
+        args=[
+            "%s:*" % CACHE_PREFIX,
+            NEIGHBORS_CACHE_KEY_LUA_PATTERN,
+            ENTRY_COUNT_KEY,
+            marker_channel,
+            marker,
+        ],
+    )
+
+
+def parse_recount(reply):
+    """
+    Converts the reply of RECOUNT_ENTRIES_SCRIPT into a dict of entry count
+    key => count.
+
+    >>> parse_recount([3, b"pubtator", 2, b"preprints", 1])
+    {'meta:cached_entry_count': 3, 'meta:cached_entry_count:pubtator': 2, 'meta:cached_entry_count:preprints': 1}
+    """
+    corpora = [
+        corpus.decode("utf8") if isinstance(corpus, bytes) else corpus
+        for corpus in reply[1::2]
+    ]
+
+    return {
+        entry_count_key(): reply[0],
+        **{entry_count_key(corpus): count for corpus, count in zip(corpora, reply[2::2])},
+    }
+
+
+# keyspace events that mean a key is gone. requires that redis'
+# notify-keyspace-events setting includes 'E' (keyevent notifications), 'x'
+# (expired), 'e' (evicted) and 'g' (generic commands, e.g. del), as in
+# services/redis/redis.conf
+REMOVAL_EVENTS = ("expired", "evicted", "del")
+NOTIFY_KEYSPACE_EVENTS = "Exeg"
+
+# renews the lease in KEYS[1] for ARGV[2] seconds if it's still held by ARGV[1]
+RENEW_LEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+
+class EntryCountKeeper:
+    """
+    Decrements the entry counts (and drops the entry from the index of the
+    most requested tokens) as cached responses expire, are evicted or are
+    deleted, which redis announces via keyspace notifications; incrementing is
+    done as they're written (see SET_AND_COUNT_SCRIPT).
+
+    Notifications are delivered to every subscriber, so only one process
+    should apply them: every API process runs a keeper, but they elect a
+    leader by holding a lease on LEADER_KEY, and only the leader subscribes.
+    Since notifications sent while no process was subscribed are lost, a new
+    leader recounts the entries once when it takes over (see
+    recount_entries()). The recount is atomic, and publishes a marker to
+    RECOUNT_CHANNEL once it's done; the notifications the leader receives
+    before its marker are already reflected in the counts, so they're skipped.
+
+    'client' is an async redis client, e.g. redis.asyncio.Redis.
+    """
+
+    LEADER_KEY = "meta:entry_count_leader"
+    RECOUNT_CHANNEL = "meta:entry_count_recounted"
+
+    def __init__(self, client, lease_secs=30):
+        self.client = client
+        self.lease_secs = lease_secs
+        self.id = uuid.uuid4().hex
+        self.renew_lease = client.register_script(RENEW_LEASE_SCRIPT)
+        self.recount = client.register_script(RECOUNT_ENTRIES_SCRIPT)
+        self.task = None
+
+    async def start(self):
+        try:
+            # in case redis was started without our config, e.g. a managed one
+            await self.client.config_set("notify-keyspace-events", NOTIFY_KEYSPACE_EVENTS)
+        except Exception as ex:
+            logger.warning("Couldn't enable keyspace notifications (%s)" % ex)
+
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+
+        # lets another process take over right away, if we were the leader
+        try:
+            await self.renew_lease(keys=[self.LEADER_KEY], args=[self.id, 0])
+        except Exception as ex:
+            logger.warning("Couldn't release the entry count lease (%s)" % ex)
+
+    async def run(self):
+        while True:
+            try:
+                if await self.client.set(
+                    self.LEADER_KEY, self.id, nx=True, ex=self.lease_secs
+                ):
+                    logger.info("Keeping cache entry counts in this process")
+                    await self.lead()
+            except asyncio.CancelledError:
+                raise
+            except Exception as ex:
+                logger.warning("Keeping cache entry counts failed (%s), retrying..." % ex)
+
+            await asyncio.sleep(self.lease_secs / 3)
+
+    async def lead(self):
+        """
+        Applies removal notifications while renewing the lease, returning if
+        it's lost.
+        """
+        loop = asyncio.get_running_loop()
+        pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+
+        try:
+            await pubsub.psubscribe(
+                *["__keyevent@*__:%s" % event for event in REMOVAL_EVENTS]
+            )
+            await pubsub.subscribe(self.RECOUNT_CHANNEL)
+
+            # recount after subscribing, so no removals are missed in between
+            marker = await self.reconcile()
+            recounted = False
+            renew_at = loop.time() + self.lease_secs / 3
+
+            while True:
+                message = await pubsub.get_message(timeout=1.0)
+
+                if message is None:
+                    pass
+                elif message["type"] == "message":
+                    recounted = recounted or message["data"].decode("utf8") == marker
+                elif recounted:
+                    await self.removed(message["data"])
+
+                if loop.time() >= renew_at:
+                    if not await self.renew_lease(
+                        keys=[self.LEADER_KEY], args=[self.id, self.lease_secs]
+                    ):
+                        return
+                    renew_at = loop.time() + self.lease_secs / 3
+        finally:
+            await pubsub.reset()
+
+    async def removed(self, key):
+        parsed = parse_neighbors_cache_key(key)
+
+        if parsed is None:
+            return
+
+        tok, corpus = parsed
+
+        # the entry is no longer in the cache, so it no longer has a place in
+        # the index of the most requested ones
+        async with self.client.pipeline(transaction=False) as pipe:
+            await (
+                pipe.decr(entry_count_key())
+                .decr(entry_count_key(corpus))
+                .zrem(request_counts_key(corpus), tok)
+                .zrem(last_access_key(corpus), tok)
+                .execute()
+            )
+
+    async def reconcile(self):
+        """
+        Recounts the cached entries, returning the marker that's published to
+        RECOUNT_CHANNEL when it's done.
+        """
+        marker = uuid.uuid4().hex
+        counts = parse_recount(
+            await recount_entries(
+                self.recount, marker_channel=self.RECOUNT_CHANNEL, marker=marker
+            )
+        )
+
+        logger.info("Recounted cached entries: %s" % counts)
+
+        return marker
+
+
+# ========================================================================
+# === HTTP caching
+# ========================================================================
+
+
+def request_is_not_cacheable(request):
+    """
+    Returns True if 'request' asks not to be served from the cache.
+    """
+    cache_control = request.headers.get("Cache-Control", "") if request else ""
+    return "no-store" in cache_control or "no-cache" in cache_control
+
+
+def etag_for(value):
+    """
+    Returns the ETag of a response whose encoded form is 'value'. The JSON
+    body produced for a given encoded form is always the same, so this can be
+    computed (and checked against a request's If-None-Match) without decoding
+    it.
+    """
+    return '"%s"' % hashlib.sha1(value).hexdigest()
+
+
+def requested_resource_not_modified(request, etag):
+    """
+    Returns True if 'request' has an If-None-Match header that matches 'etag',
+    i.e. the client already has this version of the response.
+    """
+    if not request or "If-None-Match" not in request.headers:
+        return False
+
+    check_etags = [
+        x.strip() for x in request.headers["If-None-Match"].split(",") if x.strip()
+    ]
+
+    # If-None-Match uses the weak comparison, which ignores the W/ prefix
+    return check_etags == ["*"] or any(
+        (x[2:] if x.startswith("W/") else x) == etag for x in check_etags
+    )
+
+
+def cache_headers(cache_hit, etag, max_age):
+    """
+    Returns the headers for a response served from the cache (if 'cache_hit')
+    or just added to it, which clients and proxies may reuse for 'max_age'
+    seconds before revalidating it with its ETag.
+    """
+    expires_at = datetime.utcnow() + timedelta(seconds=max_age)
+
+    return {
+        CACHE_HEADER: "Hit" if cache_hit else "Miss",
+        "Expires": expires_at.strftime(HTTP_TIME),
+        "Cache-Control": "public, max-age=%d" % max_age,
+        "ETag": etag,
+    }
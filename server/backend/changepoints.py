@@ -0,0 +1,63 @@
+import logging
+import os
+import sys
+from csv import DictReader
+from pathlib import Path
+
+logging.basicConfig(stream=sys.stdout)
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# the per-corpus changepoint files produced by word-lapse-models, relative to
+# the data folder
+CHANGEPOINT_FILES = {
+    "pubtator": Path("pubtator_changepoints.tsv"),
+    "preprints": Path("preprint_changepoints.tsv"),
+}
+
+
+class ChangepointIndex:
+    """
+    Holds a corpus' changepoints keyed by token, with each changepoint already
+    split into its [start, end] pair, so looking up a token's changepoints
+    doesn't involve reading or scanning the changepoint file.
+
+    The modification time of the file is recorded when it's read, so callers
+    can check is_stale() and reload the index if the file has been replaced.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.mtime = os.stat(self.path).st_mtime_ns
+        self.changepoints = {}
+
+        with open(self.path, "r") as fp:
+            for row in DictReader(fp, dialect="excel-tab"):
+                # e.g., "2005-2006" => ["2005", "2006"]
+                self.changepoints.setdefault(row["tok"], []).append(
+                    [y.strip() for y in row["changepoint_idx"].split("-")]
+                )
+
+        logger.info(
+            "Loaded changepoints for %d tokens from %s"
+            % (len(self.changepoints), self.path)
+        )
+
+    def is_stale(self):
+        """
+        Returns True if the file backing this index has changed since it
+        was read.
+        """
+        try:
+            return os.stat(self.path).st_mtime_ns != self.mtime
+        except FileNotFoundError:
+            # keep serving what we have until a replacement shows up
+            return False
+
+    def lookup(self, tok: str):
+        """
+        Returns the changepoints for 'tok' as a list of [start, end] pairs,
+        in the order in which they appear in the file, or an empty list if
+        'tok' has no changepoints.
+        """
+        return [list(pair) for pair in self.changepoints.get(tok, ())]
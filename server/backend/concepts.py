@@ -0,0 +1,198 @@
+"""
+The concept ID file from word-lapse-models, all_concept_ids.tsv.xz, and the
+lookups that are built from it:
+- the concept ID => label map used to label neighbors, data/concept_ids.strtab
+  (see neighbors.get_concept_id_mapper()), a sorted StringTable of the
+  lowercased IDs with their labels as values. It's memory-mapped, so every
+  worker process on a machine shares a single copy of it, and it's read with
+  the same 'in', [], and get() as a dict
+- the concept label => ID table used by /autocomplete, which is part of the
+  autocomplete index (see backend.autocomplete)
+
+Both are built on demand if they're missing, but after a data refresh they
+should be rebuilt ahead of time with this module's command line interface.
+It reads the concept file once, builds the lookups in parallel, and checks
+them against the file before moving them into place.
+
+Usage, from the server folder:
+  python -m backend.concepts build [--jobs 2]
+"""
+
+import argparse
+import logging
+import os
+import sys
+from pathlib import Path
+
+import pandas as pd
+from joblib import Parallel, delayed
+
+from .strtable import StringTable
+from .tracking import ExecTimer
+
+logging.basicConfig(stream=sys.stdout)
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# relative to the data folder
+CONCEPTS_FILE = Path("all_concept_ids.tsv.xz")
+CONCEPT_MAP_FILE = Path("concept_ids.strtab")
+
+
+def read_concepts(path):
+    """
+    Reads the concept ID file at 'path' into a DataFrame with the columns
+    'concept_id' and 'concept' (the label), in the file's order.
+    """
+    logger.info("Reading concepts from %s..." % path)
+
+    concepts = pd.read_csv(
+        path,
+        sep="\t",
+        usecols=["concept_id", "concept"],
+        dtype=str,
+        # labels like 'nan' and 'null' are real words, not missing values
+        keep_default_na=False,
+        na_filter=False,
+    )
+
+    logger.info("...done! %d concepts" % len(concepts))
+
+    return concepts
+
+
+def concept_labels(concepts):
+    """
+    Returns a pair of (labels, concept IDs) from 'concepts', a DataFrame
+    returned by read_concepts(), sorted by label. If a label occurs more than
+    once, the last ID listed for it is used.
+    """
+    concepts = (
+        concepts[concepts.concept != ""]
+        .drop_duplicates("concept", keep="last")
+        .sort_values("concept")
+    )
+
+    return concepts.concept.tolist(), concepts.concept_id.tolist()
+
+
+def concept_id_entries(concepts):
+    """
+    Returns a pair of (lowercased concept IDs, labels) from 'concepts', a
+    DataFrame returned by read_concepts(), sorted by ID. If an ID occurs more
+    than once, the last label listed for it is used.
+    """
+    concepts = (
+        concepts.assign(concept_id=concepts.concept_id.str.lower())
+        .drop_duplicates("concept_id", keep="last")
+        .sort_values("concept_id")
+    )
+
+    return concepts.concept_id.tolist(), concepts.concept.tolist()
+
+
+def write_concept_map(path, concepts):
+    """
+    Writes the concept ID => label map of 'concepts' to 'path'; see this
+    module's docstring for the format.
+    """
+    concept_ids, labels = concept_id_entries(concepts)
+    StringTable.write(path, concept_ids, labels, is_sorted=True)
+
+
+def load_concept_map(path):
+    """
+    Memory-maps the concept ID => label map written by write_concept_map().
+    """
+    return StringTable.open(path)
+
+
+# ========================================================================
+# === command line interface
+# ========================================================================
+
+
+def verify(concepts, concept_map_path, autocomplete_index_path):
+    """
+    Checks that the concept ID => label map at 'concept_map_path' and the
+    labels in the autocomplete index at 'autocomplete_index_path' match
+    'concepts', raising a ValueError if they don't.
+    """
+    from .autocomplete import AutocompleteIndex
+
+    for path, table, (keys, values) in (
+        (
+            concept_map_path,
+            load_concept_map(concept_map_path),
+            concept_id_entries(concepts),
+        ),
+        (
+            autocomplete_index_path,
+            AutocompleteIndex.open(autocomplete_index_path).concepts.table,
+            concept_labels(concepts),
+        ),
+    ):
+        if list(table.keys()) != keys or [
+            table.value(idx) for idx in range(len(table))
+        ] != values:
+            raise ValueError("%s doesn't match the concept file" % path)
+
+
+def build(args):
+    from .autocomplete import AUTOCOMPLETE_INDEX_FILE, build_autocomplete_index
+    data_folder = Path(args.data_folder)
+
+    paths = [data_folder / CONCEPT_MAP_FILE, data_folder / AUTOCOMPLETE_INDEX_FILE]
+    tmp_paths = ["%s.build.%d" % (path, os.getpid()) for path in paths]
+
+    with ExecTimer(verbose=True):
+        concepts = read_concepts(data_folder / CONCEPTS_FILE)
+
+        print("Building %s..." % ", ".join(str(path) for path in paths), flush=True)
+        Parallel(n_jobs=args.jobs, backend=args.backend)(
+            [
+                delayed(write_concept_map)(tmp_paths[0], concepts),
+                delayed(build_autocomplete_index)(
+                    data_folder, tmp_paths[1], concepts=concepts
+                ),
+            ]
+        )
+
+        print("Verifying...", flush=True)
+        try:
+            verify(concepts, *tmp_paths)
+        except ValueError:
+            for tmp_path in tmp_paths:
+                os.remove(tmp_path)
+            raise
+
+        for tmp_path, path in zip(tmp_paths, paths):
+            os.replace(tmp_path, path)
+
+        print("...done!", flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Builds the concept lookups from all_concept_ids.tsv.xz"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build_parser = subparsers.add_parser(
+        "build", help="rebuild concept_ids.strtab and the autocomplete index"
+    )
+    build_parser.add_argument(
+        "--jobs", type=int, default=2, help="lookups built at once"
+    )
+    build_parser.add_argument("--backend", default="loky", help="joblib backend")
+    build_parser.add_argument(
+        "--data-folder", default="./data", help="the data folder (default: ./data)"
+    )
+    build_parser.set_defaults(func=build)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -31,6 +31,25 @@ def is_truthy(v):
     )
 
 
+def parse_years(spec):
+    """
+    Returns the set of years in 'spec', a comma-separated list of years and
+    ranges of years, as strings (which is how the year models are keyed).
+
+    >>> sorted(parse_years("2000-2002,2010"))
+    ['2000', '2001', '2002', '2010']
+    >>> sorted(parse_years(" 2005 "))
+    ['2005']
+    """
+    years = set()
+
+    for part in spec.split(","):
+        start, _, end = part.strip().partition("-")
+        years.update(str(year) for year in range(int(start), int(end or start) + 1))
+
+    return years
+
+
 # when DEBUG is true, uvicorn will run in debug mode with autoreload enabled
 DEBUG = is_truthy(os.environ.get("DEBUG", False))
 
@@ -56,6 +75,39 @@ MATERIALIZE_MODELS = is_truthy(os.environ.get("MATERIALIZE_MODELS", True))
 # (requires that MATERIALIZE_MODELS is true, since otherwise there's no cache to warm)
 WARM_CACHE = MATERIALIZE_MODELS and is_truthy(os.environ.get("WARM_CACHE", True))
 
+# selects how nearest neighbors are found in the year models:
+# - 'vectorized': queries all the year models with matrix products over their
+#   normalized vectors, which are written next to each model on first use
+#   (requires that MATERIALIZE_MODELS is true)
+# - 'ann': like 'vectorized', but searches each year's approximate
+#   nearest-neighbor index instead, for years that have one (see backend/ann.py)
+# - 'quantized': like 'vectorized', but scans a float16 or int8 copy of each
+#   year's vectors for candidates, then re-ranks them with the exact vectors,
+#   for years that have one (see backend/quantize.py)
+# - 'gensim': calls each year model's most_similar() in turn
+NEIGHBOR_ENGINE = (
+    os.environ.get("NEIGHBOR_ENGINE", "vectorized") if MATERIALIZE_MODELS else "gensim"
+)
+
+# number of clusters each approximate nearest-neighbor query searches, if
+# NEIGHBOR_ENGINE is 'ann'; higher is more accurate but slower. use
+# 'python -m backend.ann report' to pick a value
+ANN_NPROBE = int(os.environ.get("ANN_NPROBE", 16))
+
+# which quantized copy of the vectors to scan, if NEIGHBOR_ENGINE is
+# 'quantized'; either 'int8' (a quarter of the size) or 'float16' (half)
+QUANTIZED_DTYPE = os.environ.get("QUANTIZED_DTYPE", "int8")
+
+# number of candidates found in the quantized vectors per query, which are
+# re-ranked with the exact vectors; higher is more accurate but slower. use
+# 'python -m backend.quantize report' to pick a value
+QUANTIZED_CANDIDATES = int(os.environ.get("QUANTIZED_CANDIDATES", 100))
+
+# if USE_NEIGHBOR_TABLE is truthy, the neighbors of tokens in the shared
+# vocabulary are read from the corpus' precomputed neighbor table, if one has
+# been built (see backend/neighbor_table.py); other tokens are searched for
+USE_NEIGHBOR_TABLE = is_truthy(os.environ.get("USE_NEIGHBOR_TABLE", True))
+
 # if PARALLELIZE_QUERY is truthy or unspecified, queries year models in parallel
 PARALLELIZE_QUERY = is_truthy(os.environ.get("PARALLELIZE_QUERY", False))
 # integer number of pools to use for parallel year queries, default 4
@@ -65,6 +117,63 @@ PARALLEL_POOLS = int(os.environ.get("PARALLEL_POOLS", 4))
 # options are listed here: https://joblib.readthedocs.io/en/latest/generated/joblib.Parallel.html
 PARALLEL_BACKEND = os.environ.get("PARALLEL_BACKEND", "loky")
 
+# if RELOAD_CHANGEPOINTS is truthy, workers reload a corpus' changepoints when
+# its changepoint file is modified; otherwise, they're loaded once at startup
+RELOAD_CHANGEPOINTS = is_truthy(os.environ.get("RELOAD_CHANGEPOINTS", True))
+
+# the maximum number of tokens that can be requested at once from /neighbors/batch
+MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", 100))
+
+# while waiting on a job, the API is notified as soon as it's done, but it
+# also checks the job's status at this interval in case a notification is lost
+JOB_STATUS_POLL_SECS = float(os.environ.get("JOB_STATUS_POLL_SECS", 10))
+
+# maximum number of connections each API process opens to redis, shared by all
+# its requests; requests wait for a free connection once they're all in use
+REDIS_POOL_SIZE = int(os.environ.get("REDIS_POOL_SIZE", 32))
+
+# each API process keeps up to this many bytes of recently requested /neighbors
+# responses in memory, in front of the redis cache; 0 disables it
+LOCAL_CACHE_MAX_BYTES = int(os.environ.get("LOCAL_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+
+# responses are kept in memory for at most this long, so that changes to the
+# redis cache are eventually seen
+LOCAL_CACHE_TTL_SECS = int(os.environ.get("LOCAL_CACHE_TTL_SECS", 300))
+
+# browsers and proxies may reuse a /neighbors response for this long before
+# revalidating it, which is cheap since the response's ETag is checked before
+# it's decoded
+HTTP_CACHE_MAX_AGE_SECS = int(os.environ.get("HTTP_CACHE_MAX_AGE_SECS", 60 * 60))
+
+# if set, each /neighbors request is split into one job per shard of the years,
+# which the workers for each shard run in parallel and the API merges. it's a
+# space-separated list of shards, each of which is a list of years in the
+# format parse_years() accepts, e.g. "2000-2007 2008-2014 2015-2021". each
+# shard's jobs go to the workers with that shard's models (see WORKER_YEARS),
+# if there are any. other jobs (e.g., /neighbors/batch) need all the years
+YEAR_SHARDS = os.environ.get("YEAR_SHARDS", "").split()
+
+# if set, a worker only loads the year models for these years, in the format
+# parse_years() accepts, and serves the shard with the same value in the API's
+# YEAR_SHARDS (i.e., listens on the w2v_queries:<corpus>:<WORKER_YEARS> queue
+# for each corpus, or w2v_queries:<WORKER_YEARS> with all the corpora)
+WORKER_YEARS = os.environ.get("WORKER_YEARS") or None
+
+# if set, a worker only loads the models for these corpora, a comma-separated
+# list of the ids in CORPORA_SET, and only takes their jobs (i.e., listens on
+# the w2v_queries:<corpus> queue for each, or w2v_queries:<corpus>:<shard>
+# with WORKER_YEARS). the API routes each job to the workers with the fewest
+# models that can run it, so the corpora can be scaled independently
+WORKER_CORPORA = [
+    corpus.strip()
+    for corpus in os.environ.get("WORKER_CORPORA", "").split(",")
+    if corpus.strip()
+] or None
+
+# how long the API reuses the list of queues that workers are listening on
+# when routing jobs, before reading it again
+WORKER_QUEUES_TTL_SECS = float(os.environ.get("WORKER_QUEUES_TTL_SECS", 10))
+
 # number of rq workers available, read from the environment
 RQ_CONCURRENCY = int(os.environ.get("RQ_CONCURRENCY", -1))
 
@@ -76,9 +185,25 @@ def get_config_values():
         "USE_MEMMAP": USE_MEMMAP,
         "MATERIALIZE_MODELS": MATERIALIZE_MODELS,
         "WARM_CACHE": WARM_CACHE,
+        "NEIGHBOR_ENGINE": NEIGHBOR_ENGINE,
+        "ANN_NPROBE": ANN_NPROBE,
+        "QUANTIZED_DTYPE": QUANTIZED_DTYPE,
+        "QUANTIZED_CANDIDATES": QUANTIZED_CANDIDATES,
+        "USE_NEIGHBOR_TABLE": USE_NEIGHBOR_TABLE,
         "PARALLELIZE_QUERY": PARALLELIZE_QUERY,
         "PARALLEL_POOLS": PARALLEL_POOLS,
         "PARALLEL_BACKEND": PARALLEL_BACKEND,
+        "RELOAD_CHANGEPOINTS": RELOAD_CHANGEPOINTS,
+        "MAX_BATCH_SIZE": MAX_BATCH_SIZE,
+        "JOB_STATUS_POLL_SECS": JOB_STATUS_POLL_SECS,
+        "REDIS_POOL_SIZE": REDIS_POOL_SIZE,
+        "LOCAL_CACHE_MAX_BYTES": LOCAL_CACHE_MAX_BYTES,
+        "LOCAL_CACHE_TTL_SECS": LOCAL_CACHE_TTL_SECS,
+        "HTTP_CACHE_MAX_AGE_SECS": HTTP_CACHE_MAX_AGE_SECS,
+        "YEAR_SHARDS": YEAR_SHARDS,
+        "WORKER_YEARS": WORKER_YEARS,
+        "WORKER_CORPORA": WORKER_CORPORA,
+        "WORKER_QUEUES_TTL_SECS": WORKER_QUEUES_TTL_SECS,
         "RQ_CONCURRENCY": RQ_CONCURRENCY,
     }
 
@@ -91,6 +216,17 @@ def emit_config():
         "Materialized models (MATERIALIZE_MODELS)?: %s" % MATERIALIZE_MODELS, flush=True
     )
     print("Pre-warmed model cache (WARM_CACHE)?: %s" % WARM_CACHE, flush=True)
+    print("Neighbor engine (NEIGHBOR_ENGINE)?: %s" % NEIGHBOR_ENGINE, flush=True)
+    print("ANN clusters probed (ANN_NPROBE)?: %s" % ANN_NPROBE, flush=True)
+    print("Quantized vectors (QUANTIZED_DTYPE)?: %s" % QUANTIZED_DTYPE, flush=True)
+    print(
+        "Quantized candidates (QUANTIZED_CANDIDATES)?: %s" % QUANTIZED_CANDIDATES,
+        flush=True,
+    )
+    print(
+        "Precomputed neighbors (USE_NEIGHBOR_TABLE)?: %s" % USE_NEIGHBOR_TABLE,
+        flush=True,
+    )
     print(
         "Parallel year querying (PARALLELIZE_QUERY)?: %s" % PARALLELIZE_QUERY,
         flush=True,
@@ -99,6 +235,38 @@ def emit_config():
     print(
         "Joblib.Parallel backend (PARALLEL_BACKEND)?: %s" % PARALLEL_BACKEND, flush=True
     )
+    print(
+        "Reload modified changepoints (RELOAD_CHANGEPOINTS)?: %s"
+        % RELOAD_CHANGEPOINTS,
+        flush=True,
+    )
+    print("Max tokens per batch (MAX_BATCH_SIZE)?: %s" % MAX_BATCH_SIZE, flush=True)
+    print(
+        "Job status fallback interval (JOB_STATUS_POLL_SECS)?: %s"
+        % JOB_STATUS_POLL_SECS,
+        flush=True,
+    )
+    print("Redis connections per process (REDIS_POOL_SIZE)?: %s" % REDIS_POOL_SIZE, flush=True)
+    print(
+        "In-process cache size (LOCAL_CACHE_MAX_BYTES)?: %s" % LOCAL_CACHE_MAX_BYTES,
+        flush=True,
+    )
+    print(
+        "In-process cache lifetime (LOCAL_CACHE_TTL_SECS)?: %s" % LOCAL_CACHE_TTL_SECS,
+        flush=True,
+    )
+    print(
+        "HTTP cache lifetime (HTTP_CACHE_MAX_AGE_SECS)?: %s" % HTTP_CACHE_MAX_AGE_SECS,
+        flush=True,
+    )
+    print("Year shards (YEAR_SHARDS)?: %s" % YEAR_SHARDS, flush=True)
+    print("Worker's years (WORKER_YEARS)?: %s" % WORKER_YEARS, flush=True)
+    print("Worker's corpora (WORKER_CORPORA)?: %s" % WORKER_CORPORA, flush=True)
+    print(
+        "Worker queue refresh interval (WORKER_QUEUES_TTL_SECS)?: %s"
+        % WORKER_QUEUES_TTL_SECS,
+        flush=True,
+    )
 
 
 if __name__ == "__main__":
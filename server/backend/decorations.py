@@ -0,0 +1,213 @@
+"""
+Precomputed decorations of the year models' keys, i.e. the token and tag ID
+that the API reports for each key when it's a neighbor (see decorate_key()).
+
+Each year model's decorations are stored next to the model as
+<model>.decor.strtab, an unsorted StringTable with one entry per key in the
+model's order, whose key is the token and whose value is the tag ID (or an
+empty string if it has none). Since a neighbor's row in the model is also its
+row in this table, the NeighborEngine and the NeighborTable decorate their
+results by indexing into it, without looking anything up in the concept map.
+
+The decorations are written the first time they're loaded, and rewritten if
+the model or the concept map is newer than them; they can also be written
+ahead of time with this module's command line interface.
+
+Usage, from the server folder:
+  python -m backend.decorations build [--corpus pubtator] [--force]
+"""
+
+import argparse
+import logging
+import sys
+from pathlib import Path
+
+from .strtable import StringTable
+from .tracking import ExecTimer
+
+logging.basicConfig(stream=sys.stdout)
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def decorations_path(model_path):
+    """
+    Returns the path of the decorations that accompany the model at
+    'model_path'.
+    """
+    return Path("%s.decor.strtab" % model_path)
+
+
+def decorate_key(key: str, concept_map):
+    """
+    Returns the (token, tag ID) that the API reports for the model key 'key',
+    given 'concept_map', a mapping of lowercased concept IDs to labels (see
+    neighbors.get_concept_id_mapper()). Concept IDs are replaced by their
+    labels and tagged with their IDs; the tag ID is None for other keys.
+
+    >>> concept_map = {"mesh_d1": "cancer", "mcf-7": "MCF-7 cells"}
+    >>> decorate_key("disease_mesh_d1", concept_map)
+    ('cancer', 'disease_mesh_d1')
+    >>> decorate_key("mcf-7", concept_map)
+    ('MCF-7 cells', 'mcf-7')
+    >>> decorate_key("chemical_mesh_d2", concept_map)
+    ('mesh_d2', 'mesh')
+    >>> decorate_key("mouse", concept_map)
+    ('mouse', None)
+    """
+    tag_id = None
+    entity_features = []
+
+    # Convert tags that contain the following pattern
+    # disease_mesh_####### or chemical_mesh_#######
+    if "mesh" in key:
+        entity_features = key.split("_")
+        key = "_".join(entity_features[1:])
+
+        # a switch to tell the if statement below we found a mesh id
+        tag_id = "mesh"
+
+    # Insert tagged suffix to show users that
+    # some concpets are tagged and some concepts are missed
+    # example: mcf-7 is a cellline but the token itself appears as well
+    label = concept_map.get(key)
+
+    if label is not None:
+        # add entity type back to the mesh id for the front end
+        tag_id = key if tag_id is None else "_".join(entity_features)
+        key = label
+
+    return key, tag_id
+
+
+def write_decorations(path, index_to_key, concept_map):
+    """
+    Writes the decorations of each of 'index_to_key', a model's keys in
+    order, to 'path'.
+    """
+    decorated = [decorate_key(key, concept_map) for key in index_to_key]
+
+    StringTable.write(
+        path,
+        [token for token, _ in decorated],
+        [tag_id or "" for _, tag_id in decorated],
+    )
+
+
+class ModelDecorations:
+    """
+    A year model's decorations, memory-mapped from 'path'; see this module's
+    docstring for the format.
+    """
+
+    def __init__(self, path):
+        self.table = StringTable.open(path)
+
+    def __len__(self):
+        return len(self.table)
+
+    def decorate(self, ids, scores):
+        """
+        Returns the neighbors at the rows 'ids' of the model, with the scores
+        'scores', as the list of dicts returned by the API. Rows of -1 (i.e.
+        padding) are skipped.
+        """
+        return [
+            dict(
+                token=self.table.key(idx),
+                tag_id=self.table.value(idx) or None,
+                score=score,
+            )
+            for idx, score in zip(ids, scores)
+            if idx >= 0
+        ]
+
+
+def decorations_are_stale(model_path, concept_map_path=None):
+    """
+    Returns True if the decorations of the model at 'model_path' don't exist
+    or are older than the model or the concept map file at 'concept_map_path'.
+    """
+    path = decorations_path(model_path)
+    sources = [Path(model_path)]
+
+    if concept_map_path is not None:
+        sources.append(Path(concept_map_path))
+
+    return not path.exists() or path.stat().st_mtime < max(
+        source.stat().st_mtime for source in sources if source.exists()
+    )
+
+
+def load_decorations(model_path, load_keys, concept_map, concept_map_path=None):
+    """
+    Memory-maps the decorations of the model at 'model_path', writing them
+    first if they're stale (see decorations_are_stale()).
+
+    'load_keys' is called to get the model's keys (i.e. its index_to_key) if
+    the decorations have to be written; 'concept_map' is used to decorate
+    them.
+    """
+    path = decorations_path(model_path)
+
+    if decorations_are_stale(model_path, concept_map_path):
+        logger.info(" - writing decorations to %s..." % path)
+        write_decorations(path, load_keys(), concept_map)
+
+    return ModelDecorations(path)
+
+
+# ========================================================================
+# === command line interface
+# ========================================================================
+
+
+def build(args):
+    from .concepts import CONCEPT_MAP_FILE
+    from .neighbors import (
+        data_folder,
+        get_concept_id_mapper,
+        load_word_model,
+        word_models_by_year,
+    )
+
+    concept_map = get_concept_id_mapper()
+
+    # only the models whose decorations have to be written are loaded
+    for year, _, model_path in word_models_by_year(
+        corpus=args.corpus, just_reference=True
+    ):
+        path = decorations_path(model_path)
+
+        if not args.force and not decorations_are_stale(
+            model_path, data_folder / CONCEPT_MAP_FILE
+        ):
+            print("Decorations for %s are up to date, skipping" % year, flush=True)
+            continue
+
+        with ExecTimer(verbose=True):
+            print("Writing decorations for %s to %s..." % (year, path), flush=True)
+            write_decorations(path, load_word_model(model_path).index_to_key, concept_map)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Precomputes the decorations of each year model's keys"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build_parser = subparsers.add_parser(
+        "build", help="write the decorations of each year model in a corpus"
+    )
+    build_parser.add_argument("--corpus", default="pubtator")
+    build_parser.add_argument(
+        "--force", action="store_true", help="rewrite existing decorations"
+    )
+    build_parser.set_defaults(func=build)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
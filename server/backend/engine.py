@@ -0,0 +1,387 @@
+import logging
+import os
+import sys
+from pathlib import Path
+
+import numpy as np
+
+from .ann import load_ann_index
+from .quantize import load_quantized_vectors
+
+logging.basicConfig(stream=sys.stdout)
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# the maximum number of query vectors multiplied against a year's vectors at
+# once; bounds the size of the (vocab size x batch) score matrix
+MAX_BATCH_COLUMNS = 64
+
+
+def normed_vectors_path(model_path):
+    """
+    Returns the path of the normalized vectors file that accompanies the
+    model at 'model_path'.
+    """
+    return Path("%s.normed.npy" % model_path)
+
+
+def load_normed_vectors(model_path, model, use_mmap=True):
+    """
+    Returns the L2-normalized vectors of 'model' (a KeyedVectors instance
+    loaded from 'model_path') as a float32 matrix.
+
+    The matrix is stored next to the model file the first time it's
+    requested, then loaded from there (memory-mapped if 'use_mmap' is true)
+    so that it's shared between processes like the model itself. It's
+    rewritten if the model file is newer than it, or if it doesn't have a
+    row per key of the model (i.e., the model was replaced).
+    """
+    normed_path = normed_vectors_path(model_path)
+
+    def write():
+        logger.info(" - writing normalized vectors to %s..." % normed_path)
+        # computed the same way gensim computes them for most_similar()
+        normed = model.get_normed_vectors().astype(np.float32, copy=False)
+        tmp_path = "%s.tmp.%d.npy" % (normed_path, os.getpid())
+        np.save(tmp_path, normed)
+        os.replace(tmp_path, normed_path)
+
+    if (
+        not normed_path.exists()
+        or normed_path.stat().st_mtime < Path(model_path).stat().st_mtime
+    ):
+        write()
+
+    normed = np.load(normed_path, mmap_mode="r" if use_mmap else None)
+
+    if len(normed) != len(model.index_to_key):
+        logger.warning(
+            "%s has %d rows, but the model has %d keys"
+            % (normed_path, len(normed), len(model.index_to_key))
+        )
+        write()
+        normed = np.load(normed_path, mmap_mode="r" if use_mmap else None)
+
+    return normed
+
+
+def top_k(scores, k, exclude=None):
+    """
+    Given a (vocab size x batch) matrix of scores, returns a pair of
+    (batch x k) matrices containing the row indices and scores of the top 'k'
+    scores in each column, in descending order of score.
+
+    'exclude' is an optional sequence with one row index per column that
+    should be skipped in that column's results (i.e., the query token itself).
+    Columns may end up with fewer than 'k' results if there aren't enough
+    rows, in which case they're padded with an index of -1.
+
+    Uses a partial sort to find the candidates, then only sorts those.
+    """
+    n_rows, n_cols = scores.shape
+    # take an extra candidate so we can drop the excluded row
+    n_candidates = min(k + (0 if exclude is None else 1), n_rows)
+
+    if n_candidates < n_rows:
+        candidates = np.argpartition(-scores, n_candidates - 1, axis=0)[:n_candidates]
+    else:
+        candidates = np.broadcast_to(np.arange(n_rows)[:, None], (n_rows, n_cols))
+
+    candidate_scores = np.take_along_axis(scores, candidates, axis=0)
+    order = np.argsort(-candidate_scores, axis=0, kind="stable")
+    candidates = np.take_along_axis(candidates, order, axis=0).T
+    candidate_scores = np.take_along_axis(candidate_scores, order, axis=0).T
+
+    ids = np.full((n_cols, k), -1, dtype=np.int64)
+    top_scores = np.zeros((n_cols, k), dtype=scores.dtype)
+
+    for col in range(n_cols):
+        keep = (
+            candidates[col] != exclude[col]
+            if exclude is not None
+            else np.ones(len(candidates[col]), dtype=bool)
+        )
+        kept_ids = candidates[col][keep][:k]
+        ids[col, : len(kept_ids)] = kept_ids
+        top_scores[col, : len(kept_ids)] = candidate_scores[col][keep][:k]
+
+    return ids, top_scores
+
+
+class YearIndex:
+    """
+    A single year model's vocabulary and L2-normalized vectors, prepared for
+    nearest-neighbor queries with plain matrix products.
+
+    If 'ann_nprobe' is given, the year's approximate nearest-neighbor index
+    (see ann.py) is loaded too, if there is one, and used by search().
+    Otherwise, if 'quantized_dtype' is given, the year's quantized vectors
+    (see quantize.py) are loaded, if there are any, and search() scans them for
+    'quantized_candidates' candidates per query before re-ranking them.
+
+    If 'decorations' (the model's ModelDecorations; see decorations.py) is
+    given, the NeighborEngine uses it to produce each neighbor's API dict.
+    """
+
+    def __init__(
+        self,
+        year,
+        model_path,
+        model,
+        use_mmap=True,
+        ann_nprobe=None,
+        quantized_dtype=None,
+        quantized_candidates=100,
+        decorations=None,
+    ):
+        self.year = year
+        self.model_path = model_path
+        self.key_to_index = model.key_to_index
+        self.index_to_key = model.index_to_key
+        self.normed = load_normed_vectors(model_path, model, use_mmap=use_mmap)
+        self.ann_index = (
+            load_ann_index(model_path, nprobe=ann_nprobe, use_mmap=use_mmap)
+            if ann_nprobe
+            else None
+        )
+        self.quantized = (
+            load_quantized_vectors(model_path, quantized_dtype, use_mmap=use_mmap)
+            if quantized_dtype and self.ann_index is None
+            else None
+        )
+        self.quantized_candidates = quantized_candidates
+
+        # copies built from a different version of the model can't be used
+        if self.ann_index is not None and self.ann_index.ntotal != len(self.normed):
+            logger.warning(
+                "The ANN index of %s doesn't match the model, using exact search"
+                % model_path
+            )
+            self.ann_index = None
+
+        if self.quantized is not None and len(self.quantized.vectors) != len(self.normed):
+            logger.warning(
+                "The quantized vectors of %s don't match the model, using exact search"
+                % model_path
+            )
+            self.quantized = None
+
+        self.decorations = decorations
+
+    def query_vectors(self, rows):
+        # renormalize the queries the way gensim does, so that scores match
+        queries = self.normed[rows]
+        return queries / np.linalg.norm(queries, axis=1, keepdims=True)
+
+    def search(self, rows, topn):
+        """
+        For each of the row indices in 'rows', finds the 'topn' rows with the
+        highest cosine similarity, excluding the row itself.
+
+        Returns a pair of (len(rows) x topn) matrices of row indices and
+        similarity scores, in descending order of similarity. Rows with fewer
+        than 'topn' neighbors are padded with an index of -1.
+
+        Uses the ANN index or the quantized vectors if this year has them,
+        otherwise the exact search.
+        """
+        if self.ann_index is not None:
+            return self.search_ann(rows, topn)
+
+        if self.quantized is not None:
+            return self.search_quantized(rows, topn)
+
+        return self.search_exact(rows, topn)
+
+    def search_exact(self, rows, topn):
+        """
+        Implements search() by scoring every row in the vocabulary.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        ids = np.empty((len(rows), topn), dtype=np.int64)
+        scores = np.empty((len(rows), topn), dtype=np.float32)
+
+        for start in range(0, len(rows), MAX_BATCH_COLUMNS):
+            batch = rows[start : start + MAX_BATCH_COLUMNS]
+            batch_scores = self.normed @ self.query_vectors(batch).T
+
+            ids[start : start + len(batch)], scores[start : start + len(batch)] = top_k(
+                batch_scores, topn, exclude=batch
+            )
+
+        return ids, scores
+
+    def search_ann(self, rows, topn):
+        """
+        Implements search() with the ANN index. Any row for which the index
+        finds fewer than 'topn' neighbors (e.g., because the probed clusters
+        are too small) is answered with the exact search instead.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        # ask for one extra, since the index will usually return the row itself
+        ann_scores, ann_ids = self.ann_index.search(
+            np.ascontiguousarray(self.query_vectors(rows), dtype=np.float32), topn + 1
+        )
+
+        ids = np.full((len(rows), topn), -1, dtype=np.int64)
+        scores = np.zeros((len(rows), topn), dtype=np.float32)
+        fallback = []
+
+        for i, row in enumerate(rows):
+            keep = (ann_ids[i] >= 0) & (ann_ids[i] != row)
+
+            if keep.sum() < min(topn, len(self.index_to_key) - 1):
+                fallback.append(i)
+                continue
+
+            ids[i] = ann_ids[i][keep][:topn]
+            scores[i] = ann_scores[i][keep][:topn]
+
+        if fallback:
+            ids[fallback], scores[fallback] = self.search_exact(rows[fallback], topn)
+
+        return ids, scores
+
+    def search_quantized(self, rows, topn):
+        """
+        Implements search() by scanning the quantized vectors for the
+        candidates with the highest approximate scores, then ranking the
+        candidates by their exact scores, computed from just their rows of the
+        normalized vectors. The scores returned are the exact ones.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        queries = self.query_vectors(rows)
+        candidates = self.quantized.candidates(
+            queries, max(self.quantized_candidates, topn + 1)
+        )
+
+        ids = np.full((len(rows), topn), -1, dtype=np.int64)
+        scores = np.zeros((len(rows), topn), dtype=np.float32)
+
+        for i, (row, query, row_candidates) in enumerate(zip(rows, queries, candidates)):
+            # read the rows in order, which is kinder to a memory-mapped matrix
+            row_candidates = np.sort(row_candidates[row_candidates != row])
+            exact_scores = self.normed[row_candidates] @ query
+
+            order = np.argsort(-exact_scores, kind="stable")[:topn]
+            ids[i, : len(order)] = row_candidates[order]
+            scores[i, : len(order)] = exact_scores[order]
+
+        return ids, scores
+
+
+class NeighborEngine:
+    """
+    Answers nearest-neighbor queries for one or more tokens over all the year
+    models of a corpus.
+
+    Each year's query vectors are gathered up front and then multiplied against
+    that year's normalized vectors in a single matrix product, with a partial
+    sort to find the top entries, which replaces calling gensim's
+    most_similar() per token and per year. Years with an ANN index or
+    quantized vectors can search those instead.
+    """
+
+    def __init__(self, year_indices):
+        self.year_indices = year_indices
+
+    @classmethod
+    def from_models(
+        cls,
+        models,
+        use_mmap=True,
+        ann_nprobe=None,
+        quantized_dtype=None,
+        quantized_candidates=100,
+        decorations=None,
+    ):
+        """
+        Builds an engine from 'models', a sequence of (year, model_path, model)
+        tuples, where each model is a KeyedVectors instance.
+
+        If 'ann_nprobe' is given, each year's ANN index is used where
+        available, and likewise the quantized vectors if 'quantized_dtype' is
+        given; see YearIndex. 'decorations' is an optional dict of each year's
+        ModelDecorations.
+        """
+        return cls(
+            [
+                YearIndex(
+                    year,
+                    model_path,
+                    model,
+                    use_mmap=use_mmap,
+                    ann_nprobe=ann_nprobe,
+                    quantized_dtype=quantized_dtype,
+                    quantized_candidates=quantized_candidates,
+                    decorations=(decorations or {}).get(year),
+                )
+                for year, model_path, model in models
+            ]
+        )
+
+    def query(self, toks, resolve, topn=25, on_year=None, years=None):
+        """
+        Finds the 'topn' nearest neighbors of each token in 'toks' in each year.
+
+        'resolve' is a function taking a token and a year's key_to_index dict,
+        returning the key under which the token is stored in that year (or None
+        if it's not present), e.g. neighbors.resolve_model_token().
+
+        If 'on_year' is given, it's called with (year, {tok: neighbors}) as each
+        year's results become available. If 'years' is given, only those years
+        are queried.
+
+        Returns a dict of the form
+        {<tok>: {<year>: [(<neighbor key>, <score>), ...], ...}, ...}, where a
+        token that doesn't occur in a year's model has an empty list for that
+        year. For years with decorations, each neighbor is instead the dict
+        returned by the API (see ModelDecorations.decorate()).
+        """
+        year_indices = [
+            year_index
+            for year_index in self.year_indices
+            if years is None or year_index.year in years
+        ]
+
+        # gather the row of each token in each year in one pass
+        present = []
+
+        for year_index in year_indices:
+            model_toks = [(tok, resolve(tok, year_index.key_to_index)) for tok in toks]
+            present.append(
+                [
+                    (tok, year_index.key_to_index[model_tok])
+                    for tok, model_tok in model_toks
+                    if model_tok is not None
+                ]
+            )
+
+        result = {tok: {} for tok in toks}
+
+        for year_index, year_present in zip(year_indices, present):
+            year_result = {tok: [] for tok in toks}
+
+            if year_present:
+                ids, scores = year_index.search([row for _, row in year_present], topn)
+
+                for (tok, _), tok_ids, tok_scores in zip(year_present, ids, scores):
+                    if year_index.decorations is not None:
+                        year_result[tok] = year_index.decorations.decorate(
+                            tok_ids.tolist(), tok_scores.tolist()
+                        )
+                        continue
+
+                    year_result[tok] = [
+                        (year_index.index_to_key[idx], score)
+                        for idx, score in zip(tok_ids.tolist(), tok_scores.tolist())
+                        if idx >= 0
+                    ]
+
+            for tok in toks:
+                result[tok][year_index.year] = year_result[tok]
+
+            if on_year is not None:
+                on_year(year_index.year, year_result)
+
+        return result
@@ -0,0 +1,291 @@
+import argparse
+import json
+import logging
+import sys
+import uuid
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from .strtable import StringTable, write_atomically
+from .tracking import ExecTimer
+
+logging.basicConfig(stream=sys.stdout)
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# the per-corpus token frequency files produced by word-lapse-models,
+# relative to the data folder
+FREQUENCY_FILES = {
+    "pubtator": Path("all_pubtator_tok_frequency.tsv.xz"),
+    "preprints": Path("all_preprint_tok_frequency.tsv.xz"),
+}
+
+# the columnar copies of the files above, produced by FrequencyTable.save()
+# (e.g. via this module's command line interface), relative to the data folder
+COLUMNAR_FOLDERS = {
+    "pubtator": Path("all_pubtator_tok_frequency.cols"),
+    "preprints": Path("all_preprint_tok_frequency.cols"),
+}
+
+# the files that make up a columnar frequency table: the token table and one
+# .npy file per column, each named after the table's generation, and the
+# manifest that names the current generation
+TOKENS_FILE = "tokens.%s.strtab"
+COLUMN_FILE = "%s.%s.npy"
+COLUMNS = ("row_offsets", "year", "word_count", "normalized")
+MANIFEST_FILE = "manifest.json"
+
+
+class FrequencyTable:
+    """
+    Holds the token frequency table for a single corpus in a form that's
+    cheap to query, so we only pay for reading and decompressing the source
+    .tsv.xz file once per process rather than once per request.
+
+    Rows are sorted by token, then by year, and stored as parallel numpy
+    arrays. The normalized frequency (i.e., word_count divided by the total
+    word count for that year over the whole corpus) is computed once when the
+    table is built.
+
+    Each token maps to a contiguous range of rows, so looking up a token is a
+    binary search over the sorted token table followed by an array slice.
+
+    The table can be saved to and loaded from a folder containing the token
+    table and one .npy file per column. Loading memory-maps the files, so
+    there's no parsing cost and processes on the same machine share the pages.
+    Each save writes a new generation of the files and then switches the
+    folder's manifest over to it, so a reader never pairs the columns of one
+    save with the tokens of another.
+    """
+
+    def __init__(self, tokens: StringTable, row_offsets, year, word_count, normalized):
+        # 'tokens' is the sorted table of unique tokens; token i's rows are
+        # located in [row_offsets[i], row_offsets[i+1])
+        self.tokens = tokens
+        self.row_offsets = row_offsets
+        self.year = year
+        self.word_count = word_count
+        self.normalized = normalized
+
+    @classmethod
+    def from_tsv(cls, path):
+        """
+        Builds a FrequencyTable from a tab-delimited file with (at least) the
+        columns 'tok', 'year', and 'word_count'. The file may be compressed;
+        pandas infers the compression from the extension.
+        """
+        logger.info("Building frequency table from %s..." % path)
+
+        frame = pd.read_csv(
+            path,
+            sep="\t",
+            usecols=["tok", "year", "word_count"],
+            dtype={"tok": str, "year": np.int16, "word_count": np.int64},
+            # tokens like 'nan' and 'null' are real words, not missing values
+            keep_default_na=False,
+            na_filter=False,
+        )
+
+        # per-year totals over the entire corpus, broadcast back to each row
+        totals = frame.groupby("year")["word_count"].transform("sum")
+        frame["normalized"] = frame["word_count"] / totals
+
+        frame = frame.sort_values(["tok", "year"], kind="mergesort")
+
+        toks = frame["tok"].to_numpy()
+        # indices where a new token's run of rows begins
+        starts = np.flatnonzero(np.r_[True, toks[1:] != toks[:-1]])
+        row_offsets = np.r_[starts, len(toks)].astype(np.int64)
+
+        word_count = frame["word_count"].to_numpy()
+
+        if len(word_count) == 0 or word_count.max() <= np.iinfo(np.int32).max:
+            word_count = word_count.astype(np.int32)
+
+        table = cls(
+            tokens=StringTable.from_strings(toks[starts].tolist(), is_sorted=True),
+            row_offsets=row_offsets,
+            year=frame["year"].to_numpy(),
+            word_count=word_count,
+            normalized=frame["normalized"].to_numpy(),
+        )
+
+        logger.info("...done! %d rows over %d tokens" % (len(toks), len(table)))
+
+        return table
+
+    @classmethod
+    def load(cls, folder, use_mmap=True):
+        """
+        Loads a table previously written by save() from 'folder'. If
+        'use_mmap' is true, the columns are memory-mapped rather than read.
+
+        Raises a ValueError if the files don't make up a consistent table.
+        """
+        folder = Path(folder)
+
+        with open(folder / MANIFEST_FILE) as fp:
+            manifest = json.load(fp)
+
+        generation = manifest["generation"]
+        columns = {
+            name: np.load(
+                folder / (COLUMN_FILE % (name, generation)),
+                mmap_mode="r" if use_mmap else None,
+            )
+            for name in COLUMNS
+        }
+        tokens = StringTable.open(folder / (TOKENS_FILE % generation))
+        table = cls(tokens=tokens, **columns)
+
+        n_rows = int(table.row_offsets[-1]) if len(table.row_offsets) else 0
+
+        if (
+            len(table.tokens) != manifest["tokens"]
+            or len(table.row_offsets) != len(table.tokens) + 1
+            or any(len(getattr(table, name)) != n_rows for name in COLUMNS[1:])
+        ):
+            raise ValueError("The frequency table in %s is inconsistent" % folder)
+
+        return table
+
+    def save(self, folder):
+        """
+        Writes the table into 'folder' as a token table and a .npy file per
+        column, all named after a new generation, then points the folder's
+        manifest at that generation. The files of the generation it replaces
+        are kept, so a reader that read the old manifest just before the switch
+        can still open them, and those of any earlier ones are removed.
+        """
+        folder = Path(folder)
+        folder.mkdir(parents=True, exist_ok=True)
+        generation = uuid.uuid4().hex
+
+        for name in COLUMNS:
+            np.save(folder / (COLUMN_FILE % (name, generation)), getattr(self, name))
+
+        StringTable.write(
+            folder / (TOKENS_FILE % generation), self.tokens.keys(), is_sorted=True
+        )
+
+        try:
+            with open(folder / MANIFEST_FILE) as fp:
+                previous = json.load(fp)["generation"]
+        except FileNotFoundError:
+            previous = None
+
+        manifest = {"generation": generation, "tokens": len(self.tokens)}
+        write_atomically(folder / MANIFEST_FILE, json.dumps(manifest).encode("utf8"))
+
+        keep = set()
+        for gen in (generation, previous):
+            keep.add(TOKENS_FILE % gen)
+            keep.update(COLUMN_FILE % (name, gen) for name in COLUMNS)
+
+        for path in [*folder.glob("*.npy"), *folder.glob("*.strtab")]:
+            if path.name not in keep:
+                path.unlink()
+
+    def __contains__(self, tok):
+        return tok in self.tokens
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def total_counts(self):
+        """
+        Returns each token's word count summed over every year, as an int64
+        array in the same order as self.tokens.
+        """
+        if len(self.tokens) == 0:
+            return np.zeros(0, dtype=np.int64)
+
+        return np.add.reduceat(self.word_count.astype(np.int64), self.row_offsets[:-1])
+
+    def lookup(self, tok: str):
+        """
+        Returns the per-year frequencies for 'tok', ordered by year, as a list
+        of dicts of the form
+        {"year": <int>, "frequency": <int>, "normalized_frequency": <float>}.
+
+        Returns an empty list if 'tok' isn't in the table.
+        """
+        idx = self.tokens.find(tok)
+
+        if idx < 0:
+            return []
+
+        rows = slice(self.row_offsets[idx], self.row_offsets[idx + 1])
+
+        return [
+            {"year": year, "frequency": frequency, "normalized_frequency": normalized}
+            for year, frequency, normalized in zip(
+                self.year[rows].tolist(),
+                self.word_count[rows].tolist(),
+                self.normalized[rows].tolist(),
+            )
+        ]
+
+
+def has_columnar_table(folder):
+    """
+    Returns True if 'folder' holds a table written by FrequencyTable.save().
+    """
+    return (Path(folder) / MANIFEST_FILE).exists()
+
+
+def load_frequency_table(corpus: str, data_folder, use_columnar=True, write_columnar=True):
+    """
+    Loads the frequency table for 'corpus' from 'data_folder'.
+
+    If 'use_columnar' is true and a columnar copy of the table exists, it's
+    memory-mapped. Otherwise, the table is built from the .tsv.xz file and,
+    if 'write_columnar' is true, a columnar copy is written for next time.
+
+    Raises a KeyError if 'corpus' isn't a known corpus.
+    """
+    data_folder = Path(data_folder)
+    columnar_folder = data_folder / COLUMNAR_FOLDERS[corpus]
+
+    if use_columnar and has_columnar_table(columnar_folder):
+        logger.info("Loading columnar frequency table from %s..." % columnar_folder)
+        return FrequencyTable.load(columnar_folder)
+
+    table = FrequencyTable.from_tsv(data_folder / FREQUENCY_FILES[corpus])
+
+    if write_columnar:
+        logger.info(" - writing columnar copy to %s..." % columnar_folder)
+        table.save(columnar_folder)
+
+    return table
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=(
+            "Converts the per-corpus token frequency .tsv.xz files into the"
+            " memory-mappable columnar format read by FrequencyTable.load()."
+        )
+    )
+    parser.add_argument(
+        "corpora",
+        nargs="*",
+        default=list(FREQUENCY_FILES.keys()),
+        help="corpora to convert (default: all of %s)" % list(FREQUENCY_FILES.keys()),
+    )
+    parser.add_argument(
+        "--data-folder", default="./data", help="the data folder (default: ./data)"
+    )
+    args = parser.parse_args()
+
+    for corpus in args.corpora:
+        with ExecTimer(verbose=True):
+            print("Converting '%s'..." % corpus, flush=True)
+            load_frequency_table(corpus, args.data_folder, use_columnar=False)
+            print("...done!", flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,536 @@
+import asyncio
+import json
+import logging
+import sys
+import zlib
+from functools import wraps
+
+from rq import Queue, get_current_job
+from rq.job import Job
+from rq.worker_registration import REDIS_WORKER_KEYS
+
+from .config import CORPORA_SET
+
+logging.basicConfig(stream=sys.stdout)
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# workers publish each job's outcome to a channel with this prefix followed by
+# the job id, e.g. "wl:job_events:get_neighbors__pubtator_mouse"
+JOB_EVENTS_PREFIX = "wl:job_events:"
+
+# while computing (part of) a /neighbors response, jobs append its parts to a
+# redis stream with this prefix followed by the job id as they become available
+PARTIALS_PREFIX = "wl:partial:"
+
+# how long a stream of partial results is kept after its last update
+PARTIALS_EXPIRE_SECS = 5 * 60
+
+# ...and after its job is done, which matches how long rq keeps the job, since
+# a new job with the same id would otherwise find the old one's events
+PARTIALS_DONE_EXPIRE_SECS = 10
+
+# the queue that workers with all the models take jobs from. jobs that only
+# need some of the models are routed to a queue named after them instead, if a
+# worker takes jobs from it; see queue_name() and route_queue_name()
+QUEUE_NAME = "w2v_queries"
+
+
+def partials_key(job_id: str):
+    return f"{PARTIALS_PREFIX}{job_id}"
+
+
+def queue_name(corpus=None, shard=None):
+    """
+    Returns the name of the queue for jobs that only need the models for
+    'corpus' and/or the years 'shard' (see config.YEAR_SHARDS).
+
+    >>> queue_name()
+    'w2v_queries'
+    >>> queue_name("pubtator")
+    'w2v_queries:pubtator'
+    >>> queue_name("pubtator", "2000-2007")
+    'w2v_queries:pubtator:2000-2007'
+    >>> queue_name(shard="2000-2007")
+    'w2v_queries:2000-2007'
+    """
+    return ":".join([QUEUE_NAME] + [part for part in (corpus, shard) if part])
+
+
+def worker_queue_names(corpora=None, shard=None):
+    """
+    Returns the names of the queues that a worker with the models for
+    'corpora' (all of them if None) and the years 'shard' (all of them if
+    None) takes jobs from, which is how workers advertise the models they
+    hold to the API.
+
+    >>> worker_queue_names(["preprints"])
+    ['w2v_queries:preprints']
+    >>> worker_queue_names(shard="2000-2007")
+    ['w2v_queries:pubtator:2000-2007', 'w2v_queries:preprints:2000-2007', 'w2v_queries:2000-2007']
+    >>> worker_queue_names()
+    ['w2v_queries:pubtator', 'w2v_queries:preprints', 'w2v_queries']
+    """
+    names = [queue_name(corpus, shard) for corpus in (corpora or CORPORA_SET)]
+
+    if not corpora:
+        names.append(queue_name(shard=shard))
+
+    return names
+
+
+def route_queue_name(available, corpus=None, shard=None):
+    """
+    Returns the name of the queue to send a job that needs the models for
+    'corpus' and/or the years 'shard' to, given the names of the queues that
+    workers are taking jobs from, 'available'. The queue of the workers with
+    the fewest models that can run the job is chosen, falling back to
+    QUEUE_NAME if none of them are available.
+
+    >>> route_queue_name({"w2v_queries", "w2v_queries:preprints"}, "preprints")
+    'w2v_queries:preprints'
+    >>> route_queue_name({"w2v_queries:pubtator:2000-2007"}, "pubtator", "2000-2007")
+    'w2v_queries:pubtator:2000-2007'
+    >>> route_queue_name({"w2v_queries:pubtator"}, "pubtator", "2000-2007")
+    'w2v_queries:pubtator'
+    >>> route_queue_name(set(), "pubtator")
+    'w2v_queries'
+    """
+    candidates = [
+        queue_name(corpus, shard),
+        queue_name(shard=shard),
+        queue_name(corpus),
+    ]
+
+    return next((name for name in candidates if name in available), QUEUE_NAME)
+
+
+def partial_events(result):
+    """
+    Splits a /neighbors response into the sequence of events a worker
+    publishes while computing it (see PartialResults), e.g. to replay a cached
+    response as a stream:
+    - {"type": "frequency", "frequency": [...], "changepoints": [...]}
+    - {"type": "neighbors", "year": <year>, "neighbors": [...]}, once per year
+    - {"type": "done", "elapsed": <elapsed_ms>}
+
+    A failed computation ends with {"type": "error", "detail": <message>}
+    instead. The result of a shard job (see w2v_worker.get_neighbors_shard())
+    only has a 'frequency' event if it includes the frequencies.
+    """
+    if "frequency" in result:
+        yield {
+            "type": "frequency",
+            "frequency": result["frequency"],
+            "changepoints": result["changepoints"],
+        }
+
+    for year, neighbors in result["neighbors"].items():
+        yield {"type": "neighbors", "year": year, "neighbors": neighbors}
+
+    yield {"type": "done", "elapsed": result.get("elapsed")}
+
+
+def merge_shard_results(results, elapsed):
+    """
+    Combines the results of the shard jobs for a /neighbors request (see
+    w2v_worker.get_neighbors_shard()) into the /neighbors response, with
+    'elapsed' as the time taken for all of them.
+    """
+    merged = {"neighbors": {}}
+
+    for result in results:
+        merged["neighbors"].update(result["neighbors"])
+
+        if "frequency" in result:
+            merged["frequency"] = result["frequency"]
+            merged["changepoints"] = result["changepoints"]
+
+    merged["neighbors"] = dict(sorted(merged["neighbors"].items()))
+    merged["elapsed"] = elapsed
+
+    return merged
+
+
+# ========================================================================
+# === worker side
+# ========================================================================
+
+
+def publish_job_event(r, job_id, status):
+    """
+    Announces that the job 'job_id' has finished ('status' is 'finished') or
+    failed ('status' is 'failed').
+
+    The event doesn't include the job's result or traceback, since it's
+    delivered to every API process and a result can be several MB (e.g. for
+    a batch job); the waiting process reads them from the job instead (see
+    fetch_job_state()).
+    """
+    r.publish(
+        JOB_EVENTS_PREFIX + job_id,
+        json.dumps({"job_id": job_id, "status": status}),
+    )
+
+
+def notify_on_completion(func):
+    """
+    Decorates a job function so that, when it's run by an rq worker, its
+    outcome is published via publish_job_event(). This lets the API respond as
+    soon as the job is done rather than polling the job's status.
+
+    Note that the event is published just before rq saves the job's result,
+    so the API may have to check the job's status a few more times before
+    the result is there.
+    """
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        job = get_current_job()
+
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            if job is not None:
+                publish_job_event(job.connection, job.id, "failed")
+            raise
+
+        if job is not None:
+            publish_job_event(job.connection, job.id, "finished")
+
+        return result
+
+    return wrapper
+
+
+class PartialResults:
+    """
+    Publishes the parts of the /neighbors response computed by the job
+    'job_id' to the job's stream (see partials_key()) as they're computed,
+    using the (non-async) redis connection 'r'. Each stream entry has a single
+    'event' field holding one of the JSON-encoded events listed in
+    partial_events().
+
+    If 'job_id' is None (i.e., the job function isn't being run by rq),
+    nothing is published.
+    """
+
+    def __init__(self, r, job_id):
+        self.r = r
+        self.key = partials_key(job_id) if job_id is not None else None
+        self.started = False
+
+    def publish(self, event):
+        if self.key is None:
+            return
+
+        with self.r.pipeline(transaction=False) as pipe:
+            # start a fresh stream, rather than appending to an earlier one's
+            if not self.started:
+                pipe.delete(self.key)
+                self.started = True
+
+            pipe.xadd(self.key, {"event": json.dumps(event)})
+            pipe.expire(
+                self.key,
+                PARTIALS_DONE_EXPIRE_SECS
+                if event["type"] in ("done", "error")
+                else PARTIALS_EXPIRE_SECS,
+            )
+            pipe.execute()
+
+
+# ========================================================================
+# === API side
+# ========================================================================
+
+
+async def read_partials(client, positions, block_ms=1000):
+    """
+    Returns the events (see partial_events()) published by the jobs in
+    'positions', a dict mapping each job id to the id of the last entry read
+    from its partial results stream (initially "0-0"), waiting up to
+    'block_ms' for some to be published. 'client' is an async redis client.
+
+    Returns a list of (job id, event) pairs, which is empty if nothing was
+    published in time, and updates 'positions' to follow on from them.
+    """
+    entries = await client.xread(
+        {partials_key(job_id): last_id for job_id, last_id in positions.items()},
+        block=block_ms,
+        count=100,
+    )
+    events = []
+
+    for key, messages in entries:
+        job_id = key.decode("utf8")[len(PARTIALS_PREFIX) :]
+
+        for entry_id, fields in messages:
+            positions[job_id] = entry_id
+            events.append((job_id, json.loads(fields[b"event"])))
+
+    return events
+
+
+async def fetch_worker_queues(client):
+    """
+    Returns a dict mapping the name of each queue that a live rq worker is
+    taking jobs from to the number of workers taking jobs from it. 'client' is
+    an async redis client.
+
+    Reads the queue names each worker registers (in the 'queues' field of its
+    hash) in a single round trip after listing the workers, rather than
+    fetching each worker with rq's Worker.all().
+    """
+    worker_keys = await client.smembers(REDIS_WORKER_KEYS)
+
+    async with client.pipeline(transaction=False) as pipe:
+        for worker_key in worker_keys:
+            pipe.hget(worker_key, "queues")
+        worker_queues = await pipe.execute()
+
+    counts = {}
+
+    # workers that died without unregistering have no hash
+    for queues in filter(None, worker_queues):
+        for name in queues.decode("utf8").split(","):
+            counts[name] = counts.get(name, 0) + 1
+
+    return counts
+
+
+async def fetch_queue_lengths(client, names):
+    """
+    Returns a dict mapping each of the queue names in 'names' to the number of
+    jobs waiting in that queue. 'client' is an async redis client.
+    """
+    async with client.pipeline(transaction=False) as pipe:
+        for name in names:
+            pipe.llen(Queue.redis_queue_namespace_prefix + name)
+        lengths = await pipe.execute()
+
+    return dict(zip(names, lengths))
+
+
+async def fetch_job_state(client, job_id, serializer):
+    """
+    Reads the status of the rq job 'job_id' with 'client', an async redis
+    client, along with its result if it's finished or its traceback if it
+    failed. 'serializer' is the serializer of the job's queue.
+
+    Returns a tuple of (status, result, exc_info), where status is None if
+    the job doesn't exist. This is a single round trip, compared to the
+    several that fetching the job with rq's Job.fetch() makes.
+    """
+    status, result, exc_info = await client.hmget(
+        Job.key_for(job_id), "status", "result", "exc_info"
+    )
+
+    if status is None:
+        return None, None, None
+
+    status = status.decode("utf8")
+    result = serializer.loads(result) if status == "finished" and result else None
+
+    if exc_info:
+        # rq compresses tracebacks, but older jobs may not be
+        try:
+            exc_info = zlib.decompress(exc_info)
+        except zlib.error:
+            pass
+        exc_info = exc_info.decode("utf8", errors="replace")
+
+    return status, result, exc_info
+
+
+class JobNotifier:
+    """
+    Delivers the events published by notify_on_completion() to coroutines
+    waiting on them, using a single pub/sub subscription per process no matter
+    how many requests are waiting.
+
+    'client' is an async redis client, e.g. redis.asyncio.Redis.
+
+    Usage:
+    ```
+    future = notifier.subscribe(job_id)
+    try:
+        event = await future
+    finally:
+        notifier.unsubscribe(job_id, future)
+    ```
+    """
+
+    def __init__(self, client):
+        self.client = client
+        # job id => set of futures waiting on that job
+        self.waiters = {}
+        self.task = None
+
+    async def start(self):
+        self.task = asyncio.create_task(self.listen())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+
+    async def listen(self):
+        while True:
+            pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+
+            try:
+                await pubsub.psubscribe(JOB_EVENTS_PREFIX + "*")
+
+                async for message in pubsub.listen():
+                    self.dispatch(message)
+
+            except asyncio.CancelledError:
+                raise
+            except Exception as ex:
+                # requests that are waiting will fall back to checking the job
+                # status until we're resubscribed
+                logger.warning("Job event subscription failed (%s), retrying..." % ex)
+                await asyncio.sleep(1)
+            finally:
+                # returns the subscription's connection to the pool
+                await pubsub.reset()
+
+    def dispatch(self, message):
+        channel = message["channel"]
+        channel = channel.decode("utf8") if isinstance(channel, bytes) else channel
+        job_id = channel[len(JOB_EVENTS_PREFIX) :]
+
+        # skip decoding events for jobs no one in this process is waiting on
+        futures = self.waiters.get(job_id)
+
+        if not futures:
+            return
+
+        event = json.loads(message["data"])
+
+        for future in futures:
+            if not future.done():
+                future.set_result(event)
+
+    def subscribe(self, job_id):
+        """
+        Returns a future that resolves to the event published for 'job_id'.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.setdefault(job_id, set()).add(future)
+        return future
+
+    def unsubscribe(self, job_id, future):
+        futures = self.waiters.get(job_id, set())
+        futures.discard(future)
+
+        if not futures:
+            self.waiters.pop(job_id, None)
+
+
+class PartialsReader:
+    """
+    Delivers the events published by PartialResults to the coroutines
+    following them, reading every stream that's being followed in this process
+    with a single blocking XREAD at a time.
+
+    'client' is an async redis client, e.g. redis.asyncio.Redis, that's only
+    used by this reader: each XREAD holds a connection for up to 'block_ms',
+    which would otherwise starve the pool that requests share.
+
+    Each follower gets an asyncio.Queue of (job id, event) pairs, starting
+    from the first event each job published, even if another follower was
+    already following the job.
+
+    Usage:
+    ```
+    events = reader.follow(job_ids)
+    try:
+        job_id, event = await events.get()
+    finally:
+        reader.unfollow(job_ids, events)
+    ```
+    """
+
+    def __init__(self, client, block_ms=100):
+        self.client = client
+        self.block_ms = block_ms
+        # job id => id of the last entry read from its stream
+        self.positions = {}
+        # job id => the events read from its stream so far
+        self.history = {}
+        # job id => set of queues following that job
+        self.followers = {}
+        # set when there's something to follow
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+    async def start(self):
+        self.task = asyncio.create_task(self.listen())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+
+    async def listen(self):
+        while True:
+            if not self.positions:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+
+            positions = dict(self.positions)
+
+            try:
+                events = await read_partials(self.client, positions, self.block_ms)
+            except asyncio.CancelledError:
+                raise
+            except Exception as ex:
+                # followers fall back to checking the jobs' status until we
+                # can read again
+                logger.warning("Reading partial results failed (%s), retrying..." % ex)
+                await asyncio.sleep(1)
+                continue
+
+            for job_id, event in events:
+                # skip jobs that were unfollowed while we were reading
+                if job_id not in self.positions:
+                    continue
+
+                self.positions[job_id] = positions[job_id]
+                self.history[job_id].append(event)
+
+                for events_queue in self.followers[job_id]:
+                    events_queue.put_nowait((job_id, event))
+
+    def follow(self, job_ids):
+        """
+        Returns a queue that receives the events published by the jobs
+        'job_ids'.
+        """
+        events_queue = asyncio.Queue()
+
+        for job_id in job_ids:
+            if job_id not in self.positions:
+                self.positions[job_id] = "0-0"
+                self.history[job_id] = []
+                self.followers[job_id] = set()
+
+            for event in self.history[job_id]:
+                events_queue.put_nowait((job_id, event))
+
+            self.followers[job_id].add(events_queue)
+
+        self.wakeup.set()
+
+        return events_queue
+
+    def unfollow(self, job_ids, events_queue):
+        for job_id in job_ids:
+            followers = self.followers.get(job_id, set())
+            followers.discard(events_queue)
+
+            if not followers:
+                self.positions.pop(job_id, None)
+                self.history.pop(job_id, None)
+                self.followers.pop(job_id, None)
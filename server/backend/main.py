@@ -1,23 +1,64 @@
 import asyncio
+import hashlib
+import json
 import logging
 import os
-import pickle
-import re
+import time
 from functools import wraps
-from itertools import islice
+from typing import List
 
 import redis
-from fastapi import FastAPI, HTTPException, Request
-from fastapi_redis_cache import FastApiRedisCache, cache
-from fastapi_utils.tasks import repeat_every
-from pygtrie import CharTrie
+import redis.asyncio
+from fastapi import FastAPI, HTTPException, Request, Response
+from pydantic import BaseModel
 from rq import Queue, Worker
-from rq.exceptions import NoSuchJobError
 from rq.job import Job
+from rq.worker_registration import REDIS_WORKER_KEYS
+from starlette.concurrency import run_in_threadpool
 from starlette.middleware.cors import CORSMiddleware
-
-from .config import CORPORA_SET, DEBUG, LOG_LEVEL, get_config_values
-from .neighbors import get_concept_trie
+from starlette.responses import StreamingResponse
+
+from .autocomplete import AutocompleteIndex, load_autocomplete_index
+from .cache import (
+    AccessRecorder,
+    EntryCountKeeper,
+    LocalResponseCache,
+    NeighborsCache,
+    cache_headers,
+    decode_response,
+    encode_response,
+    etag_for,
+    request_is_not_cacheable,
+    requested_resource_not_modified,
+    response_json,
+    result_json,
+)
+from .config import (
+    CORPORA_SET,
+    DEBUG,
+    HTTP_CACHE_MAX_AGE_SECS,
+    JOB_STATUS_POLL_SECS,
+    LOCAL_CACHE_MAX_BYTES,
+    LOCAL_CACHE_TTL_SECS,
+    LOG_LEVEL,
+    MAX_BATCH_SIZE,
+    REDIS_POOL_SIZE,
+    WORKER_QUEUES_TTL_SECS,
+    YEAR_SHARDS,
+    get_config_values,
+    parse_years,
+)
+from .jobs import (
+    QUEUE_NAME,
+    JobNotifier,
+    PartialsReader,
+    fetch_job_state,
+    fetch_queue_lengths,
+    fetch_worker_queues,
+    merge_shard_results,
+    partial_events,
+    route_queue_name,
+)
 from .tracking import ExecTimer
 
 logging.basicConfig()
@@ -29,14 +70,37 @@ elif LOG_LEVEL:
 
 app = FastAPI()
 
-# populated in init_redis_cache(), used in neighbors_is_cached
-redis_cache: FastApiRedisCache = None
+# async redis client shared by all requests; populated in init_redis()
+redis_client: redis.asyncio.Redis = None
+# reads and writes cached /neighbors responses with redis_client; populated in
+# init_redis(), used in cache_response() and the /neighbors endpoints
+response_cache: NeighborsCache = None
+# holds the most recently used /neighbors responses in this process' memory;
+# used in cache_response()
+local_cache = LocalResponseCache(LOCAL_CACHE_MAX_BYTES, LOCAL_CACHE_TTL_SECS)
+# batches up the per-token request counts for /neighbors/cache; populated in
+# init_access_recorder(), used in cache_response() and stream_neighbors()
+access_recorder: AccessRecorder = None
+# keeps the cached entry counts reported by server_meta() up to date; populated
+# in init_entry_count_keeper()
+entry_count_keeper: EntryCountKeeper = None
 # populated in init_rq(), used in neighbors()
 queue: Queue = None
-# trie of vocab words; populated in init_autocomplete_trie, used in autocomplete()
-vocab_trie: CharTrie = None
-# trie of concept labels to IDs; populated in init_autocomplete_trie, used in autocomplete()
-concept_trie: CharTrie = None
+# the Queue for each queue name that jobs have been routed to, including
+# 'queue'; used in routed_queue()
+queues_by_name = {}
+# the queues that workers are taking jobs from, i.e. the result of
+# jobs.fetch_worker_queues(), and when it was read; used in worker_queues()
+worker_queue_counts = ({}, 0.0)
+# delivers job completion events; populated in init_job_notifier(), used in
+# wait_on_job()
+job_notifier: JobNotifier = None
+# delivers the partial results of /neighbors jobs; populated in
+# init_partials_reader(), used in follow_partials()
+partials_reader: PartialsReader = None
+# prefix index of vocab words and concept labels; populated in
+# init_autocomplete_index(), used in autocomplete()
+autocomplete_index: AutocompleteIndex = None
 
 
 # lists all origins that are allowed to hit the API
@@ -74,64 +138,111 @@ app.add_middleware(
 
 
 @app.on_event("startup")
-async def init_redis_cache():
-    # initializes redis_cache, a FastAPI-compatible cache decorator.
-    # the cached entries are persisted in redis, a fast in-memory store with
-    # occasional disk persistence.
-    global redis_cache
-    redis_cache = FastApiRedisCache()
-    redis_cache.init(host_url=os.environ.get("REDIS_URL"), prefix="wlc")
+async def init_redis():
+    # creates the async redis client that all requests share, which holds at
+    # most REDIS_POOL_SIZE connections. redis persists the cached responses,
+    # the job queue, etc.
+    global redis_client, response_cache
+    redis_client = redis.asyncio.Redis(
+        connection_pool=redis.asyncio.BlockingConnectionPool.from_url(
+            os.environ.get("REDIS_URL"), max_connections=REDIS_POOL_SIZE
+        )
+    )
+    response_cache = NeighborsCache(redis_client)
 
 
 @app.on_event("startup")
 async def init_rq():
     # initialize rq, the redis queue.
-    # moves expensive tasks to a separate process where they won't block the API
+    # moves expensive tasks to a separate process where they won't block the API.
+    # rq's API isn't async, so its calls are run in a thread (see
+    # enqueue_and_wait()) with their own pool of connections
     global queue
-    r = redis.from_url(os.environ.get("REDIS_URL"))
-    queue = Queue("w2v_queries", connection=r)
+    r = redis.Redis(
+        connection_pool=redis.BlockingConnectionPool.from_url(
+            os.environ.get("REDIS_URL"), max_connections=REDIS_POOL_SIZE
+        )
+    )
+    queue = queues_by_name[QUEUE_NAME] = Queue(QUEUE_NAME, connection=r)
+
 
 @app.on_event("startup")
-@repeat_every(seconds=60 * 5)  # 5 minutes
-def count_cached_entries() -> None:
-    r = redis.from_url(os.environ.get("REDIS_URL"))
-    r.set(
-        'meta:cached_entry_count',
-        sum(1 for _ in r.scan_iter('wlc:*'))
+async def init_job_notifier():
+    # subscribes to the events workers publish when jobs finish, so requests
+    # waiting on jobs are notified right away instead of polling
+    global job_notifier
+    job_notifier = JobNotifier(redis_client)
+    await job_notifier.start()
+
+
+@app.on_event("shutdown")
+async def stop_job_notifier():
+    await job_notifier.stop()
+
+
+@app.on_event("startup")
+async def init_partials_reader():
+    # follows the partial results of the jobs that /neighbors/stream requests
+    # are waiting on. it blocks on its own connection rather than taking one
+    # from redis_client's pool, which requests share
+    global partials_reader
+    partials_reader = PartialsReader(
+        redis.asyncio.Redis.from_url(os.environ.get("REDIS_URL"))
     )
+    await partials_reader.start()
+
+
+@app.on_event("shutdown")
+async def stop_partials_reader():
+    await partials_reader.stop()
+    await partials_reader.client.close()
+    await partials_reader.client.connection_pool.disconnect()
+
+
+@app.on_event("startup")
+async def init_access_recorder():
+    global access_recorder
+    access_recorder = AccessRecorder(redis_client)
+    await access_recorder.start()
+
+
+@app.on_event("shutdown")
+async def stop_access_recorder():
+    await access_recorder.stop()
+
 
 @app.on_event("startup")
-def init_autocomplete_trie():
-    global vocab_trie, concept_trie
+async def init_entry_count_keeper():
+    # the counts are incremented as entries are cached; one of the API
+    # processes is elected to decrement them as entries are evicted or expire
+    global entry_count_keeper
+    entry_count_keeper = EntryCountKeeper(redis_client)
+    await entry_count_keeper.start()
+
 
-    # step 1: load autocomplete map from full_vocab.txt
+@app.on_event("shutdown")
+async def stop_entry_count_keeper():
+    await entry_count_keeper.stop()
+
+
+@app.on_event("shutdown")
+async def close_redis():
+    await redis_client.close()
+    await redis_client.connection_pool.disconnect()
+    queue.connection.connection_pool.disconnect()
+
+
+@app.on_event("startup")
+def init_autocomplete_index():
+    global autocomplete_index
+
+    # maps the prefix index of full_vocab.txt and the concept labels, which is
+    # shared by all the API processes; it's built here if it doesn't exist yet
     # (full_vocab.txt is generated by word-lapse-models' merged_vocab.py script)
     with ExecTimer(verbose=True):
-        logger.info("Starting vocab trie load...")
-
-        vocab_trie_pickle = "./data/vocab_trie.pkl"
-
-        if os.path.exists(vocab_trie_pickle):
-            logger.info("...found vocab trie pickle, loading...")
-            with open(vocab_trie_pickle, "rb") as pickle_fp:
-                vocab_trie = pickle.load(pickle_fp)
-        else:
-            logger.info("...no pickle found, generating...")
-            with open("./data/full_vocab.txt", "r") as fp:
-                vocab_trie = CharTrie()
-                for line in fp:
-                    vocab_trie[line] = True
-
-                logger.info(" - writing pickle...")
-                with open(vocab_trie_pickle, "wb") as pickle_fp:
-                    pickle.dump(vocab_trie, pickle_fp)
-                logger.info(" - ...pickling done!")
-        
-        logger.info("...trie loading done!")
-
-    # step 2. load autocomplete concept labels -> ID map
-    with ExecTimer(verbose=True):
-        concept_trie = get_concept_trie()
+        logger.info("Starting autocomplete index load...")
+        autocomplete_index = load_autocomplete_index("./data")
+        logger.info("...autocomplete index loading done!")
 
 
 # ========================================================================
@@ -139,23 +250,62 @@ def init_autocomplete_trie():
 # ========================================================================
 
 
-async def wait_on_job(job):
+# how soon to check for a job's result after it's announced as done (doubling
+# on each check, up to JOB_STATUS_POLL_SECS)
+JOB_RESULT_POLL_SECS = 0.01
+
+
+async def wait_on_job(job_id):
     """
-    Polls 'job' until it's done, then returns its result if successful.
+    Waits until the job 'job_id' is done, then returns its result if successful.
+
+    Workers announce when a job is done (see jobs.notify_on_completion()),
+    which job_notifier delivers here as soon as it happens; the job's result
+    is then read from the job itself. In case that announcement is missed
+    (e.g., if the job finished before we started waiting, or the worker was
+    killed), the job's status is also checked when we start waiting and every
+    JOB_STATUS_POLL_SECS after that.
 
     If unsuccessful, throws an HTTPException 500 with details about the job
     exception included in the details.
     """
+    event = job_notifier.subscribe(job_id)
+    poll_secs = JOB_STATUS_POLL_SECS
+
     try:
-        while not job.is_finished:
-            await asyncio.sleep(1)
-            if job.get_status(refresh=True) == "failed":
-                raise Exception("job failed!", job.exc_info)
+        while True:
+            status, result, exc_info = await fetch_job_state(
+                redis_client, job_id, queue.serializer
+            )
+
+            if status == "finished":
+                return result
+            if status == "failed":
+                raise Exception("job failed!", exc_info)
+            if status is None:
+                raise Exception("job %s no longer exists!" % job_id)
+
+            if event.done():
+                # the worker announces the job just before rq saves its
+                # result, so check back shortly until it's there
+                await asyncio.sleep(poll_secs)
+                poll_secs = min(poll_secs * 2, JOB_STATUS_POLL_SECS)
+                continue
+
+            try:
+                # shield the future so the timeout doesn't cancel it
+                await asyncio.wait_for(
+                    asyncio.shield(event), timeout=JOB_STATUS_POLL_SECS
+                )
+                poll_secs = JOB_RESULT_POLL_SECS
+            except asyncio.TimeoutError:
+                continue
 
-        return job.result
     except Exception as ex:
         print(ex)
         raise HTTPException(status_code=500, detail="Job process exception: %s" % ex)
+    finally:
+        job_notifier.unsubscribe(job_id, event)
 
 
 async def enqueue_and_wait(func, *args, **kwargs):
@@ -163,7 +313,228 @@ async def enqueue_and_wait(func, *args, **kwargs):
     Helper method to pass 'func' with any extra args to the w2v_queries queue.
     """
 
-    return await wait_on_job(queue.enqueue(func, *args, **kwargs))
+    job = await run_in_threadpool(queue.enqueue, func, *args, **kwargs)
+
+    return await wait_on_job(job.id)
+
+
+async def enqueue_unique(func, job_id, *args, target_queue=None, **kwargs):
+    """
+    Passes 'func' with any extra args to the w2v_queries queue (or
+    'target_queue', if given) as a job with the id 'job_id', unless a job with
+    that id already exists (e.g., because another request for the same thing
+    is being processed) and hasn't failed. Returns 'job_id'.
+    """
+    # check for an existing job
+    status = await redis_client.hget(Job.key_for(job_id), "status")
+
+    if status is not None:
+        logger.info("Found existing job! %s" % job_id)
+
+        if status != b"failed":
+            return job_id
+
+        logger.info("..but job %s has staus failed" % job_id)
+
+    logger.info("Creating new job %s" % job_id)
+
+    # create and fire off a new job
+    await run_in_threadpool(
+        (target_queue or queue).enqueue, func, *args, job_id=job_id, **kwargs
+    )
+
+    return job_id
+
+
+async def enqueue_unique_and_wait(func, job_id, *args, **kwargs):
+    """
+    Like enqueue_and_wait(), but gives the job the id 'job_id'. If a job with
+    that id already exists, waits on that job rather than creating a new one;
+    see enqueue_unique().
+    """
+    return await wait_on_job(await enqueue_unique(func, job_id, *args, **kwargs))
+
+
+async def worker_queues():
+    """
+    Returns a dict mapping the name of each queue that workers are taking
+    jobs from to the number of workers taking jobs from it (see
+    jobs.fetch_worker_queues()), reading it again at most every
+    WORKER_QUEUES_TTL_SECS.
+    """
+    global worker_queue_counts
+
+    counts, read_at = worker_queue_counts
+
+    if time.monotonic() - read_at > WORKER_QUEUES_TTL_SECS:
+        counts = await fetch_worker_queues(redis_client)
+        worker_queue_counts = (counts, time.monotonic())
+
+    return counts
+
+
+async def routed_queue(corpus, shard=None):
+    """
+    Returns the Queue to send a job that needs the models for 'corpus' (and
+    just the years 'shard', if given) to, i.e. the queue of the workers with
+    the fewest models that can run it (see jobs.route_queue_name()).
+    """
+    name = route_queue_name(await worker_queues(), corpus, shard)
+
+    if name not in queues_by_name:
+        queues_by_name[name] = Queue(name, connection=queue.connection)
+
+    return queues_by_name[name]
+
+
+def neighbors_job_id(tok, corpus, shard=None):
+    """
+    Returns the id of the job that computes the /neighbors response for 'tok'
+    in 'corpus' (or just the shard of it for the years 'shard', if given),
+    which concurrent requests for it share.
+    """
+    if shard is not None:
+        return f"get_neighbors__{corpus}_{tok}__{shard}"
+
+    return f"get_neighbors__{corpus}_{tok}"
+
+
+async def enqueue_neighbors(tok, corpus):
+    """
+    Starts computing the /neighbors response for 'tok' in 'corpus', unless
+    it's already being computed. Returns the ids of the jobs that compute it,
+    which is a single job unless YEAR_SHARDS is set, in which case it's one job
+    per shard (see get_neighbors_sharded()).
+    """
+    from .w2v_worker import get_neighbors, get_neighbors_shard
+
+    if not YEAR_SHARDS:
+        return [
+            await enqueue_unique(
+                get_neighbors,
+                neighbors_job_id(tok, corpus),
+                tok=tok,
+                corpus=corpus,
+                target_queue=await routed_queue(corpus),
+                job_timeout=1200,
+                result_ttl=10,
+                failure_ttl=10,
+            )
+        ]
+
+    return await asyncio.gather(
+        *(
+            enqueue_unique(
+                get_neighbors_shard,
+                neighbors_job_id(tok, corpus, shard),
+                tok=tok,
+                corpus=corpus,
+                years=sorted(parse_years(shard)),
+                # the first shard also looks up the frequencies
+                with_frequency=(i == 0),
+                target_queue=await routed_queue(corpus, shard),
+                job_timeout=1200,
+                result_ttl=10,
+                failure_ttl=10,
+            )
+            for i, shard in enumerate(YEAR_SHARDS)
+        )
+    )
+
+
+async def get_neighbors_sharded(tok, corpus):
+    """
+    Produces the /neighbors response for 'tok' in 'corpus' when YEAR_SHARDS is
+    set, by running a job for each shard of the years in parallel, each on the
+    workers that hold that shard's year models, and merging their results.
+    """
+    with ExecTimer() as timer:
+        results = await asyncio.gather(
+            *(wait_on_job(job_id) for job_id in await enqueue_neighbors(tok, corpus))
+        )
+
+    return merge_shard_results(results, timer.snapshot())
+
+
+async def follow_partials(job_ids):
+    """
+    Generates (job id, event) pairs for the events the jobs 'job_ids' publish
+    as they compute their parts of a /neighbors response (see
+    jobs.PartialResults), until each of them has published a 'done' or
+    'error' event.
+
+    If a job goes away without publishing its last event, an 'error' event is
+    generated for it.
+    """
+    pending = set(job_ids)
+    events = partials_reader.follow(job_ids)
+
+    try:
+        while pending:
+            try:
+                job_id, event = await asyncio.wait_for(events.get(), timeout=1)
+            except asyncio.TimeoutError:
+                pass
+            else:
+                if job_id not in pending:
+                    continue
+
+                if event["type"] in ("done", "error"):
+                    pending.discard(job_id)
+
+                yield job_id, event
+                continue
+
+            # make sure the jobs are still around to publish something
+            for job_id in list(pending):
+                status, result, exc_info = await fetch_job_state(
+                    redis_client, job_id, queue.serializer
+                )
+
+                if status == "finished" and result is not None:
+                    # the job finished without publishing (e.g., it was
+                    # already running on a worker that predates streaming)
+                    pending.discard(job_id)
+
+                    for event in partial_events(result):
+                        yield job_id, event
+
+                elif status in (None, "failed", "stopped", "canceled"):
+                    pending.discard(job_id)
+
+                    yield job_id, {
+                        "type": "error",
+                        "detail": "Job process exception: %s" % exc_info,
+                    }
+    finally:
+        partials_reader.unfollow(job_ids, events)
+
+
+def corpus_id_for(corpus):
+    """
+    Returns the corpus id for 'corpus' if it's one of the labels in
+    CORPORA_SET, or 'corpus' unchanged otherwise.
+    """
+    if corpus and corpus in CORPORA_SET.values():
+        return next(
+            (id for id, label in CORPORA_SET.items() if label == corpus), None
+        )
+
+    return corpus
+
+
+def validate_corpus(corpus):
+    """
+    Raises an HTTPException 400 if 'corpus' isn't a corpus id in CORPORA_SET.
+    """
+    corpora_ids = list(CORPORA_SET.keys())
+
+    if corpus not in corpora_ids:
+        logger.info("Corpus %s requested, but not found in %s" % (corpus, corpora_ids))
+        raise HTTPException(
+            status_code=400,
+            detail="Requested corpus '%s' not in corpus set %s" % (corpus, corpora_ids),
+        )
 
 
 def lowercase_field(target_field="tok"):
@@ -183,23 +554,127 @@ def map_corpus_label(target_field="corpus"):
         @wraps(func)
         async def anon(*args, **kwargs):
             if target_field in kwargs:
-                input_label = kwargs[target_field]
-
                 # check if the specified corpus is a label in CORPORA_SET, not an id.
                 # if it's there, replace the target field with the corpus id
-                if input_label and input_label in CORPORA_SET.values():
-                    corpus_id = next(
-                        (id for id, label in CORPORA_SET.items() if label == input_label),
-                        None
-                    )
-                    kwargs[target_field] = corpus_id
-                
+                kwargs[target_field] = corpus_id_for(kwargs[target_field])
+
             return await func(*args, **kwargs)
 
         return anon
 
     return decorator
 
+
+def max_age(ttl):
+    """
+    Returns how long clients may reuse a response that's cached for another
+    'ttl' seconds.
+    """
+    return max(0, int(min(ttl, HTTP_CACHE_MAX_AGE_SECS)))
+
+
+def cache_response():
+    """
+    Caches the responses of an endpoint that takes 'tok' and 'corpus' arguments
+    (i.e., /neighbors) in redis, via response_cache, and in this process'
+    memory, via local_cache.
+
+    Works like the fastapi_redis_cache @cache() decorator it replaces, but
+    with the shared async redis client and a compact encoding (see
+    cache.encode_response()): responses are served from the cache unless the
+    request has a 'Cache-Control: no-cache' or 'no-store' header, and carry
+    X-FastAPI-Cache, Cache-Control, Expires and ETag headers. A request whose
+    If-None-Match header matches the ETag gets a 304.
+
+    Responses are returned as bytes, bypassing FastAPI's encoding of the
+    endpoint's return value. Those in local_cache are served as they are,
+    and those in redis are only decoded if the client doesn't already have
+    them.
+
+    Requests are recorded in the index of the most requested tokens that backs
+    /neighbors/cache once their response is in the cache (i.e., it's served
+    from there or was just added to it), so the index only holds cached
+    tokens; they're removed from it when they're evicted (see
+    cache.EntryCountKeeper).
+    """
+
+    def decorator(func):
+        @wraps(func)
+        async def anon(*args, **kwargs):
+            request = kwargs.get("request")
+
+            if request_is_not_cacheable(request):
+                return await func(*args, **kwargs)
+
+            tok, corpus = kwargs["tok"], kwargs["corpus"]
+            entry = local_cache.get((tok, corpus))
+
+            if entry is None:
+                ttl, value = await response_cache.get(tok, corpus)
+
+                if value is not None:
+                    etag = etag_for(value)
+
+                    # the ETag is computed from the stored value, so clients
+                    # that already have the response don't need it decoded
+                    if requested_resource_not_modified(request, etag):
+                        access_recorder.record(tok, corpus)
+                        return Response(
+                            status_code=304, headers=cache_headers(True, etag, max_age(ttl))
+                        )
+
+                    entry = local_cache.put(
+                        (tok, corpus),
+                        await run_in_threadpool(response_json, value),
+                        etag,
+                        time.time() + ttl,
+                    )
+
+            if entry is not None:
+                access_recorder.record(tok, corpus)
+                headers = cache_headers(
+                    True, entry.etag, max_age(entry.expires_at - time.time())
+                )
+
+                if requested_resource_not_modified(request, entry.etag):
+                    return Response(status_code=304, headers=headers)
+
+                return Response(
+                    content=entry.body, media_type="application/json", headers=headers
+                )
+
+            result = await func(*args, **kwargs)
+
+            # the job that produced the response has usually cached it already
+            # (see w2v_worker.get_neighbors()), so its ETag is taken from what
+            # it stored. otherwise (e.g., with YEAR_SHARDS) it's cached here
+            ttl, value = await response_cache.get(tok, corpus)
+
+            if value is None:
+                ttl, value = response_cache.expire, await run_in_threadpool(
+                    encode_response, result
+                )
+                await response_cache.set(tok, corpus, value)
+
+            access_recorder.record(tok, corpus)
+            entry = local_cache.put(
+                (tok, corpus),
+                await run_in_threadpool(result_json, result),
+                etag_for(value),
+                time.time() + ttl,
+            )
+
+            return Response(
+                content=entry.body,
+                media_type="application/json",
+                headers=cache_headers(False, entry.etag, max_age(ttl)),
+            )
+
+        return anon
+
+    return decorator
+
+
 # ========================================================================
 # === endpoints
 # ========================================================================
@@ -213,28 +688,45 @@ async def server_meta(worker_details: bool = False):
     """
 
     # gather info about worker pools, load, etc.
-    r = redis.from_url(os.environ.get("REDIS_URL"))
-    runtime = {"total_workers": Worker.count(connection=r)}
+    # (equivalent to rq's Worker.count(), which isn't async)
+    workers_by_queue = await fetch_worker_queues(redis_client)
+    runtime = {
+        "total_workers": await redis_client.scard(REDIS_WORKER_KEYS),
+        # the number of workers taking jobs from each queue, which reflects the
+        # models they hold (e.g., 'w2v_queries:preprints' for the workers with
+        # just the preprints models; see jobs.worker_queue_names())
+        "workers_by_queue": workers_by_queue,
+        # the number of jobs waiting for a worker in each of those queues, e.g.
+        # for clients like utils/populate_cache to pace themselves
+        "queued_jobs": await fetch_queue_lengths(
+            redis_client, sorted(set(workers_by_queue) | {QUEUE_NAME})
+        ),
+    }
 
     # get the number of entries in the cache, but if it fails for any
     # reason, just report 0 rather than causing the request to fail
     try:
-        cached_entry_count = int(r.get('meta:cached_entry_count') or 0)
+        cached_entry_count, cached_entries_by_corpus = await response_cache.entry_counts(
+            list(CORPORA_SET.keys())
+        )
     except:
-        cached_entry_count = 0
+        cached_entry_count, cached_entries_by_corpus = 0, {}
 
     payload = {
         "name": "Word Lapse API",
         "commit_sha": os.environ.get("COMMIT_SHA", "unspecified"),
         "config": get_config_values(),
         "cache": {
-            "cached_entries": cached_entry_count
+            "cached_entries": cached_entry_count,
+            "cached_entries_by_corpus": cached_entries_by_corpus,
+            # counters for the in-memory cache of the process serving this request
+            "local": local_cache.stats(),
         },
         "runtime": runtime,
     }
 
     if worker_details:
-        workers = Worker.all(connection=r)
+        workers = await run_in_threadpool(Worker.all, connection=queue.connection)
         runtime["worker_info"] = {
             worker.hostname: {
                 "state": worker.state,
@@ -262,7 +754,7 @@ async def ping_workers():
 @app.get("/neighbors")
 @lowercase_field()
 @map_corpus_label()
-@cache()
+@cache_response()
 async def neighbors(request: Request, tok: str, corpus: str = "pubtator"):
     """
     Returns information about the token 'tok' over all the years in the dataset
@@ -294,46 +786,216 @@ async def neighbors(request: Request, tok: str, corpus: str = "pubtator"):
     from .w2v_worker import get_neighbors
 
     # validate the corpus before we send off a job, since it's hard to read the exception there
-    corpora_ids = list(CORPORA_SET.keys())
+    validate_corpus(corpus)
 
-    if corpus not in corpora_ids:
-        logger.info("Corpus %s requested, but not found in %s" % (corpus, corpora_ids))
-        raise HTTPException(
-            status_code=400,
-            detail="Requested corpus '%s' not in corpus set %s" % (corpus, corpora_ids),
+    logger.info("Serving request for %s..." % tok)
+
+    if YEAR_SHARDS:
+        return await get_neighbors_sharded(tok, corpus)
+
+    return await enqueue_unique_and_wait(
+        get_neighbors,
+        neighbors_job_id(tok, corpus),
+        tok=tok,
+        corpus=corpus,
+        target_queue=await routed_queue(corpus),
+        job_timeout=1200,
+        result_ttl=10,
+        failure_ttl=10,
+    )
+
+
+async def stream_neighbors(tok: str, corpus: str):
+    """
+    Generates the events of the /neighbors/stream response for 'tok' in
+    'corpus' as lines of JSON; see neighbors_stream().
+    """
+    def line(event):
+        return json.dumps(event).encode("utf8") + b"\n"
+
+    # if the response is cached, send it all at once
+    entry = local_cache.get((tok, corpus))
+    _, value = (None, None) if entry is not None else await response_cache.get(tok, corpus)
+
+    if entry is not None or value is not None:
+        access_recorder.record(tok, corpus)
+        result = (
+            json.loads(entry.body)
+            if entry is not None
+            else await run_in_threadpool(decode_response, value)
         )
 
-    logger.info("Serving request for %s..." % tok)
+        for event in partial_events(result):
+            yield line(event)
 
-    # construct unique job id
-    new_job_id = f"get_neighbors__{corpus}_{tok}"
+        return
 
-    try:
-        # attempt to fetch and wait on an existing job
-        r = redis.from_url(os.environ.get("REDIS_URL"))
-        existing_job = Job.fetch(new_job_id, connection=r)
+    # otherwise, follow the jobs that compute it (starting them if needed) as
+    # they publish each part of the response
+    job_ids = await enqueue_neighbors(tok, corpus)
+
+    if not YEAR_SHARDS:
+        # the job caches the response itself
+        async for _, event in follow_partials(job_ids):
+            if event["type"] == "done":
+                access_recorder.record(tok, corpus)
+
+            yield line(event)
+        return
+
+    # with YEAR_SHARDS, assemble and cache the response from the shards' parts.
+    # the frequencies are sent first, so any neighbors that arrive before them
+    # are held back until then
+    result = {"neighbors": {}}
+    held = []
+
+    with ExecTimer() as timer:
+        async for _, event in follow_partials(job_ids):
+            if event["type"] == "error":
+                yield line(event)
+                return
+
+            if event["type"] == "frequency":
+                result["frequency"] = event["frequency"]
+                result["changepoints"] = event["changepoints"]
+                yield line(event)
+
+                for held_event in held:
+                    yield line(held_event)
+                held = []
+
+            elif event["type"] == "neighbors":
+                result["neighbors"][event["year"]] = event["neighbors"]
+
+                if "frequency" in result:
+                    yield line(event)
+                else:
+                    held.append(event)
+
+    result = merge_shard_results([result], timer.snapshot())
+    await response_cache.set(
+        tok, corpus, await run_in_threadpool(encode_response, result)
+    )
+    access_recorder.record(tok, corpus)
+
+    yield line({"type": "done", "elapsed": result["elapsed"]})
 
-        logger.info("Found existing job! %s" % existing_job)
 
-        if existing_job.get_status() == "failed":
-            logger.info("..but job %s has staus failed" % existing_job)
-            raise NoSuchJobError()
+@app.get("/neighbors/stream")
+@lowercase_field()
+@map_corpus_label()
+async def neighbors_stream(tok: str, corpus: str = "pubtator"):
+    """
+    Returns the same information as `/neighbors`, but as a stream of
+    newline-delimited JSON objects that are sent as soon as they're available,
+    rather than all at once when the slowest part is done. The frequencies and
+    changepoints come first, followed by the neighbors for each year as
+    they're found:
+
+    ```
+    {"type": "frequency", "frequency": [...], "changepoints": [...]}
+    {"type": "neighbors", "year": <year:str>, "neighbors": [...]}
+    ...
+    {"type": "done", "elapsed": <elapsed_ms:float>}
+    ```
+
+    where the values have the same format as the corresponding fields of the
+    `/neighbors` response. If the response can't be produced, the stream ends
+    with `{"type": "error", "detail": <message:str>}` instead of the 'done'
+    object.
+
+    Cached responses are sent all at once. Otherwise, the response is cached
+    when it's complete, just as it would be by `/neighbors`.
+    """
+    validate_corpus(corpus)
+
+    logger.info("Streaming request for %s..." % tok)
+
+    return StreamingResponse(
+        stream_neighbors(tok, corpus), media_type="application/x-ndjson"
+    )
+
+
+class NeighborsBatchRequest(BaseModel):
+    toks: List[str]
+    corpus: str = "pubtator"
+
+
+@app.post("/neighbors/batch")
+async def neighbors_batch(batch: NeighborsBatchRequest):
+    """
+    Returns the same information as `/neighbors` for each token in 'toks', drawn
+    from the dataset specified by 'corpus' (default 'pubtator').
+
+    Tokens that are already cached are served from the cache. The rest are
+    processed together in a single job, which queries each year model once for
+    all of them and caches each token's result, so subsequent `/neighbors`
+    requests for them are fast. At most MAX_BATCH_SIZE tokens (see the `config`
+    block returned by `/`) can be requested at once.
+
+    The request body is of the form
+
+    ```
+    {"toks": [<token:str>, ...], "corpus": <corpus:str>}
+    ```
+
+    and the returned object is of the form
+
+    ```
+    {<token:str>: <the /neighbors response for the token>, ...}
+    ```
+
+    Note that tokens are lowercased, as in `/neighbors`.
+    """
+    from .w2v_worker import get_neighbors_batch
+
+    corpus = corpus_id_for(batch.corpus)
+    validate_corpus(corpus)
 
-        return await wait_on_job(existing_job)
+    # lowercase and remove duplicates, preserving the order
+    toks = list(dict.fromkeys(tok.lower() for tok in batch.toks))
 
-    except NoSuchJobError:
-        logger.info("Creating new job for %s" % tok)
+    if len(toks) > MAX_BATCH_SIZE:
+        raise HTTPException(
+            status_code=400,
+            detail="Requested %d tokens, but at most %d can be requested at once"
+            % (len(toks), MAX_BATCH_SIZE),
+        )
+
+    # the JSON bodies of the cached responses, which are spliced into the
+    # response as they are
+    results = await response_cache.get_many(toks, corpus)
+    missing = [tok for tok in toks if tok not in results]
 
-        # create and fire off a new job
-        return await enqueue_and_wait(
-            get_neighbors,
-            tok=tok,
+    logger.info(
+        "Serving batch of %d tokens (%d cached)..." % (len(toks), len(results))
+    )
+
+    if missing:
+        # identical batches share a job, like requests for the same token do
+        batch_hash = hashlib.sha1("\n".join(missing).encode("utf8")).hexdigest()
+
+        computed = await enqueue_unique_and_wait(
+            get_neighbors_batch,
+            f"get_neighbors_batch__{corpus}_{batch_hash}",
+            toks=missing,
             corpus=corpus,
-            job_timeout=1200,
-            job_id=new_job_id,
+            target_queue=await routed_queue(corpus),
+            job_timeout=1200 + 10 * len(missing),
             result_ttl=10,
             failure_ttl=10,
         )
+        results.update(
+            {tok: json.dumps(result).encode("utf8") for tok, result in computed.items()}
+        )
+
+    return Response(
+        content=b"{%s}"
+        % b", ".join(
+            b"%s: %s" % (json.dumps(tok).encode("utf8"), results[tok]) for tok in toks
+        ),
+        media_type="application/json",
+    )
 
 
 @app.get("/neighbors/cached")
@@ -349,53 +1011,91 @@ async def neighbors_is_cached(tok: str, corpus: str = "pubtator"):
     Note that querying for the token will increase its cache count,
     making it less likely to be evicted.
     """
-    key = redis_cache.get_cache_key(neighbors, request=None, tok=tok, corpus=corpus)
-    (_, in_cache) = redis_cache.check_cache(key)
-    return {"token": tok, "is_cached": True if in_cache is not None else False}
+    if (tok, corpus) in local_cache:
+        access_recorder.touch(tok, corpus)
+        return {"token": tok, "is_cached": True}
+
+    return {"token": tok, "is_cached": await response_cache.touch(tok, corpus)}
 
 
 @app.get("/neighbors/cache")
-async def neighbors_cache(count: int = 100):
+@map_corpus_label()
+async def neighbors_cache(
+    count: int = 100, offset: int = 0, corpus: str = None, recent: bool = False
+):
     """
-    Returns a list of tokens in the cache, with up to 'count' entries returned
-    (default 100, max value 1000).
+    Returns a list of the most requested tokens in the cache, with up to
+    'count' entries returned (default 100, max value 1000), starting from the
+    'offset'-th most requested (default 0). If 'corpus' is given (one of
+    'pubtator', 'preprints'), only that corpus' tokens are listed; otherwise,
+    they're drawn from every corpus.
 
-    Note that while these tokens are ordered by the 'freq' field in the list
-    that's returned, they're not retrieved in order of 'freq' due to redis'
-    limitations and the prohibitive cost of querying and returning all the keys
-    to order it ourselves.
+    If 'recent' is true, the tokens are ordered by the time they were last
+    requested rather than by the number of requests.
 
-    Refer to [redis's LFU documentation](https://redis.io/topics/lru-cache#the-new-lfu-mode)
-    for the meaning of the 'freq' field.
+    Returns a list of the following form:
+    ```
+    [ {'token': <token:str>, 'corpus': <corpus:str>, 'freq': <freq:int?>, 'requests': <requests:int>, 'last_access': <unix_time:float>}, ... ]
+    ```
+
+    where 'requests' is the number of times the token was requested while it
+    was cached, 'last_access' is the time of the last of those requests, and
+    'freq' is redis' LFU counter for the token's cache entry, as before (see
+    [redis's LFU documentation](https://redis.io/topics/lru-cache#the-new-lfu-mode)).
+
+    Tokens are dropped from the list when they're evicted from the cache.
+
+    Changes: tokens used to be drawn from an arbitrary slice of the cache and
+    ordered by 'freq' alone; they're now the most requested (or most
+    recently requested) tokens, and the 'offset', 'corpus' and 'recent'
+    parameters and the 'requests' and 'last_access' fields were added.
     """
-    # connect to redis and get the top 100 keys by frequency?
-    r = redis.from_url(os.environ.get("REDIS_URL"))
+    if corpus is not None:
+        validate_corpus(corpus)
 
     # clamp count to something reasonable
-    actual_count = min(count, 1000)
+    actual_count = max(0, min(count, 1000))
+    offset = max(0, offset)
 
-    prefix = "wlc"
+    if actual_count == 0:
+        return []
+
+    if corpus is not None:
+        ranked = [
+            (tok, corpus, requests, last_access)
+            for tok, requests, last_access in await response_cache.most_requested(
+                corpus, actual_count, offset=offset, recent=recent
+            )
+        ]
+    else:
+        # the top entries over every corpus are among the top of each corpus
+        ranked = [
+            (tok, corpus_id, requests, last_access)
+            for corpus_id in CORPORA_SET.keys()
+            for tok, requests, last_access in await response_cache.most_requested(
+                corpus_id, offset + actual_count, recent=recent
+            )
+        ]
+        ranked.sort(
+            key=lambda x: (x[3] or 0) if recent else (x[2], x[3] or 0), reverse=True
+        )
+        ranked = ranked[offset : offset + actual_count]
 
-    # extract the token from the key, e.g. "mouse" from "backend.main.neighbors(mouse)"
-    tok_extract = re.compile(
-        r".*tok=(?P<token>[^,]+).*?(?:corpus=(?P<corpus>[^)]+))?\)"
+    freqs = await response_cache.lfu_freqs(
+        [(tok, tok_corpus) for tok, tok_corpus, _, _ in ranked]
     )
 
-    # build a list of top "count" tokens, then order it by frequency
-    # (note that if there are more than 'count' tokens, we can't guarantee they're the top ones...)
-    toptokens = [
+    return [
         {
-            **{"freq": r.object("freq", x)},
-            **(tok_extract.search(x.decode("utf8")).groupdict()),
+            "token": tok,
+            "corpus": tok_corpus,
+            "freq": freq,
+            "requests": requests,
+            "last_access": last_access,
         }
-        for x in islice(
-            r.scan_iter(match=("%s*" % prefix), count=actual_count), actual_count
-        )
-        if tok_extract.search(x.decode("utf8")) is not None
+        for (tok, tok_corpus, requests, last_access), freq in zip(ranked, freqs)
     ]
 
-    return toptokens
-
 
 @app.get("/autocomplete")
 async def autocomplete(
@@ -422,12 +1122,15 @@ async def autocomplete(
     'vocab_limit' limits the number of vocabulary entries returned (max 100).
     'concept_limit' limits the number of concept map entries returned (max 100).
 
+    The entries are the most frequent matches from each source, ordered by
+    their total word count over all the corpora (see backend.autocomplete).
+
     Returns a list of the following form:
     ```
     [ {'vocab': <term:str?>, 'concept': <concept_id:str?> }, ... ]
     ```
     """
-    global vocab_trie, concept_trie
+    global autocomplete_index
 
     if not include_vocab and not include_concepts:
         return []
@@ -437,32 +1140,28 @@ async def autocomplete(
     if len(prefix) < 3:
         return [{"vocab": prefix, "concept": None}]
 
-    results = []
+    # (score, entry) pairs from both sources, merged by score below
+    suggestions = []
 
     if include_vocab:
-        vocab_limit = min(vocab_limit, 100)
-
-        try:
-            results += [
-                {'vocab': "".join(x).strip(), 'concept': None}
-                for x in islice(vocab_trie.iterkeys(prefix=prefix), vocab_limit)
-            ]
-        except KeyError:
-            # pygtrie throws a KeyError if it can't find the prefix, but that's not an error per se
-            pass
+        suggestions += [
+            (score, {'vocab': term, 'concept': None})
+            for term, score in autocomplete_index.complete_vocab(
+                prefix, max(0, min(vocab_limit, 100))
+            )
+        ]
 
     if include_concepts:
-        concept_limit = min(concept_limit, 100)
-
-        try:
-            results += [
-                {'vocab': label.strip(), 'concept': concept_id}
-                for label, concept_id in islice(
-                    concept_trie.iteritems(prefix=prefix), concept_limit
-                )
-            ]
-        except KeyError:
-            # pygtrie throws a KeyError if it can't find the prefix, but that's not an error per se
-            pass
+        suggestions += [
+            (score, {'vocab': label, 'concept': concept_id})
+            for label, concept_id, score in autocomplete_index.complete_concepts(
+                prefix, max(0, min(concept_limit, 100))
+            )
+        ]
+
+    # the sort is stable, so vocab entries come first among equal scores
+    results = [
+        entry for _, entry in sorted(suggestions, key=lambda x: x[0], reverse=True)
+    ]
 
     return results
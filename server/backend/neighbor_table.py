@@ -0,0 +1,328 @@
+"""
+Precomputed nearest neighbors for every token in the shared vocabulary.
+
+A corpus' neighbor table holds the top neighbors of each token in
+full_vocab.txt in each year, so that a /neighbors request for one of them is
+answered with a lookup rather than a scan of every year model. It's stored in
+the folder data/neighbor_tables/<corpus>/ as:
+- vocab.strtab: the sorted table of tokens; a token's id is its index here
+- <year>.keys.strtab: the year model's keys, in the model's order
+- <year>.ids.npy: an int32 (tokens x topn) matrix of the rows of each token's
+  neighbors in <year>.keys.strtab, in descending order of score, padded with
+  -1 (all -1 if the token isn't in the year's model)
+- <year>.scores.npy: the float32 (tokens x topn) matrix of their scores
+- <year>.progress: the number of tokens whose neighbors have been written
+
+Each year is computed a chunk of tokens at a time with the NeighborEngine's
+exact search, recording its progress after each chunk, so an interrupted
+build picks up where it left off. Years are computed in parallel.
+
+Only years whose neighbors have been written for every token are used, and
+only if every year model of the corpus has one; otherwise, the neighbors are
+found with a live search as usual.
+
+Usage, from the server folder:
+  python -m backend.neighbor_table build [--corpus pubtator] [--jobs 4] [--force]
+"""
+
+import argparse
+import logging
+import shutil
+import sys
+from pathlib import Path
+
+import numpy as np
+from joblib import Parallel, delayed
+
+from .strtable import StringTable, write_atomically
+from .tracking import ExecTimer
+
+logging.basicConfig(stream=sys.stdout)
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# relative to the data folder
+VOCAB_FILE = Path("full_vocab.txt")
+NEIGHBOR_TABLES_FOLDER = Path("neighbor_tables")
+
+TABLE_VOCAB_FILE = "vocab.strtab"
+
+# the number of neighbors stored per token and year; requests for more than
+# this many are answered with a live search
+NEIGHBOR_TABLE_TOPN = 25
+
+# the number of tokens searched and written at once
+CHUNK_TOKENS = 4096
+
+
+def neighbor_table_folder(data_folder, corpus):
+    return Path(data_folder) / NEIGHBOR_TABLES_FOLDER / corpus
+
+
+def year_paths(folder, year):
+    """
+    Returns a dict of the paths of the files that hold 'year' in the neighbor
+    table in 'folder'.
+    """
+    return {
+        name: Path(folder) / ("%s.%s" % (year, suffix))
+        for name, suffix in (
+            ("keys", "keys.strtab"),
+            ("ids", "ids.npy"),
+            ("scores", "scores.npy"),
+            ("progress", "progress"),
+        )
+    }
+
+
+def read_progress(path):
+    """
+    Returns the number of tokens recorded in the progress file at 'path', or 0
+    if it doesn't exist.
+    """
+    try:
+        with open(path, "r") as fp:
+            return int(fp.read())
+    except FileNotFoundError:
+        return 0
+
+
+def read_vocab(path):
+    """
+    Returns the sorted, unique tokens in the vocabulary file at 'path', which
+    has one token per line.
+    """
+    with open(path, "r") as fp:
+        return sorted({line.strip() for line in fp} - {""})
+
+
+class NeighborTable:
+    """
+    A corpus' precomputed neighbor table, memory-mapped from 'folder'; see
+    this module's docstring for the format.
+
+    Only the years that have been completely written (and are in 'years', if
+    given) are loaded.
+    """
+
+    def __init__(self, folder, years=None):
+        self.folder = Path(folder)
+        self.vocab = StringTable.open(self.folder / TABLE_VOCAB_FILE)
+        # year => (keys, ids, scores)
+        self.years = {}
+
+        for progress_path in sorted(self.folder.glob("*.progress")):
+            year = progress_path.name.split(".")[0]
+            paths = year_paths(self.folder, year)
+
+            if years is not None and year not in years:
+                continue
+
+            if read_progress(paths["progress"]) < len(self.vocab):
+                logger.warning("Neighbor table for %s is incomplete, skipping" % year)
+                continue
+
+            self.years[year] = (
+                StringTable.open(paths["keys"]),
+                np.load(paths["ids"], mmap_mode="r"),
+                np.load(paths["scores"], mmap_mode="r"),
+            )
+
+        self.topn = min(
+            (ids.shape[1] for _, ids, _ in self.years.values()),
+            default=NEIGHBOR_TABLE_TOPN,
+        )
+
+    def __contains__(self, tok):
+        return tok in self.vocab
+
+    def lookup(self, tok: str, years=None, decorations=None):
+        """
+        Returns the neighbors of 'tok' in each year (or just those in 'years')
+        as a dict of the form {<year>: [(<neighbor key>, <score>), ...], ...},
+        like NeighborEngine.query() returns for each token, or None if 'tok'
+        isn't in the table.
+
+        If 'decorations' (a dict of each year model's ModelDecorations; see
+        decorations.py) is given, each neighbor is instead the dict returned
+        by the API, since the table's keys are in the same order as the
+        model's.
+        """
+        idx = self.vocab.find(tok)
+
+        if idx < 0:
+            return None
+
+        result = {}
+
+        for year, (keys, ids, scores) in self.years.items():
+            if years is not None and year not in years:
+                continue
+
+            if decorations is not None:
+                result[year] = decorations[year].decorate(
+                    ids[idx].tolist(), scores[idx].tolist()
+                )
+                continue
+
+            result[year] = [
+                (keys.key(neighbor), score)
+                for neighbor, score in zip(ids[idx].tolist(), scores[idx].tolist())
+                if neighbor >= 0
+            ]
+
+        return result
+
+
+def load_neighbor_table(data_folder, corpus, model_years):
+    """
+    Loads the neighbor table for 'corpus' from 'data_folder', if there is one
+    and it has every year in 'model_years'. Returns None otherwise, in which
+    case callers should use a live search.
+    """
+    folder = neighbor_table_folder(data_folder, corpus)
+
+    if not (folder / TABLE_VOCAB_FILE).exists():
+        logger.info("No neighbor table at %s, using live search" % folder)
+        return None
+
+    table = NeighborTable(folder, years=set(model_years))
+    missing = set(model_years) - set(table.years)
+
+    if missing:
+        logger.warning(
+            "Neighbor table at %s is missing years %s, using live search"
+            % (folder, sorted(missing))
+        )
+        return None
+
+    return table
+
+
+# ========================================================================
+# === building
+# ========================================================================
+
+
+def build_year(folder, year, model_path, topn=NEIGHBOR_TABLE_TOPN, chunk=CHUNK_TOKENS):
+    """
+    Computes the neighbors of every token in the neighbor table in 'folder'
+    for 'year', whose model is at 'model_path', resuming from the last chunk
+    that was recorded.
+    """
+    from .engine import YearIndex
+    from .neighbors import load_word_model, resolve_model_token
+
+    vocab = StringTable.open(Path(folder) / TABLE_VOCAB_FILE)
+    paths = year_paths(folder, year)
+    done = read_progress(paths["progress"])
+
+    if done >= len(vocab):
+        print("Neighbors for %s are done, skipping" % year, flush=True)
+        return
+
+    model = load_word_model(model_path)
+    year_index = YearIndex(year, model_path, model)
+
+    if done == 0:
+        StringTable.write(paths["keys"], year_index.index_to_key)
+
+        for name, dtype in (("ids", np.int32), ("scores", np.float32)):
+            np.lib.format.open_memmap(
+                paths[name], mode="w+", dtype=dtype, shape=(len(vocab), topn)
+            ).flush()
+
+    ids = np.load(paths["ids"], mmap_mode="r+")
+    scores = np.load(paths["scores"], mmap_mode="r+")
+
+    print("Computing neighbors for %s from token %d..." % (year, done), flush=True)
+
+    for start in range(done, len(vocab), chunk):
+        end = min(start + chunk, len(vocab))
+
+        chunk_ids = np.full((end - start, topn), -1, dtype=np.int32)
+        chunk_scores = np.zeros((end - start, topn), dtype=np.float32)
+
+        # the chunk's tokens that are in this year's model, and their rows
+        present = []
+
+        for i, tok in enumerate(vocab.keys(start, end)):
+            model_tok = resolve_model_token(tok, year_index.key_to_index)
+
+            if model_tok is not None:
+                present.append((i, year_index.key_to_index[model_tok]))
+
+        if present:
+            found_ids, found_scores = year_index.search_exact(
+                [row for _, row in present], topn
+            )
+            chunk_ids[[i for i, _ in present]] = found_ids
+            chunk_scores[[i for i, _ in present]] = found_scores
+
+        ids[start:end] = chunk_ids
+        scores[start:end] = chunk_scores
+        ids.flush()
+        scores.flush()
+
+        # only recorded once the chunk is on disk
+        write_atomically(paths["progress"], str(end).encode("utf8"))
+
+    print("...neighbors for %s done!" % year, flush=True)
+
+
+def build(args):
+    from .neighbors import data_folder, word_models_by_year
+
+    folder = neighbor_table_folder(data_folder, args.corpus)
+
+    if args.force and folder.exists():
+        shutil.rmtree(folder)
+
+    folder.mkdir(parents=True, exist_ok=True)
+
+    # the vocabulary is fixed once a table is started, since the token ids
+    # index into every year's files
+    if not (folder / TABLE_VOCAB_FILE).exists():
+        vocab = read_vocab(data_folder / VOCAB_FILE)
+        print("Writing vocabulary of %d tokens..." % len(vocab), flush=True)
+        StringTable.write(folder / TABLE_VOCAB_FILE, vocab, is_sorted=True)
+    else:
+        print("Using the existing vocabulary (use --force to rebuild it)", flush=True)
+
+    models = list(word_models_by_year(corpus=args.corpus, just_reference=True))
+
+    with ExecTimer(verbose=True):
+        Parallel(n_jobs=args.jobs, backend=args.backend)(
+            delayed(build_year)(folder, year, model_path, chunk=args.chunk)
+            for year, _, model_path in models
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Precomputes the neighbors of every token in the vocabulary"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build_parser = subparsers.add_parser(
+        "build", help="compute (or resume computing) a corpus' neighbor table"
+    )
+    build_parser.add_argument("--corpus", default="pubtator")
+    build_parser.add_argument(
+        "--jobs", type=int, default=4, help="years computed at once"
+    )
+    build_parser.add_argument("--backend", default="loky", help="joblib backend")
+    build_parser.add_argument(
+        "--chunk", type=int, default=CHUNK_TOKENS, help="tokens searched at once"
+    )
+    build_parser.add_argument(
+        "--force", action="store_true", help="discard the existing table and start over"
+    )
+    build_parser.set_defaults(func=build)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,29 +1,41 @@
 import logging
-import lzma
-import mmap
-import os
-import pickle
 import re
 import sys
 from contextlib import contextmanager
-from csv import DictReader
 from itertools import groupby
 from pathlib import Path
 
-import pandas as pd
-import plydata as ply
 from gensim.models import KeyedVectors, Word2Vec
 from joblib import Parallel, delayed
-from pygtrie import CharTrie
 
 from .config import (
+    ANN_NPROBE,
     CORPORA_SET,
     MATERIALIZE_MODELS,
+    NEIGHBOR_ENGINE,
     PARALLEL_BACKEND,
     PARALLEL_POOLS,
     PARALLELIZE_QUERY,
+    QUANTIZED_CANDIDATES,
+    QUANTIZED_DTYPE,
+    RELOAD_CHANGEPOINTS,
     USE_MEMMAP,
+    USE_NEIGHBOR_TABLE,
+    WORKER_YEARS,
+    parse_years,
 )
+from .changepoints import CHANGEPOINT_FILES, ChangepointIndex
+from .concepts import (
+    CONCEPT_MAP_FILE,
+    CONCEPTS_FILE,
+    load_concept_map,
+    read_concepts,
+    write_concept_map,
+)
+from .decorations import decorate_key, load_decorations
+from .engine import NeighborEngine
+from .frequencies import load_frequency_table
+from .neighbor_table import load_neighbor_table
 from .tracking import ExecTimer
 
 logging.basicConfig(stream=sys.stdout)
@@ -46,8 +58,33 @@ data_folder = Path("./data")
 #   year/index
 word_models = {}
 
-# Enables tagged concepts to be denormalized (e.g. concept_id -> concept name)
-concept_id_mapper_dict = None
+# stores a NeighborEngine for each corpus, built over the models in
+# 'word_models'; used unless config.NEIGHBOR_ENGINE is 'gensim'
+neighbor_engines = {}
+
+# stores the precomputed NeighborTable for each corpus, or None if it doesn't
+# have one; used if config.USE_NEIGHBOR_TABLE is true
+neighbor_tables = {}
+
+# the years whose models this worker loads, or None for all of them; see
+# config.WORKER_YEARS
+worker_years = parse_years(WORKER_YEARS) if WORKER_YEARS else None
+
+# Enables tagged concepts to be denormalized (e.g. concept_id -> concept name);
+# populated by get_concept_id_mapper()
+concept_id_mapper = None
+
+# stores the ModelDecorations of each year model, keyed by corpus, then year;
+# populated by get_model_decorations()
+model_decorations = {}
+
+# caches ChangepointIndex instances, keyed by corpus; populated by
+# get_changepoint_index()
+changepoint_indices = {}
+
+# caches FrequencyTable instances, keyed by corpus; populated by
+# get_frequency_table()
+frequency_tables = {}
 
 # ========================================================================
 # === extract_frequencies(), cutoff_points()
@@ -64,138 +101,89 @@ class CorpusNotFoundException(Exception):
         super().__init__(self.message)
 
 
-def extract_frequencies(tok: str, corpus: str):
-    corpus_paths = {
-        "pubtator": data_folder / Path("all_pubtator_tok_frequency.tsv.xz"),
-        "preprints": data_folder / Path("all_preprint_tok_frequency.tsv.xz"),
-    }
-
-    # Extract the frequencies
-    try:
-        frequency_table = pd.read_csv(corpus_paths[corpus], sep="\t")
-    except KeyError:
-        raise CorpusNotFoundException(corpus=corpus)
-
-    # note: previously, frequency was a float column in the above csv, but
-    # it's been replaced with word_count, an integer. since the frontend doesn't
-    # care whether it's a float or an int, we've renamed it here to 'frequency'
-    # so everything continues to work...
-
-    frequency_output_df = (
-        frequency_table
-        >> ply.group_by("year")
-        >> ply.define(total="sum(word_count)")
-        >> ply.ungroup()
-        >> ply.query("tok == @tok")
-        >> ply.define(normalized="word_count/total") 
-        >> ply.select("year", "word_count", "normalized")
-        >> ply.arrange("year")
-        >> ply.rename({"frequency": "word_count", "normalized_frequency": "normalized"})
-        >> ply.call(".astype", {"year": int, "frequency": int, "normalized_frequency": float})
-    )
+def get_frequency_table(corpus: str):
+    """
+    Returns the FrequencyTable for 'corpus', loading it the first time it's
+    requested in this process. If the columnar copy of the table is present in
+    the data folder it's memory-mapped; otherwise, the table is built from the
+    corpus' frequency file and a columnar copy is written for next time.
+
+    Workers should call this for each corpus on startup (see
+    w2v_worker.load_frequency_tables()) so that the forked job processes
+    inherit the already-built tables.
+    """
+    global frequency_tables
 
-    return frequency_output_df >> ply.call(".to_dict", orient="records")
+    if corpus not in frequency_tables:
+        try:
+            frequency_tables[corpus] = load_frequency_table(corpus, data_folder)
+        except KeyError:
+            raise CorpusNotFoundException(corpus=corpus)
 
+    return frequency_tables[corpus]
 
-def cutoff_points(tok: str, corpus: str):
-    corpus_paths = {
-        "pubtator": data_folder / Path("pubtator_changepoints.tsv"),
-        "preprints": data_folder / Path("preprint_changepoints.tsv"),
-    }
 
-    # Extract Estimated Cutoff Points
-    try:
-        cutoff_points = pd.read_csv(corpus_paths[corpus], sep="\t")
-    except KeyError:
-        raise CorpusNotFoundException(corpus=corpus)
-
-    result = (
-        cutoff_points
-        >> ply.query("tok == @tok")
-        >> ply.select("changepoint_idx")
-        >> ply.call(".to_dict", orient="records")
-    )
-
-    # split hyphens, unnest from object, and return
-    return [[y.strip() for y in x["changepoint_idx"].split("-")] for x in result]
+def extract_frequencies(tok: str, corpus: str):
+    # note: previously, frequency was a float column in the frequency tables,
+    # but it's been replaced with word_count, an integer. since the frontend
+    # doesn't care whether it's a float or an int, FrequencyTable.lookup()
+    # reports it as 'frequency' so everything continues to work...
+    return get_frequency_table(corpus).lookup(tok)
 
 
-# ========================================================================
-# === extract_neighbors()
-# ========================================================================
+def get_changepoint_index(corpus: str):
+    """
+    Returns the ChangepointIndex for 'corpus', loading it the first time it's
+    requested in this process.
 
+    If config.RELOAD_CHANGEPOINTS is true and the changepoint file has been
+    modified since it was loaded, the index is reloaded.
+    """
+    global changepoint_indices
 
-def get_concept_trie():
-    logger.info("Starting concept trie load...")
+    index = changepoint_indices.get(corpus)
 
-    concept_trie_pickle = data_folder / Path("concept_trie.pkl")
+    if index is None or (RELOAD_CHANGEPOINTS and index.is_stale()):
+        try:
+            changepoint_path = data_folder / CHANGEPOINT_FILES[corpus]
+        except KeyError:
+            raise CorpusNotFoundException(corpus=corpus)
 
-    # attempt to use pickled trie b/c generating it takes 45 minutes(!)
-    if os.path.exists(concept_trie_pickle):
-        with open(concept_trie_pickle, "rb") as fp:
-            with mmap.mmap(fp.fileno(), length=0, access=mmap.ACCESS_READ) as mmap_obj:
-                concept_trie = pickle.load(mmap_obj)
-    else:
-        logger.info(
-            " - concept trie pickle not found, regenerating (this will take a while)..."
-        )
-        concept_trie = CharTrie()
-        for row in get_concept_lines():
-            concept_trie[row["concept"]] = row["concept_id"]
+        index = changepoint_indices[corpus] = ChangepointIndex(changepoint_path)
 
-        logger.info(" - writing pickle...")
-        with open(concept_trie_pickle, "wb") as fp:
-            pickle.dump(concept_trie, fp)
-        logger.info(" - done!")
+    return index
 
-    logger.info("...concept trie loading done!")
 
-    return concept_trie
+def cutoff_points(tok: str, corpus: str):
+    # Extract Estimated Cutoff Points
+    return get_changepoint_index(corpus).lookup(tok)
 
 
-def get_concept_lines():
-    with lzma.open(data_folder / Path("all_concept_ids.tsv.xz"), "rt") as fp:
-        reader = DictReader(
-            fp, dialect="excel-tab", fieldnames=("concept_id", "concept")
-        )
-        for row in reader:
-            yield row
+# ========================================================================
+# === extract_neighbors()
+# ========================================================================
 
 
-def get_concept_id_mapper(use_pickle=True, write_pickle=True):
+def get_concept_id_mapper():
     """
-    Loads the concept mapper into a python dictionary format
+    Memory-maps the concept ID => label map (see backend.concepts), building
+    it first if it doesn't exist yet. The map is read like a dict, i.e. with
+    'in', [], and get().
     """
-    global concept_id_mapper_dict
-
-    if not concept_id_mapper_dict:
-        # check if a pickled version exists
-        pickled_path = data_folder / Path("concept_dict.pkl")
-
-        if use_pickle and os.path.exists(pickled_path):
-            with open(pickled_path, "rb") as fp:
-                with mmap.mmap(
-                    fp.fileno(), length=0, access=mmap.ACCESS_READ
-                ) as mmap_obj:
-                    concept_id_mapper_dict = pickle.load(mmap_obj)
-        else:
-            concept_id_mapper = pd.read_csv(
-                data_folder / Path("all_concept_ids.tsv.xz"), sep="\t"
-            ) >> ply.define(concept_id="concept_id.str.lower()")
-
-            concept_id_mapper_dict = dict(
-                zip(
-                    concept_id_mapper.concept_id.tolist(),
-                    concept_id_mapper.concept.tolist(),
-                )
+    global concept_id_mapper
+
+    if concept_id_mapper is None:
+        concept_map_path = data_folder / CONCEPT_MAP_FILE
+
+        if not concept_map_path.exists():
+            logger.info("No concept map at %s, building it..." % concept_map_path)
+            write_concept_map(
+                concept_map_path, read_concepts(data_folder / CONCEPTS_FILE)
             )
 
-            # serialize to a pickle to save us some time
-            if write_pickle:
-                with open(pickled_path, "wb") as fp:
-                    pickle.dump(concept_id_mapper_dict, fp)
+        concept_id_mapper = load_concept_map(concept_map_path)
 
-    return concept_id_mapper_dict
+    return concept_id_mapper
 
 
 def load_word_model(model_path, use_keyedvec=True):
@@ -223,7 +211,8 @@ def word_models_by_year(
     in ./data/word2vec_models/*/*model.
 
     The models are sorted by year, then by index within that year if there
-    are multiple models associated with a specific year.
+    are multiple models associated with a specific year. If config.WORKER_YEARS
+    is set, only the models for those years are generated.
 
     corpus: the corpus to retrieve (one of the keys *or* values in
       config.CORPORA_SET; either will work)
@@ -257,6 +246,9 @@ def word_models_by_year(
 
     # group all models for a year into a list
     for year, word_model_refs in groupby(word_models_sorted, key=extract_year):
+        if worker_years is not None and year not in worker_years:
+            continue
+
         # yield each model for the current year in order (e.g., 2000_0, 2000_1)
         # differentiated by idx
         for idx, word_model_ref in enumerate(sorted(word_model_refs)):
@@ -303,6 +295,173 @@ def materialized_word_models(**kwargs):
     return word_models[corpus]
 
 
+def resolve_model_token(tok: str, key_to_index):
+    """
+    Returns the key under which 'tok' is stored in a model with the vocabulary
+    'key_to_index' (i.e., the model's key_to_index dict), or None if the model
+    doesn't contain 'tok'.
+
+    Concepts of the form mesh_<id> are stored in the models with their entity
+    type prefixed, i.e. as disease_mesh_<id> or chemical_mesh_<id>, so those
+    are checked first.
+
+    >>> resolve_model_token("mouse", {"mouse": 0})
+    'mouse'
+    >>> resolve_model_token("mesh_d1", {"mesh_d1": 0, "chemical_mesh_d1": 1})
+    'chemical_mesh_d1'
+    >>> resolve_model_token("rat", {"mouse": 0}) is None
+    True
+    """
+    if tok.startswith("mesh_"):
+        for entity_type in ("disease", "chemical"):
+            remapped_tok = f"{entity_type}_{tok}"
+
+            if remapped_tok in key_to_index:
+                logger.info(f"remapped token {tok} to {remapped_tok}")
+                return remapped_tok
+
+    return tok if tok in key_to_index else None
+
+
+def decorate_neighbors(word_neighbors):
+    """
+    Converts 'word_neighbors', a list of (neighbor key, score) tuples from a
+    year model, into the list of dicts returned by the API, replacing concept
+    IDs with their labels and tagging them with their concept IDs.
+
+    The NeighborEngine and NeighborTable produce these dicts themselves from
+    each model's precomputed decorations (see get_model_decorations()), so
+    this is only used for gensim's results.
+    """
+    result = []
+
+    for word_neighbor, similarity_score in word_neighbors:
+        token, tag_id = decorate_key(word_neighbor, concept_id_mapper)
+        result.append(dict(token=token, tag_id=tag_id, score=similarity_score))
+
+    return result
+
+
+def get_model_decorations(corpus: str):
+    """
+    Returns the decorations of each of the corpus' year models (see
+    decorations.py) as a dict of {<year>: <ModelDecorations>, ...}, loading
+    them the first time they're requested. A model's decorations are written
+    first if they're missing or stale, which loads the model if it isn't
+    already loaded.
+    """
+    global model_decorations
+
+    if corpus not in model_decorations:
+        concept_map = get_concept_id_mapper()
+        loaded_models = {year: model for year, _, model in word_models.get(corpus, [])}
+
+        def model_keys(year, model_path):
+            # uses the materialized model, if it's been loaded already
+            model = loaded_models.get(year)
+
+            if model is None:
+                model = load_word_model(model_path)
+
+            return model.index_to_key
+
+        model_decorations[corpus] = {
+            year: load_decorations(
+                model_path,
+                lambda: model_keys(year, model_path),
+                concept_map,
+                data_folder / CONCEPT_MAP_FILE,
+            )
+            for year, _, model_path in word_models_by_year(
+                corpus=corpus, just_reference=True
+            )
+        }
+
+    return model_decorations[corpus]
+
+
+def get_neighbor_engine(corpus: str):
+    """
+    Returns the NeighborEngine for 'corpus', building it over the corpus'
+    materialized year models the first time it's requested.
+
+    Building the engine the first time writes each model's normalized vectors
+    next to the model file, which takes a while; subsequent builds just
+    memory-map them.
+    """
+    global neighbor_engines
+
+    if corpus not in neighbor_engines:
+        model_paths = {
+            year: model_path
+            for year, _, model_path in word_models_by_year(
+                corpus=corpus, just_reference=True
+            )
+        }
+
+        neighbor_engines[corpus] = NeighborEngine.from_models(
+            [
+                (year, model_paths[year], model)
+                for year, _, model in materialized_word_models(corpus=corpus)
+            ],
+            use_mmap=USE_MEMMAP,
+            ann_nprobe=(ANN_NPROBE if NEIGHBOR_ENGINE == "ann" else None),
+            quantized_dtype=(
+                QUANTIZED_DTYPE if NEIGHBOR_ENGINE == "quantized" else None
+            ),
+            quantized_candidates=QUANTIZED_CANDIDATES,
+            decorations=get_model_decorations(corpus),
+        )
+
+    return neighbor_engines[corpus]
+
+
+def get_neighbor_table(corpus: str):
+    """
+    Returns the precomputed NeighborTable for 'corpus', loading it the first
+    time it's requested, or None if config.USE_NEIGHBOR_TABLE is false or the
+    corpus doesn't have a complete table for the years this worker loads.
+    """
+    global neighbor_tables
+
+    if not USE_NEIGHBOR_TABLE:
+        return None
+
+    if corpus not in neighbor_tables:
+        model_years = [
+            year
+            for year, _, _ in word_models_by_year(corpus=corpus, just_reference=True)
+        ]
+        neighbor_tables[corpus] = load_neighbor_table(data_folder, corpus, model_years)
+
+    return neighbor_tables[corpus]
+
+
+def lookup_neighbor_table(tok: str, corpus: str, neighbors: int = 25, years=None):
+    """
+    Returns the neighbors of 'tok' in each year (or just those in 'years') from
+    the corpus' precomputed NeighborTable, in the form
+    {<year>: [<neighboring word>, ...], ...}, or None if they have to be
+    searched for instead (e.g., if 'tok' isn't in the table).
+    """
+    table = get_neighbor_table(corpus)
+
+    if table is None or neighbors > table.topn:
+        return None
+
+    year_neighbors = table.lookup(
+        tok, years=years, decorations=get_model_decorations(corpus)
+    )
+
+    if year_neighbors is None:
+        return None
+
+    return {
+        year: word_neighbors[:neighbors]
+        for year, word_neighbors in sorted(year_neighbors.items())
+    }
+
+
 def query_model_for_tok(
     year,
     tok,
@@ -315,57 +474,17 @@ def query_model_for_tok(
     result = []
     word_vectors = model if use_keyedvec else model.wv
 
-    # Check to see if token is in the vocab
-    vocab = set(word_vectors.key_to_index.keys())
-
-    if tok.startswith("mesh_"):
-        original_tok = tok
-        tok = (
-            f"disease_{tok}"
-            if f"disease_{tok}" in vocab
-            else f"chemical_{tok}"
-            if f"chemical_{tok}" in vocab
-            else tok
-        )
-
-        if tok != original_tok:
-            logger.info(f"remapped token {original_tok} to {tok}")
+    # Check to see if token is in the vocab, i.e. if it maps to a key in
+    # this model (checked against the model's own key_to_index dict)
+    model_tok = resolve_model_token(tok, word_vectors.key_to_index)
 
-    if tok in vocab:
+    if model_tok is not None:
         # If it is grab the neighbors
         # Gensim needs to be > 4.0 as they enabled neighbor clipping (remove words from entire vocab)
-        word_neighbors = word_vectors.most_similar(tok, topn=neighbors)
+        word_neighbors = word_vectors.most_similar(model_tok, topn=neighbors)
 
         # Append neighbor to word_neighbor_map
-        for neighbor in word_neighbors:
-            word_neighbor, similarity_score = neighbor
-            tag_id = None
-            entity_features = []
-            
-            # Convert tags that contain the following pattern
-            # disease_mesh_####### or chemical_mesh_#######
-            if "mesh" in word_neighbor:
-                entity_features = word_neighbor.split("_")
-                word_neighbor = "_".join(entity_features[1:])
-
-                # a switch to tell the if statement below we found a mesh id
-                tag_id = "mesh"
-
-            # Insert tagged suffix to show users that
-            # some concpets are tagged and some concepts are missed
-            # example: mcf-7 is a cellline but the token itself appears as well
-            if word_neighbor in concept_id_mapper_dict:
-                # add entity type back to the mesh id for the front end
-                tag_id = word_neighbor if tag_id is None else "_".join(entity_features)
-                word_neighbor = concept_id_mapper_dict[word_neighbor]
-
-            result.append(
-                dict(
-                    token=word_neighbor,
-                    tag_id=tag_id,
-                    score=similarity_score
-                )
-            )
+        result = decorate_neighbors(word_neighbors)
 
     return result
 
@@ -375,6 +494,8 @@ def extract_neighbors(
     corpus: str,
     neighbors: int = 25,
     use_keyedvec: bool = True,
+    on_year=None,
+    years=None,
 ):
     """
     Given a word 'tok', for each year from 2000 to 2020, extracts the top
@@ -387,9 +508,51 @@ def extract_neighbors(
     that end in 'model' and refers to the 'wv' subkey of each instance to
     perform the nearest-neighbor queries.
 
+    Unless config.NEIGHBOR_ENGINE is 'gensim' (or use_keyedvec is False), the
+    queries are answered by the corpus' NeighborEngine rather than by calling
+    each year model's most_similar().
+
+    If 'on_year' is given, it's called with (year, <neighboring words>) as
+    each year's neighbors become available, e.g. to stream them to a client.
+
+    If 'years' is given, only those years (as strings) are queried, e.g. to
+    produce one shard of the response.
+
+    If the corpus has a precomputed neighbor table that includes 'tok' (see
+    neighbor_table.py), the neighbors are read from it instead.
+
     Returns a dict of the following form: {<year>: [<neighboring word>, ...], ...}
     """
 
+    year_neighbors = lookup_neighbor_table(tok, corpus, neighbors, years=years)
+
+    if year_neighbors is not None:
+        if on_year is not None:
+            for year, word_neighbors in year_neighbors.items():
+                on_year(year, word_neighbors)
+
+        return year_neighbors
+
+    if NEIGHBOR_ENGINE != "gensim" and use_keyedvec:
+        word_neighbor_map = {}
+
+        def collect_year(year, year_result):
+            word_neighbor_map[year] = year_result[tok]
+
+            if on_year is not None:
+                on_year(year, word_neighbor_map[year])
+
+        with ExecTimer(verbose=True):
+            get_neighbor_engine(corpus).query(
+                [tok],
+                resolve_model_token,
+                topn=neighbors,
+                on_year=collect_year,
+                years=years,
+            )
+
+        return word_neighbor_map
+
     model_loader = (
         materialized_word_models if MATERIALIZE_MODELS else word_models_by_year
     )
@@ -417,14 +580,23 @@ def extract_neighbors(
                     for year, _, model in model_loader(
                         corpus=corpus, use_keyedvec=use_keyedvec
                     )
+                    if years is None or year in years
                 )
                 word_neighbor_map = dict(result)
+
+            # the years are all done at once here
+            if on_year is not None:
+                for year, year_neighbors in word_neighbor_map.items():
+                    on_year(year, year_neighbors)
         else:
             word_neighbor_map = {}
 
             for year, _, model in model_loader(
                 corpus=corpus, use_keyedvec=use_keyedvec
             ):
+                if years is not None and year not in years:
+                    continue
+
                 word_neighbor_map[year] = query_model_for_tok(
                     year,
                     tok,
@@ -433,4 +605,44 @@ def extract_neighbors(
                     use_keyedvec=use_keyedvec,
                 )
 
+                if on_year is not None:
+                    on_year(year, word_neighbor_map[year])
+
     return word_neighbor_map
+
+
+def extract_neighbors_batch(
+    toks,
+    corpus: str,
+    neighbors: int = 25,
+):
+    """
+    Like extract_neighbors(), but for each token in 'toks'.
+
+    Unless config.NEIGHBOR_ENGINE is 'gensim', all the tokens are answered
+    together, with a single pass over the year models (and a single matrix
+    product per year for the whole batch). Otherwise, each token is handled by
+    extract_neighbors() in turn. Either way, tokens in the corpus' precomputed
+    neighbor table are read from it instead.
+
+    Returns a dict of the following form:
+    {<tok>: {<year>: [<neighboring word>, ...], ...}, ...}
+    """
+    if NEIGHBOR_ENGINE == "gensim":
+        return {
+            tok: extract_neighbors(tok, corpus=corpus, neighbors=neighbors)
+            for tok in toks
+        }
+
+    tok_neighbors = {tok: lookup_neighbor_table(tok, corpus, neighbors) for tok in toks}
+    missing = [tok for tok, year_neighbors in tok_neighbors.items() if year_neighbors is None]
+
+    if missing:
+        with ExecTimer(verbose=True):
+            tok_neighbors.update(
+                get_neighbor_engine(corpus).query(
+                    missing, resolve_model_token, topn=neighbors
+                )
+            )
+
+    return tok_neighbors
@@ -0,0 +1,381 @@
+"""
+Quantized copies of the year models' normalized vectors.
+
+Each year model can have a float16 or int8 copy of its normalized vectors
+stored next to the model, as <model>.normed.float16.npy or
+<model>.normed.int8.npy (the latter with a per-row scale factor in
+<model>.normed.int8.scale.npy). When config.NEIGHBOR_ENGINE is 'quantized',
+the NeighborEngine scans the quantized copy to find a few candidate neighbors
+per query, then re-ranks the candidates by their exact scores, which are
+computed from just those rows of the float32 vectors. Since only the quantized
+copy is scanned, it's all that has to stay resident, which is half (float16)
+or a quarter (int8) of the size of the float32 vectors.
+
+Usage, from the server folder:
+  # build a quantized copy of every year model in a corpus
+  python -m backend.quantize build [--corpus pubtator] [--dtype int8] [--force]
+
+  # report how often the top neighbors match the exact search's, along with
+  # per-year latency and sizes, to choose config.QUANTIZED_CANDIDATES
+  python -m backend.quantize report [--corpus pubtator] [--dtype int8] [--candidates 50,100,200]
+"""
+
+import argparse
+import logging
+import os
+import sys
+from pathlib import Path
+from timeit import default_timer
+
+import numpy as np
+
+from .tracking import ExecTimer
+
+logging.basicConfig(stream=sys.stdout)
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+QUANTIZED_DTYPES = ("float16", "int8")
+
+# the number of rows that are quantized or scanned at once; bounds the size of
+# the float32 copy of each chunk and its (rows x batch) score matrix
+CHUNK_ROWS = 16384
+
+
+def quantized_vectors_path(model_path, dtype):
+    """
+    Returns the path of the 'dtype' copy of the normalized vectors that
+    accompanies the model at 'model_path'.
+    """
+    return Path("%s.normed.%s.npy" % (model_path, dtype))
+
+
+def quantized_scale_path(model_path):
+    """
+    Returns the path of the per-row scale factors of the int8 copy of the
+    normalized vectors that accompanies the model at 'model_path'.
+    """
+    return Path("%s.normed.int8.scale.npy" % model_path)
+
+
+def quantize_rows(rows, dtype):
+    """
+    Quantizes 'rows', a float32 matrix, to 'dtype'. Returns a pair of
+    (quantized rows, scale), where scale is None for float16 and otherwise a
+    float32 vector with the factor each row's int8 values are multiplied by to
+    approximate the original values.
+
+    >>> rows = np.array([[0.5, -0.25], [0.0, 0.0]], dtype=np.float32)
+    >>> quantized, scale = quantize_rows(rows, "int8")
+    >>> quantized.tolist(), scale.tolist()
+    ([[127, -64], [0, 0]], [0.003937007859349251, 1.0])
+    >>> quantize_rows(rows, "float16")[0].dtype
+    dtype('float16')
+    """
+    if dtype == "float16":
+        return rows.astype(np.float16), None
+
+    scale = np.abs(rows).max(axis=1) / 127
+    # all-zero rows get a scale of 1 rather than dividing by 0
+    scale[scale == 0] = 1
+    quantized = np.rint(rows / scale[:, None]).astype(np.int8)
+
+    return quantized, scale.astype(np.float32)
+
+
+def write_quantized_vectors(normed, model_path, dtype):
+    """
+    Writes the 'dtype' copy of 'normed', the (possibly memory-mapped)
+    normalized vectors of the model at 'model_path', a chunk at a time.
+    """
+    paths = [quantized_vectors_path(model_path, dtype)]
+    arrays = [
+        np.lib.format.open_memmap(
+            "%s.tmp.%d.npy" % (paths[0], os.getpid()),
+            mode="w+",
+            dtype=dtype,
+            shape=normed.shape,
+        )
+    ]
+
+    if dtype == "int8":
+        paths.append(quantized_scale_path(model_path))
+        arrays.append(
+            np.lib.format.open_memmap(
+                "%s.tmp.%d.npy" % (paths[1], os.getpid()),
+                mode="w+",
+                dtype=np.float32,
+                shape=(normed.shape[0],),
+            )
+        )
+
+    for start in range(0, normed.shape[0], CHUNK_ROWS):
+        chunk = np.asarray(normed[start : start + CHUNK_ROWS], dtype=np.float32)
+
+        for array, values in zip(arrays, quantize_rows(chunk, dtype)):
+            array[start : start + len(chunk)] = values
+
+    # write the scale first, so a vectors file is never without its scale
+    for path, array in reversed(list(zip(paths, arrays))):
+        array.flush()
+        os.replace(array.filename, path)
+
+
+def load_quantized_vectors(model_path, dtype, use_mmap=True):
+    """
+    Loads the 'dtype' copy of the normalized vectors of the model at
+    'model_path', memory-mapped if 'use_mmap' is true.
+
+    Returns None if there's no such copy, or if it's older than the model
+    file (i.e., it has to be rebuilt), in which case callers should use the
+    exact search.
+    """
+    vectors_path = quantized_vectors_path(model_path, dtype)
+
+    if not vectors_path.exists():
+        logger.warning("No %s vectors at %s, using exact search" % (dtype, vectors_path))
+        return None
+
+    if vectors_path.stat().st_mtime < Path(model_path).stat().st_mtime:
+        logger.warning(
+            "%s is older than the model, using exact search" % vectors_path
+        )
+        return None
+
+    mmap_mode = "r" if use_mmap else None
+
+    return QuantizedVectors(
+        np.load(vectors_path, mmap_mode=mmap_mode),
+        np.load(quantized_scale_path(model_path), mmap_mode=mmap_mode)
+        if dtype == "int8"
+        else None,
+    )
+
+
+class QuantizedVectors:
+    """
+    A quantized copy of a year model's normalized vectors, i.e. 'vectors',
+    with int8 rows multiplied by 'scale' to approximate the original values.
+    """
+
+    def __init__(self, vectors, scale=None):
+        self.vectors = vectors
+        self.scale = scale
+
+    @property
+    def nbytes(self):
+        return self.vectors.nbytes + (0 if self.scale is None else self.scale.nbytes)
+
+    def candidates(self, queries, k):
+        """
+        Returns a (len(queries) x k) matrix with the row indices of the 'k'
+        rows with the highest approximate scores against each of 'queries', a
+        (batch x dims) float32 matrix, in no particular order.
+
+        The rows are converted to float32 and scored a chunk at a time, so
+        only the quantized rows need to be resident.
+        """
+        n_rows = self.vectors.shape[0]
+        k = min(k, n_rows)
+
+        scores = np.empty((n_rows, len(queries)), dtype=np.float32)
+        chunk_buffer = np.empty((CHUNK_ROWS, self.vectors.shape[1]), dtype=np.float32)
+
+        for start in range(0, n_rows, CHUNK_ROWS):
+            chunk = self.vectors[start : start + CHUNK_ROWS]
+            # converts into the buffer, rather than allocating a new chunk
+            chunk_buffer[: len(chunk)] = chunk
+            chunk_scores = scores[start : start + len(chunk)]
+            np.matmul(chunk_buffer[: len(chunk)], queries.T, out=chunk_scores)
+
+            if self.scale is not None:
+                chunk_scores *= self.scale[start : start + len(chunk), None]
+
+        if k < n_rows:
+            return np.argpartition(-scores, k - 1, axis=0)[:k].T
+
+        return np.broadcast_to(np.arange(n_rows)[None, :], (len(queries), n_rows))
+
+
+# ========================================================================
+# === command line interface
+# ========================================================================
+
+
+def build(args):
+    from .engine import load_normed_vectors
+    from .neighbors import word_models_by_year
+
+    model_paths = {
+        year: model_path
+        for year, _, model_path in word_models_by_year(
+            corpus=args.corpus, just_reference=True
+        )
+    }
+
+    for year, _, model in word_models_by_year(corpus=args.corpus):
+        model_path = model_paths[year]
+        vectors_path = quantized_vectors_path(model_path, args.dtype)
+
+        if (
+            vectors_path.exists()
+            and vectors_path.stat().st_mtime >= Path(model_path).stat().st_mtime
+            and not args.force
+        ):
+            print("%s vectors for %s already exist, skipping" % (args.dtype, year), flush=True)
+            continue
+
+        with ExecTimer(verbose=True):
+            print(
+                "Writing %s vectors for %s (%s)..." % (args.dtype, year, model_path),
+                flush=True,
+            )
+            write_quantized_vectors(
+                load_normed_vectors(model_path, model), model_path, args.dtype
+            )
+
+
+def report(args):
+    from .engine import YearIndex
+    from .neighbors import word_models_by_year
+
+    candidate_counts = [int(x) for x in args.candidates.split(",")]
+    rng = np.random.default_rng(args.seed)
+
+    print(
+        "year,candidates,identical,recall_mean,recall_min,exact_ms,quantized_ms,"
+        "speedup,size_ratio",
+        flush=True,
+    )
+
+    # candidates => list of (fraction identical, recall_min), one per year
+    summary = {candidates: [] for candidates in candidate_counts}
+
+    model_paths = {
+        year: model_path
+        for year, _, model_path in word_models_by_year(
+            corpus=args.corpus, just_reference=True
+        )
+    }
+
+    for year, _, model in word_models_by_year(corpus=args.corpus):
+        year_index = YearIndex(
+            year, model_paths[year], model, quantized_dtype=args.dtype
+        )
+
+        if year_index.quantized is None:
+            continue
+
+        rows = rng.choice(
+            len(year_index.index_to_key),
+            size=min(args.sample, len(year_index.index_to_key)),
+            replace=False,
+        )
+
+        # time single-token queries, since that's what a /neighbors request does
+        start = default_timer()
+        exact = [year_index.search_exact([row], args.topn)[0][0] for row in rows]
+        exact_ms = (default_timer() - start) * 1000 / len(rows)
+
+        for candidates in candidate_counts:
+            year_index.quantized_candidates = candidates
+
+            start = default_timer()
+            approx = [
+                year_index.search_quantized([row], args.topn)[0][0] for row in rows
+            ]
+            quantized_ms = (default_timer() - start) * 1000 / len(rows)
+
+            # the neighbors match if they're the same, in the same order
+            identical = np.mean([np.array_equal(e, a) for e, a in zip(exact, approx)])
+            recalls = [
+                len(set(e[e >= 0].tolist()) & set(a[a >= 0].tolist()))
+                / max(1, (e >= 0).sum())
+                for e, a in zip(exact, approx)
+            ]
+            summary[candidates].append((identical, np.min(recalls)))
+
+            print(
+                "%s,%d,%.4f,%.4f,%.4f,%.2f,%.2f,%.1fx,%.2f"
+                % (
+                    year,
+                    candidates,
+                    identical,
+                    np.mean(recalls),
+                    np.min(recalls),
+                    exact_ms,
+                    quantized_ms,
+                    exact_ms / quantized_ms,
+                    year_index.quantized.nbytes / year_index.normed.nbytes,
+                ),
+                flush=True,
+            )
+
+    print("\ncandidates,worst_year_identical,worst_recall")
+    for candidates, results in summary.items():
+        if results:
+            print(
+                "%d,%.4f,%.4f"
+                % (
+                    candidates,
+                    min(i for i, _ in results),
+                    min(r for _, r in results),
+                )
+            )
+
+    acceptable = [
+        candidates
+        for candidates, results in summary.items()
+        if results and min(i for i, _ in results) >= args.threshold
+    ]
+    if acceptable:
+        print(
+            "\nFewest candidates with identical neighbors in >= %.2f of queries "
+            "in every year: %d" % (args.threshold, min(acceptable))
+        )
+    else:
+        print(
+            "\nNo candidate count had identical neighbors in >= %.2f of queries "
+            "in every year" % args.threshold
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Builds and evaluates quantized copies of the year models"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build_parser = subparsers.add_parser(
+        "build", help="write a quantized copy of each year model's vectors"
+    )
+    build_parser.add_argument("--corpus", default="pubtator")
+    build_parser.add_argument("--dtype", choices=QUANTIZED_DTYPES, default="int8")
+    build_parser.add_argument("--force", action="store_true", help="rewrite existing copies")
+    build_parser.set_defaults(func=build)
+
+    report_parser = subparsers.add_parser(
+        "report", help="compare the top neighbors and latency against the exact search"
+    )
+    report_parser.add_argument("--corpus", default="pubtator")
+    report_parser.add_argument("--dtype", choices=QUANTIZED_DTYPES, default="int8")
+    report_parser.add_argument("--candidates", default="50,100,200")
+    report_parser.add_argument("--topn", type=int, default=25)
+    report_parser.add_argument(
+        "--sample", type=int, default=200, help="tokens sampled per year"
+    )
+    report_parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.99,
+        help="minimum acceptable fraction of queries with identical neighbors",
+    )
+    report_parser.add_argument("--seed", type=int, default=0)
+    report_parser.set_defaults(func=report)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,278 @@
+"""
+A compact, memory-mappable table of strings (and optionally, a string value
+for each one), stored in a single file.
+
+The file layout is:
+- a fixed-size header: magic bytes, the number of entries, and flags
+- the key offsets, as (count + 1) little-endian int64s
+- the value offsets, as (count + 1) little-endian int64s (if it has values)
+- the UTF-8 encoded keys, concatenated
+- the UTF-8 encoded values, concatenated (if it has values)
+
+Key i occupies bytes [key_offsets[i], key_offsets[i+1]) of the key blob, and
+likewise for values.
+
+When the keys are written in sorted order, the table supports exact and
+prefix lookups via binary search directly against the mapped file, so opening
+a table costs nothing beyond the mmap() call, and multiple processes reading
+the same file share a single copy in the page cache.
+"""
+
+import bisect
+import mmap
+import os
+import struct
+import sys
+
+import numpy as np
+
+MAGIC = b"WLSTRTB1"
+HEADER = struct.Struct("<8sQQ")
+
+FLAG_SORTED = 0x1
+FLAG_HAS_VALUES = 0x2
+
+# utf-8 never produces this byte, so appending it to a prefix yields a string
+# that sorts after every string starting with that prefix
+PREFIX_END = b"\xff"
+
+
+class _KeyView:
+    """
+    Exposes a StringTable's encoded keys as a sequence, so that the
+    functions in bisect can search it without materializing the keys.
+    """
+
+    def __init__(self, table):
+        self.table = table
+
+    def __len__(self):
+        return len(self.table)
+
+    def __getitem__(self, idx):
+        return self.table.key_bytes(idx)
+
+
+class StringTable:
+    def __init__(self, buffer):
+        """
+        Wraps 'buffer', which contains a string table in the format described
+        in this module's docstring. 'buffer' can be a bytes object, an mmap, or a
+        memoryview of either.
+
+        Use StringTable.open() to map a table from a file, or
+        StringTable.from_strings() to build one in memory.
+        """
+        magic, count, flags = HEADER.unpack_from(buffer, 0)
+
+        if magic != MAGIC:
+            raise ValueError("Not a string table (bad magic %r)" % magic)
+
+        self.buffer = buffer
+        self.count = count
+        self.is_sorted = bool(flags & FLAG_SORTED)
+        self.has_values = bool(flags & FLAG_HAS_VALUES)
+
+        offset = HEADER.size
+        self.key_offsets = np.frombuffer(buffer, dtype="<i8", count=count + 1, offset=offset)
+        self._key_offsets = _int_view(buffer, self.key_offsets, offset)
+        offset += self.key_offsets.nbytes
+
+        if self.has_values:
+            self.value_offsets = np.frombuffer(
+                buffer, dtype="<i8", count=count + 1, offset=offset
+            )
+            self._value_offsets = _int_view(buffer, self.value_offsets, offset)
+            offset += self.value_offsets.nbytes
+        else:
+            self.value_offsets = self._value_offsets = None
+
+        self.keys_start = offset
+        self.values_start = offset + int(self.key_offsets[-1])
+
+    # ------------------------------------------------------------------------
+    # --- construction
+    # ------------------------------------------------------------------------
+
+    @staticmethod
+    def encode(keys, values=None, is_sorted=False):
+        """
+        Returns the bytes of a string table containing 'keys' and, if given,
+        the parallel sequence 'values'.
+
+        If 'is_sorted' is true, 'keys' must already be sorted (Python's default
+        string ordering matches the table's UTF-8 byte ordering) and the table
+        will support find() and prefix_range().
+        """
+        encoded_keys = [k.encode("utf8") for k in keys]
+
+        if is_sorted and any(a > b for a, b in zip(encoded_keys, encoded_keys[1:])):
+            raise ValueError("is_sorted was specified, but the keys aren't sorted")
+
+        flags = FLAG_SORTED if is_sorted else 0
+        sections = [_offsets_for(encoded_keys)]
+
+        if values is not None:
+            encoded_values = [v.encode("utf8") for v in values]
+
+            if len(encoded_values) != len(encoded_keys):
+                raise ValueError("keys and values must be the same length")
+
+            flags |= FLAG_HAS_VALUES
+            sections.append(_offsets_for(encoded_values))
+            blobs = [b"".join(encoded_keys), b"".join(encoded_values)]
+        else:
+            blobs = [b"".join(encoded_keys)]
+
+        return b"".join(
+            [HEADER.pack(MAGIC, len(encoded_keys), flags)]
+            + [x.tobytes() for x in sections]
+            + blobs
+        )
+
+    @classmethod
+    def from_strings(cls, keys, values=None, is_sorted=False):
+        """
+        Builds a StringTable in memory; see encode() for the arguments.
+        """
+        return cls(cls.encode(keys, values=values, is_sorted=is_sorted))
+
+    @classmethod
+    def write(cls, path, keys, values=None, is_sorted=False):
+        """
+        Writes a string table to 'path'; see encode() for the arguments.
+
+        The table is written to a temporary file which then replaces 'path',
+        so readers never observe a partially-written table.
+        """
+        write_atomically(path, cls.encode(keys, values=values, is_sorted=is_sorted))
+
+    @classmethod
+    def open(cls, path):
+        """
+        Memory-maps the string table at 'path' read-only.
+        """
+        with open(path, "rb") as fp:
+            return cls(mmap.mmap(fp.fileno(), length=0, access=mmap.ACCESS_READ))
+
+    # ------------------------------------------------------------------------
+    # --- access
+    # ------------------------------------------------------------------------
+
+    def __len__(self):
+        return self.count
+
+    def key_bytes(self, idx):
+        start = self.keys_start + self._key_offsets[idx]
+        end = self.keys_start + self._key_offsets[idx + 1]
+        return bytes(self.buffer[start:end])
+
+    def key(self, idx):
+        return self.key_bytes(idx).decode("utf8")
+
+    def value(self, idx):
+        if not self.has_values:
+            raise ValueError("This string table has no values")
+
+        start = self.values_start + self._value_offsets[idx]
+        end = self.values_start + self._value_offsets[idx + 1]
+        return bytes(self.buffer[start:end]).decode("utf8")
+
+    def keys(self, start=0, end=None):
+        """
+        Yields the keys at indices [start, end).
+        """
+        for idx in range(start, self.count if end is None else end):
+            yield self.key(idx)
+
+    def items(self, start=0, end=None):
+        """
+        Yields (key, value) pairs for indices [start, end).
+        """
+        for idx in range(start, self.count if end is None else end):
+            yield self.key(idx), self.value(idx)
+
+    # ------------------------------------------------------------------------
+    # --- lookups (sorted tables only)
+    # ------------------------------------------------------------------------
+
+    def _require_sorted(self):
+        if not self.is_sorted:
+            raise ValueError("Lookups require a table written with is_sorted=True")
+
+    def find(self, key: str):
+        """
+        Returns the index of 'key' in the table, or -1 if it's not present.
+        If 'key' occurs more than once, returns the index of the first one.
+        """
+        self._require_sorted()
+
+        target = key.encode("utf8")
+        idx = bisect.bisect_left(_KeyView(self), target)
+
+        return idx if idx < self.count and self.key_bytes(idx) == target else -1
+
+    def get(self, key: str, default=None):
+        """
+        Returns the value associated with 'key', or 'default' if it's not
+        present.
+        """
+        idx = self.find(key)
+        return self.value(idx) if idx >= 0 else default
+
+    def __contains__(self, key: str):
+        return self.find(key) >= 0
+
+    def __getitem__(self, key: str):
+        idx = self.find(key)
+
+        if idx < 0:
+            raise KeyError(key)
+
+        return self.value(idx)
+
+    def prefix_range(self, prefix: str):
+        """
+        Returns (start, end) such that the keys at indices [start, end) are
+        exactly the keys that start with 'prefix'.
+        """
+        self._require_sorted()
+
+        target = prefix.encode("utf8")
+        view = _KeyView(self)
+        start = bisect.bisect_left(view, target)
+        end = bisect.bisect_left(view, target + PREFIX_END, lo=start)
+
+        return start, end
+
+
+def _int_view(buffer, offsets, offset):
+    """
+    Returns the same values as 'offsets', a little-endian int64 array at
+    'offset' in 'buffer', as a sequence that indexes to plain ints, which
+    the lookups compare much faster than numpy scalars. The sequence is a
+    memoryview of 'buffer', or a list on big-endian machines.
+    """
+    if sys.byteorder != "little":
+        return offsets.tolist()
+
+    return memoryview(buffer)[offset : offset + offsets.nbytes].cast("q")
+
+
+def _offsets_for(encoded):
+    offsets = np.zeros(len(encoded) + 1, dtype="<i8")
+    np.cumsum([len(x) for x in encoded], out=offsets[1:])
+    return offsets
+
+
+def write_atomically(path, data: bytes):
+    """
+    Writes 'data' to a temporary file next to 'path', then moves it into
+    place, so that readers either see the old file or the complete new one.
+    """
+    tmp_path = "%s.tmp.%d" % (path, os.getpid())
+
+    with open(tmp_path, "wb") as fp:
+        fp.write(data)
+
+    os.replace(tmp_path, path)
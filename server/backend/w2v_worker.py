@@ -6,15 +6,35 @@ import sys
 
 import redis
 
-from rq import Connection, Worker
+from rq import Connection, Worker, get_current_job
 
-from .config import CORPORA_SET, MATERIALIZE_MODELS, WARM_CACHE
+from .cache import write_cached_neighbors
+from .config import (
+    CORPORA_SET,
+    MATERIALIZE_MODELS,
+    NEIGHBOR_ENGINE,
+    WARM_CACHE,
+    WORKER_CORPORA,
+    WORKER_YEARS,
+)
+from .jobs import (
+    QUEUE_NAME,
+    PartialResults,
+    notify_on_completion,
+    worker_queue_names,
+)
 from .neighbors import (
     cutoff_points,
     extract_frequencies,
     extract_neighbors,
+    extract_neighbors_batch,
     materialized_word_models,
     get_concept_id_mapper,
+    get_changepoint_index,
+    get_frequency_table,
+    get_model_decorations,
+    get_neighbor_engine,
+    get_neighbor_table,
 )
 from .tracking import ExecTimer
 
@@ -22,37 +42,191 @@ logging.basicConfig(stream=sys.stdout)
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+# the corpora this worker loads the models for; see config.WORKER_CORPORA
+worker_corpora = WORKER_CORPORA or list(CORPORA_SET.keys())
+
 
+@notify_on_completion
 def get_neighbors(tok: str, corpus: str):
-    with ExecTimer() as timer:
-        # Extract the frequencies
-        frequency_output = extract_frequencies(tok, corpus)
-        logger.info("finished extract_frequencies()...")
+    """
+    Produces the /neighbors response for 'tok' in 'corpus' and writes it to the
+    response cache.
+
+    The parts of the response are also published as they're computed (see
+    jobs.PartialResults), so that /neighbors/stream can send them on right
+    away.
+    """
+    r = redis.from_url(os.environ.get("REDIS_URL"))
+    job = get_current_job()
+    partials = PartialResults(r, job.id if job is not None else None)
+
+    try:
+        with ExecTimer() as timer:
+            # Extract the frequencies
+            frequency_output = extract_frequencies(tok, corpus)
+            logger.info("finished extract_frequencies()...")
+
+            # Extract Estimated Cutoff Points
+            changepoint_output = cutoff_points(tok, corpus)
+            logger.info("finished cutoff_points()...")
+
+            partials.publish(
+                {
+                    "type": "frequency",
+                    "frequency": frequency_output,
+                    "changepoints": changepoint_output,
+                }
+            )
+
+            # Extract the neighbors
+            with ExecTimer(verbose=True):
+                word_neighbor_map = extract_neighbors(
+                    tok,
+                    corpus=corpus,
+                    on_year=lambda year, neighbors: partials.publish(
+                        {"type": "neighbors", "year": year, "neighbors": neighbors}
+                    ),
+                )
+                logger.info("finished word_neighbor_map()...")
+
+            result = {
+                "neighbors": word_neighbor_map,
+                "frequency": frequency_output,
+                "changepoints": changepoint_output,
+                "elapsed": timer.snapshot(),
+            }
+
+        write_cached_neighbors(r, tok, corpus, result)
+        partials.publish({"type": "done", "elapsed": result["elapsed"]})
+
+        return result
+
+    except Exception as ex:
+        partials.publish({"type": "error", "detail": str(ex)})
+        raise
+
+
+@notify_on_completion
+def get_neighbors_shard(tok: str, corpus: str, years, with_frequency=False):
+    """
+    Produces the neighbors of 'tok' in 'corpus' for just the years in 'years',
+    i.e. one shard of the /neighbors response when config.YEAR_SHARDS is set,
+    along with the frequencies and changepoints if 'with_frequency' is true.
+    The API merges the shards (see jobs.merge_shard_results()) and caches the
+    response.
+
+    Like get_neighbors(), the parts are published as they're computed.
+    """
+    job = get_current_job()
+    partials = PartialResults(
+        redis.from_url(os.environ.get("REDIS_URL")), job.id if job is not None else None
+    )
+
+    try:
+        with ExecTimer() as timer:
+            result = {}
+
+            if with_frequency:
+                result["frequency"] = extract_frequencies(tok, corpus)
+                result["changepoints"] = cutoff_points(tok, corpus)
+
+                partials.publish({"type": "frequency", **result})
+
+            with ExecTimer(verbose=True):
+                result["neighbors"] = extract_neighbors(
+                    tok,
+                    corpus=corpus,
+                    on_year=lambda year, neighbors: partials.publish(
+                        {"type": "neighbors", "year": year, "neighbors": neighbors}
+                    ),
+                    years=set(years),
+                )
+                logger.info("finished word_neighbor_map() for years %s..." % years)
+
+            result["elapsed"] = timer.snapshot()
+
+        partials.publish({"type": "done", "elapsed": result["elapsed"]})
 
-        # Extract Estimated Cutoff Points
-        changepoint_output = cutoff_points(tok, corpus)
-        logger.info("finished cutoff_points()...")
+        return result
+
+    except Exception as ex:
+        partials.publish({"type": "error", "detail": str(ex)})
+        raise
+
+
+@notify_on_completion
+def get_neighbors_batch(toks, corpus: str):
+    """
+    Produces the same result as get_neighbors() for each token in 'toks',
+    querying the year models for all of them at once, and writes each token's
+    result to the /neighbors response cache.
+
+    Returns a dict of the form {<tok>: <get_neighbors() result>, ...}, where
+    each result's 'elapsed' is the time taken for the whole batch.
+    """
+    with ExecTimer() as timer:
+        frequency_outputs = {tok: extract_frequencies(tok, corpus) for tok in toks}
+        changepoint_outputs = {tok: cutoff_points(tok, corpus) for tok in toks}
+        logger.info("finished frequencies and changepoints for %d tokens..." % len(toks))
 
-        # Extract the neighbors
         with ExecTimer(verbose=True):
-            word_neighbor_map = extract_neighbors(tok, corpus=corpus)
-            logger.info("finished word_neighbor_map()...")
-
-        return {
-            "neighbors": word_neighbor_map,
-            "frequency": frequency_output,
-            "changepoints": changepoint_output,
-            "elapsed": timer.snapshot(),
+            word_neighbor_maps = extract_neighbors_batch(toks, corpus)
+            logger.info("finished extract_neighbors_batch()...")
+
+        elapsed = timer.snapshot()
+
+        results = {
+            tok: {
+                "neighbors": word_neighbor_maps[tok],
+                "frequency": frequency_outputs[tok],
+                "changepoints": changepoint_outputs[tok],
+                "elapsed": elapsed,
+            }
+            for tok in toks
         }
 
+        # write all the entries in one round trip
+        with redis.from_url(os.environ.get("REDIS_URL")).pipeline() as pipe:
+            for tok, result in results.items():
+                write_cached_neighbors(pipe, tok, corpus, result)
+            pipe.execute()
+
+        return results
+
 def load_concept_map():
     with ExecTimer(verbose=True):
-        # prepopulates concept_id_mapper_dict before anything requests it
+        # maps the concept map before anything requests it, so that the job
+        # processes rq forks off inherit it
         logger.info("Starting concept mapper load...")
         get_concept_id_mapper()
         logger.info("...concept loading done!")
 
 
+def load_frequency_tables():
+    # builds each corpus' frequency table up front, so that the job processes
+    # rq forks off inherit them rather than re-reading the frequency files
+    for corpus in worker_corpora:
+        with ExecTimer(verbose=True):
+            logger.info("Starting '%s' frequency table load..." % corpus)
+            get_frequency_table(corpus)
+            logger.info("...frequency table loading done!")
+
+
+def load_changepoints():
+    # (re)loads each corpus' changepoint index if it's missing or stale; called
+    # on startup and before each job is forked, so the job processes inherit an
+    # up-to-date index instead of each one reloading it themselves
+    for corpus in worker_corpora:
+        get_changepoint_index(corpus)
+
+
+class W2VWorker(Worker):
+    def execute_job(self, job, queue):
+        load_changepoints()
+        return super().execute_job(job, queue)
+
+
+@notify_on_completion
 def ping(response: str):
     return "pong! %s" % response
 
@@ -63,17 +237,44 @@ if __name__ == "__main__":
     # load the concept map
     load_concept_map()
 
+    # load the per-corpus token frequencies
+    load_frequency_tables()
+
+    # load the per-corpus changepoints
+    load_changepoints()
+
     # load all the year models
     if MATERIALIZE_MODELS and WARM_CACHE:
         # invoke to cache word models into 'word_models'
         logger.info("Warming enabled, preloading word2vec models...")
-        for corpus in CORPORA_SET.keys():
+        for corpus in worker_corpora:
             with ExecTimer(verbose=True):
                 logger.info("Materializing '%s' corpus" % corpus)
                 materialized_word_models(corpus=corpus)
 
+                if NEIGHBOR_ENGINE != "gensim":
+                    logger.info("Building '%s' neighbor engine" % corpus)
+                    get_neighbor_engine(corpus)
+
+                # maps the corpus' precomputed neighbors, if it has them
+                get_neighbor_table(corpus)
+
+                # maps (or writes) each year model's neighbor decorations
+                get_model_decorations(corpus)
+
     queues = sys.argv[1:] or ["default"]
 
+    if WORKER_CORPORA or WORKER_YEARS:
+        # a worker with only some of the models can't answer other jobs, so it
+        # only takes the jobs that are routed to the models it has
+        queues = worker_queue_names(WORKER_CORPORA, WORKER_YEARS)
+    elif QUEUE_NAME in queues:
+        # a worker with all the models also takes the jobs that are routed to
+        # any one corpus, so that it can help out the workers for that corpus
+        queues = worker_queue_names() + [q for q in queues if q != QUEUE_NAME]
+
+    logger.info("Taking jobs from %s" % queues)
+
     with Connection(redis.from_url(os.environ.get("REDIS_URL"))):
-        w = Worker(queues)
+        w = W2VWorker(queues)
         w.work()
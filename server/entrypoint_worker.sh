@@ -9,6 +9,9 @@ export REDIS_URL=${REDIS_URL:-redis://localhost:6379}
 export USE_MEMMAP=true
 export MATERIALIZE_MODELS=true
 export WARM_CACHE=true
+# answers neighbor queries with matrix products over each model's normalized
+# vectors, rather than calling most_similar() on each year model
+export NEIGHBOR_ENGINE=vectorized
 # we'll just be using one worker per VM, since disk bandwidth is the limiter it seems
 export PARALLELIZE_QUERY=false
 # export PARALLEL_POOLS=6
@@ -20,6 +23,13 @@ export PARALLELIZE_QUERY=false
 # export USE_INLINE_RQ=1
 # export RQ_CONCURRENCY=2
 
+# to split the models across VMs, set WORKER_CORPORA to the corpora this worker
+# should load, and/or WORKER_YEARS to one of the shards in the API's
+# YEAR_SHARDS; the worker then only takes the jobs for the models it has (see
+# jobs.worker_queue_names()) instead of those on w2v_queries
+# export WORKER_CORPORA=preprints
+# export WORKER_YEARS=2000-2007
+
 
 cd /app
 python -m backend.w2v_worker w2v_queries
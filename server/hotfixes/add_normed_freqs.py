@@ -1,20 +1,24 @@
 #!/usr/local/bin/python
 
 import sys
-import json
 import logging
 import re
 from pathlib import Path
 
-import pandas as pd
-import plydata as ply
 import redis
 from tqdm import tqdm
 
 # patch the server code path into the pythonpath
 sys.path.append(str(Path('..').resolve()))
 
+from backend.cache import (
+    decode_response,
+    encode_response,
+    neighbors_cache_key,
+    rename_cached_neighbors,
+)
 from backend.config import CORPORA_SET
+from backend.frequencies import FREQUENCY_FILES, load_frequency_table
 from backend.tracking import ExecTimer
 
 logger = logging.getLogger(__name__)
@@ -27,36 +31,18 @@ DRY_RUN = False
 # if true, forces rewriting frequencies even if the entry appears to be up-to-date
 FORCE_REWRITE_FREQS = False
 
-corpus_paths = {
-    "pubtator": data_folder / Path("all_pubtator_tok_frequency.tsv.xz"),
-    "preprints": data_folder / Path("all_preprint_tok_frequency.tsv.xz"),
-}
-
 with ExecTimer(verbose=True):
     print("Loading corpora...")
-    frequency_tables_ungropued = {
-        corpus: (
-            pd.read_csv(corpus_paths[corpus], sep="\t")
-            >> ply.group_by("year")
-            >> ply.define(total="sum(word_count)")
-            >> ply.ungroup()
-        )
-        for corpus in corpus_paths
+    # memory-maps the columnar frequency tables if they've been built (see
+    # backend/frequencies.py), otherwise builds them from the .tsv.xz files
+    frequency_tables = {
+        corpus: load_frequency_table(corpus, data_folder)
+        for corpus in FREQUENCY_FILES
     }
     print("done!")
 
 def extract_frequencies(tok: str, corpus: str):
-    frequency_output_df = (
-        frequency_tables_ungropued[corpus]
-        >> ply.query("tok == @tok")
-        >> ply.define(normalized="word_count/total") 
-        >> ply.select("year", "word_count", "normalized")
-        >> ply.arrange("year")
-        >> ply.rename({"frequency": "word_count", "normalized_frequency": "normalized"})
-        >> ply.call(".astype", {"year": int, "frequency": int, "normalized_frequency": float})
-    )
-
-    return frequency_output_df >> ply.call(".to_dict", orient="records")
+    return frequency_tables[corpus].lookup(tok)
 
 
 def main():
@@ -81,7 +67,7 @@ def main():
 
     with ExecTimer(verbose=True):
         for cached_key in tqdm(r.scan_iter('wlc:*'), total=total_recs):
-            decoded = json.loads(r.get(cached_key))
+            decoded = decode_response(r.get(cached_key))
 
             try:
                 tok, corpus = re.match(
@@ -97,9 +83,10 @@ def main():
             # if so, rename the key and continue
             if corpus in corpora_labels_to_ids:
                 old_key = cached_key
-                cached_key = str(cached_key).replace(corpus, corpora_labels_to_ids[corpus])
+                cached_key = neighbors_cache_key(tok, corpora_labels_to_ids[corpus])
+                # keeps the cached entry counts in step with the rename
+                rename_cached_neighbors(r, tok, corpus, corpora_labels_to_ids[corpus])
                 corpus = corpora_labels_to_ids[corpus]
-                r.rename(old_key, cached_key)
                 renames += 1
                 tqdm.write("Corrected corpus label; %s => %s" % (old_key, cached_key))
 
@@ -121,7 +108,7 @@ def main():
             corrections += 1
 
             if not DRY_RUN:
-                r.set(cached_key, json.dumps(decoded))
+                r.set(cached_key, encode_response(decoded), keepttl=True)
 
     print("Corrections: %d" % corrections)
     print("Skipped due to missing key: %d" % skips)
@@ -0,0 +1,89 @@
+#!/usr/local/bin/python
+
+# re-encodes the /neighbors responses that were cached as JSON into the
+# compact encoding the API now uses (see backend/cache.py), keeping each
+# entry's expiry. the API reads both encodings, so this can run while it's
+# serving requests, and can be stopped and re-run at any time.
+
+import sys
+from pathlib import Path
+
+import redis
+from tqdm import tqdm
+
+# patch the server code path into the pythonpath
+sys.path.append(str(Path('..').resolve()))
+
+from backend.cache import (
+    CACHE_PREFIX,
+    decode_response,
+    encode_response,
+    is_legacy_value,
+)
+from backend.tracking import ExecTimer
+
+# if true, reports the savings without writing back to the cache
+DRY_RUN = False
+# number of keys read and written per round trip
+BATCH_SIZE = 500
+
+
+def batches(iterable, size):
+    batch = []
+    for x in iterable:
+        batch.append(x)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def main():
+    r = redis.Redis(host='localhost', port=6379)
+
+    converted = 0
+    already_compact = 0
+    bytes_before = 0
+    bytes_after = 0
+
+    if DRY_RUN:
+        print("DRY_RUN enabled, cache won't be modified")
+
+    with ExecTimer(verbose=True):
+        keys = r.scan_iter("%s:*" % CACHE_PREFIX, count=BATCH_SIZE)
+
+        for batch in batches(tqdm(keys), BATCH_SIZE):
+            values = r.mget(batch)
+
+            with r.pipeline(transaction=False) as pipe:
+                for key, value in zip(batch, values):
+                    if value is None:
+                        continue
+
+                    if not is_legacy_value(value):
+                        already_compact += 1
+                        continue
+
+                    encoded = encode_response(decode_response(value))
+                    bytes_before += len(value)
+                    bytes_after += len(encoded)
+                    converted += 1
+
+                    # overwriting a key keeps its LFU counter, and KEEPTTL its
+                    # expiry; XX skips entries that were evicted in the meantime
+                    pipe.set(key, encoded, keepttl=True, xx=True)
+
+                if not DRY_RUN:
+                    pipe.execute()
+
+    print("Converted: %d" % converted)
+    print("Already compact: %d" % already_compact)
+    print(
+        "Bytes before: %d, after: %d (%.1fx smaller)"
+        % (bytes_before, bytes_after, bytes_before / max(1, bytes_after))
+    )
+
+
+if __name__ == '__main__':
+    main()
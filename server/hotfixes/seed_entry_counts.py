@@ -0,0 +1,34 @@
+#!/usr/local/bin/python
+
+# counts the cached /neighbors responses in total and per corpus, and writes
+# the counts that the API otherwise maintains as entries are cached and removed
+# (see backend/cache.py). only needs to be run once, to seed the counts for a
+# cache that was populated before they were maintained, or if they've drifted.
+
+import sys
+from pathlib import Path
+
+import redis
+
+# patch the server code path into the pythonpath
+sys.path.append(str(Path('..').resolve()))
+
+from backend.cache import RECOUNT_ENTRIES_SCRIPT, parse_recount, recount_entries
+from backend.tracking import ExecTimer
+
+
+def main():
+    r = redis.Redis(host='localhost', port=6379)
+
+    with ExecTimer(verbose=True):
+        print("Counting cached entries...")
+        counts = parse_recount(
+            recount_entries(r.register_script(RECOUNT_ENTRIES_SCRIPT))
+        )
+
+    for key, count in counts.items():
+        print("%s: %d" % (key, count))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+# compares finding a token's neighbors with gensim's most_similar(), called on
+# each year model in turn, against the vectorized NeighborEngine (see
+# backend/engine.py). reports the time each takes per token, and checks that
+# both produce the same neighbors in the same order.
+#
+# run from the server folder, e.g.:
+#   python profiling/bench_neighbor_engine.py --corpus pubtator mouse pandemic
+
+import argparse
+import logging
+import sys
+from pathlib import Path
+from timeit import default_timer
+
+# patch the server code path into the pythonpath
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from backend.neighbors import (
+    get_neighbor_engine,
+    materialized_word_models,
+    resolve_model_token,
+)
+
+
+def per_year_loop(tok, models, topn):
+    result = {}
+
+    for year, _, model in models:
+        model_tok = resolve_model_token(tok, model.key_to_index)
+        result[year] = (
+            model.most_similar(model_tok, topn=topn) if model_tok is not None else []
+        )
+
+    return result
+
+
+def timed(func, *args, **kwargs):
+    start = default_timer()
+    result = func(*args, **kwargs)
+    return default_timer() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("toks", nargs="+", help="tokens to query")
+    parser.add_argument("--corpus", default="pubtator")
+    parser.add_argument("--topn", type=int, default=25)
+    args = parser.parse_args()
+
+    logging.getLogger("backend.neighbors").setLevel(logging.WARNING)
+
+    print("Loading models and building engine...", flush=True)
+    models = materialized_word_models(corpus=args.corpus)
+    engine = get_neighbor_engine(args.corpus)
+
+    # warm up both paths, so the first token doesn't pay for page faults
+    per_year_loop(args.toks[0], models, args.topn)
+    engine.query(args.toks[:1], resolve_model_token, topn=args.topn)
+
+    print("tok,loop_ms,engine_ms,speedup,mismatched_years,max_score_diff")
+
+    for tok in args.toks:
+        loop_secs, expected = timed(per_year_loop, tok, models, args.topn)
+        engine_secs, actual = timed(
+            engine.query, [tok], resolve_model_token, topn=args.topn
+        )
+        actual = actual[tok]
+
+        mismatched_years = [
+            year
+            for year in expected
+            if [k for k, _ in expected[year]] != [k for k, _ in actual[year]]
+        ]
+        max_score_diff = max(
+            (
+                abs(a - b)
+                for year in expected
+                for (_, a), (_, b) in zip(expected[year], actual[year])
+            ),
+            default=0.0,
+        )
+
+        print(
+            "%s,%.1f,%.1f,%.1fx,%s,%.2e"
+            % (
+                tok,
+                loop_secs * 1000,
+                engine_secs * 1000,
+                loop_secs / engine_secs,
+                "|".join(mismatched_years) or "none",
+                max_score_diff,
+            )
+        )
+
+    # the engine answers a batch of tokens with one matrix product per year
+    batch_secs, _ = timed(engine.query, args.toks, resolve_model_token, topn=args.topn)
+    print(
+        "batch of %d tokens: %.1f ms (%.1f ms/token)"
+        % (len(args.toks), batch_secs * 1000, batch_secs * 1000 / len(args.toks))
+    )
+
+
+if __name__ == "__main__":
+    main()
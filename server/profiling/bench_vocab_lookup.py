@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+# compares the cost of checking whether a token is in a year model's vocabulary
+# by building a set of the model's keys (what query_model_for_tok() used to do
+# on every call) against resolving it directly via the model's key_to_index
+# dict (see neighbors.resolve_model_token()).
+#
+# run from the server folder, e.g.:
+#   python profiling/bench_vocab_lookup.py --corpus pubtator mouse mesh_d003920
+# or, without the models available, against a synthetic vocabulary:
+#   python profiling/bench_vocab_lookup.py --synthetic-vocab 500000 mouse
+
+import argparse
+import logging
+import sys
+from pathlib import Path
+from timeit import Timer
+
+# patch the server code path into the pythonpath
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from backend.neighbors import resolve_model_token, word_models_by_year
+
+
+def set_based_lookup(tok, key_to_index):
+    # the previous implementation, kept here as the baseline
+    vocab = set(key_to_index.keys())
+
+    if tok.startswith("mesh_"):
+        tok = (
+            f"disease_{tok}"
+            if f"disease_{tok}" in vocab
+            else f"chemical_{tok}"
+            if f"chemical_{tok}" in vocab
+            else tok
+        )
+
+    return tok if tok in vocab else None
+
+
+def time_per_call(func, repeat, number):
+    return min(Timer(func).repeat(repeat=repeat, number=number)) / number
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("toks", nargs="+", help="tokens to look up")
+    parser.add_argument("--corpus", default="pubtator")
+    parser.add_argument(
+        "--synthetic-vocab",
+        type=int,
+        default=0,
+        help="if nonzero, benchmarks a synthetic vocabulary of this size instead of the models",
+    )
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--number", type=int, default=10)
+    args = parser.parse_args()
+
+    # resolve_model_token() logs remapped mesh tokens, which would swamp the output
+    logging.getLogger("backend.neighbors").setLevel(logging.WARNING)
+
+    if args.synthetic_vocab:
+        key_to_index = {"tok_%d" % i: i for i in range(args.synthetic_vocab)}
+        key_to_index.update({tok: len(key_to_index) + i for i, tok in enumerate(args.toks)})
+        vocabs = [("synthetic", key_to_index)]
+    else:
+        vocabs = [
+            (year, model.key_to_index)
+            for year, _, model in word_models_by_year(corpus=args.corpus)
+        ]
+
+    print("year,vocab_size,set_based_us,key_to_index_us,speedup")
+
+    total_before, total_after = 0, 0
+
+    for year, key_to_index in vocabs:
+        before = sum(
+            time_per_call(lambda: set_based_lookup(tok, key_to_index), args.repeat, args.number)
+            for tok in args.toks
+        )
+        after = sum(
+            time_per_call(lambda: resolve_model_token(tok, key_to_index), args.repeat, args.number * 1000)
+            for tok in args.toks
+        )
+        total_before += before
+        total_after += after
+
+        print(
+            "%s,%d,%.1f,%.3f,%.0fx"
+            % (year, len(key_to_index), before * 1e6, after * 1e6, before / after)
+        )
+
+    print(
+        "total per request: %.1f ms => %.3f ms" % (total_before * 1e3, total_after * 1e3)
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+import json
+
+import numpy as np
+import pytest
+
+from backend.cache import (
+    ENCODING_VERSION,
+    decode_response,
+    encode_columnar,
+    encode_response,
+    response_json,
+)
+
+
+def make_response(scores):
+    return {
+        "neighbors": {
+            "2000": [
+                {"token": "cancer", "tag_id": "disease_mesh_d009369", "score": scores[0]},
+                {"token": "tumor", "tag_id": None, "score": scores[1]},
+            ],
+            "2001": [],
+            "2002": [{"token": "cancer", "tag_id": "disease_mesh_d009369", "score": scores[2]}],
+        },
+        "frequency": [
+            {"year": 2000, "frequency": 12, "normalized_frequency": 1.5e-06},
+            {"year": 2001, "frequency": 3, "normalized_frequency": 2.25e-07},
+        ],
+        "changepoints": [["2000", "2001"]],
+        "elapsed": 123.4,
+    }
+
+
+def test_round_trip_float32_scores():
+    # the scores the models produce are float32s widened to floats
+    result = make_response([float(np.float32(x)) for x in (0.91, 0.5, 0.25)])
+
+    value = encode_response(result)
+
+    assert value[:1] == ENCODING_VERSION
+    assert encode_columnar(result)["score_type"] == "f"
+    assert decode_response(value) == result
+    assert list(decode_response(value)) == list(result)
+
+
+def test_round_trip_float64_fallback():
+    # 0.1 isn't exactly representable as a float32, so the scores are kept
+    # as float64 rather than losing precision
+    result = make_response([0.1, 0.2, 0.3])
+
+    assert encode_columnar(result)["score_type"] == "d"
+    assert decode_response(encode_response(result)) == result
+
+
+@pytest.mark.parametrize(
+    "result",
+    [
+        # neighbors with extra fields
+        {"neighbors": {"2000": [{"token": "a", "tag_id": None, "score": 0.5, "x": 1}]}},
+        # integer scores
+        {"neighbors": {"2000": [{"token": "a", "tag_id": None, "score": 1}]}},
+        # frequency records with different fields
+        {"neighbors": {}, "frequency": [{"year": 2000}, {"frequency": 1}]},
+        # no neighbors at all
+        {"detail": "not found"},
+    ],
+)
+def test_round_trip_unexpected_shapes(result):
+    assert encode_columnar(result) is None
+    assert decode_response(encode_response(result)) == result
+
+
+def test_legacy_json_values():
+    result = make_response([0.1, 0.2, 0.3])
+    value = json.dumps(result).encode("utf8")
+
+    assert decode_response(value) == result
+    # legacy values are already the JSON body
+    assert response_json(value) is value
+
+
+def test_response_json_matches_result():
+    result = make_response([float(np.float32(x)) for x in (0.91, 0.5, 0.25)])
+
+    assert json.loads(response_json(encode_response(result))) == result
+
+
+def test_unknown_encoding():
+    with pytest.raises(ValueError):
+        decode_response(b"\x7fnot a response")
@@ -0,0 +1,164 @@
+import os
+
+import numpy as np
+import pytest
+
+from backend.engine import NeighborEngine, top_k
+
+
+class SyntheticModel:
+    """
+    Stands in for a gensim KeyedVectors instance, with just the parts the
+    NeighborEngine reads, plus a most_similar() computed the way gensim's is.
+    """
+
+    def __init__(self, keys, vectors):
+        self.index_to_key = list(keys)
+        self.key_to_index = {key: idx for idx, key in enumerate(keys)}
+        self.vectors = vectors
+
+    def get_normed_vectors(self):
+        return self.vectors / np.linalg.norm(self.vectors, axis=1, keepdims=True)
+
+    def most_similar(self, key, topn):
+        normed = self.get_normed_vectors()
+        idx = self.key_to_index[key]
+        query = normed[idx] / np.linalg.norm(normed[idx])
+        scores = normed @ query
+
+        return [
+            (self.index_to_key[other], float(scores[other]))
+            for other in np.argsort(-scores, kind="stable")
+            if other != idx
+        ][:topn]
+
+
+def resolve(tok, key_to_index):
+    return tok if tok in key_to_index else None
+
+
+@pytest.fixture
+def models(tmp_path):
+    rng = np.random.default_rng(0)
+
+    return [
+        (
+            year,
+            str(tmp_path / ("%d.model" % year)),
+            SyntheticModel(
+                ["tok%d" % i for i in range(n_keys)],
+                rng.standard_normal((n_keys, 16)).astype(np.float32),
+            ),
+        )
+        for year, n_keys in ((2000, 200), (2001, 150))
+    ]
+
+
+def test_top_k_excludes_query_row():
+    scores = np.array([[0.9, 0.1], [0.5, 0.8], [0.7, 0.3], [0.2, 0.95]])
+
+    ids, top_scores = top_k(scores, 2, exclude=[0, 3])
+
+    assert ids.tolist() == [[2, 1], [1, 2]]
+    assert top_scores.tolist() == [[0.7, 0.5], [0.8, 0.3]]
+
+
+def test_top_k_pads_missing_rows():
+    ids, _ = top_k(np.array([[0.1], [0.2]]), 3, exclude=[1])
+
+    assert ids.tolist() == [[0, -1, -1]]
+
+
+@pytest.mark.parametrize("topn", [1, 10, 25])
+def test_query_matches_most_similar(models, topn):
+    engine = NeighborEngine.from_models(models)
+    toks = ["tok0", "tok7", "tok149", "tok199"]
+
+    result = engine.query(toks, resolve, topn=topn)
+
+    for year, _, model in models:
+        for tok in toks:
+            if tok not in model.key_to_index:
+                assert result[tok][year] == []
+                continue
+
+            expected = model.most_similar(tok, topn=topn)
+            neighbors = result[tok][year]
+
+            assert [key for key, _ in neighbors] == [key for key, _ in expected]
+            assert [score for _, score in neighbors] == pytest.approx(
+                [score for _, score in expected], abs=1e-6
+            )
+            assert tok not in [key for key, _ in neighbors]
+
+
+def test_query_matches_gensim(tmp_path):
+    gensim_models = pytest.importorskip("gensim.models")
+
+    rng = np.random.default_rng(1)
+    model = gensim_models.KeyedVectors(vector_size=16)
+    model.add_vectors(
+        ["tok%d" % i for i in range(100)],
+        rng.standard_normal((100, 16)).astype(np.float32),
+    )
+
+    engine = NeighborEngine.from_models([(2000, str(tmp_path / "2000.model"), model)])
+    neighbors = engine.query(["tok3"], resolve, topn=25)["tok3"][2000]
+    expected = model.most_similar("tok3", topn=25)
+
+    assert [key for key, _ in neighbors] == [key for key, _ in expected]
+    assert [score for _, score in neighbors] == pytest.approx(
+        [score for _, score in expected], abs=1e-6
+    )
+
+
+def test_query_reports_years_and_calls_on_year(models):
+    engine = NeighborEngine.from_models(models)
+    seen = []
+
+    result = engine.query(
+        ["tok0", "missing"],
+        resolve,
+        topn=5,
+        on_year=lambda year, year_result: seen.append((year, sorted(year_result))),
+        years={2001},
+    )
+
+    assert seen == [(2001, ["missing", "tok0"])]
+    assert list(result["tok0"]) == [2001]
+    assert result["missing"] == {2001: []}
+
+
+def test_normed_vectors_follow_model(models):
+    year, model_path, model = models[0]
+    open(model_path, "w").close()
+
+    engine = NeighborEngine.from_models([(year, model_path, model)])
+    assert len(engine.year_indices[0].normed) == 200
+
+    # the model is replaced by one with a different vocabulary
+    rng = np.random.default_rng(2)
+    replaced = SyntheticModel(
+        ["new%d" % i for i in range(50)], rng.standard_normal((50, 16)).astype(np.float32)
+    )
+    engine = NeighborEngine.from_models([(year, model_path, replaced)])
+
+    neighbors = engine.query(["new0"], resolve, topn=5)["new0"][year]
+    assert [key for key, _ in neighbors] == [
+        key for key, _ in replaced.most_similar("new0", topn=5)
+    ]
+
+
+def test_normed_vectors_rewritten_when_older_than_model(models):
+    year, model_path, model = models[0]
+    open(model_path, "w").close()
+    NeighborEngine.from_models([(year, model_path, model)])
+
+    # same vocabulary, new vectors, and a model file newer than the matrix
+    model.vectors = model.vectors[::-1].copy()
+    normed_path = model_path + ".normed.npy"
+    os.utime(normed_path, (0, 0))
+
+    engine = NeighborEngine.from_models([(year, model_path, model)])
+
+    assert np.allclose(engine.year_indices[0].normed, model.get_normed_vectors())
@@ -0,0 +1,116 @@
+import json
+
+import pandas as pd
+import pytest
+
+from backend.frequencies import COLUMNS, MANIFEST_FILE, FrequencyTable
+
+ROWS = [
+    ("mouse", 2001, 5),
+    ("mouse", 2000, 3),
+    ("cancer", 2000, 10),
+    ("cancer", 2002, 1),
+    ("café", 2001, 7),
+    ("null", 2002, 2),
+    ("zebra", 2000, 4),
+]
+
+
+def old_lookup(path, tok):
+    """
+    The per-job computation that FrequencyTable replaced: reads the whole
+    file, normalizes the word counts by each year's total, and picks out the
+    rows for 'tok'.
+    """
+    frame = pd.read_csv(path, sep="\t")
+    frame["total"] = frame.groupby("year")["word_count"].transform("sum")
+
+    rows = frame[frame.tok == tok].assign(normalized=lambda x: x.word_count / x.total)
+
+    return (
+        rows[["year", "word_count", "normalized"]]
+        .sort_values("year")
+        .rename(columns={"word_count": "frequency", "normalized": "normalized_frequency"})
+        .astype({"year": int, "frequency": int, "normalized_frequency": float})
+        .to_dict(orient="records")
+    )
+
+
+@pytest.fixture
+def frequency_file(tmp_path):
+    path = tmp_path / "tok_frequency.tsv.xz"
+    pd.DataFrame(ROWS, columns=["tok", "year", "word_count"]).to_csv(
+        path, sep="\t", index=False
+    )
+    return path
+
+
+@pytest.fixture(params=["built", "loaded"])
+def table(request, frequency_file, tmp_path):
+    table = FrequencyTable.from_tsv(frequency_file)
+
+    if request.param == "loaded":
+        table.save(tmp_path / "cols")
+        table = FrequencyTable.load(tmp_path / "cols")
+
+    return table
+
+
+@pytest.mark.parametrize("tok", ["mouse", "cancer", "café", "zebra", "missing"])
+def test_lookup_matches_old_computation(table, frequency_file, tok):
+    expected = old_lookup(frequency_file, tok)
+    result = table.lookup(tok)
+
+    assert [(x["year"], x["frequency"]) for x in result] == [
+        (x["year"], x["frequency"]) for x in expected
+    ]
+    assert [x["normalized_frequency"] for x in result] == pytest.approx(
+        [x["normalized_frequency"] for x in expected]
+    )
+    assert all(
+        type(x["year"]) is int
+        and type(x["frequency"]) is int
+        and type(x["normalized_frequency"]) is float
+        for x in result
+    )
+
+
+def test_lookup_keeps_words_pandas_reads_as_missing(table):
+    # the old computation read 'null' as NaN, so it never found it
+    assert table.lookup("null") == [
+        {"year": 2002, "frequency": 2, "normalized_frequency": pytest.approx(2 / 3)}
+    ]
+
+
+def test_total_counts(table):
+    assert dict(zip(table.tokens.keys(), table.total_counts().tolist())) == {
+        "cancer": 11,
+        "café": 7,
+        "mouse": 8,
+        "null": 2,
+        "zebra": 4,
+    }
+
+
+def test_save_replaces_generations(frequency_file, tmp_path):
+    table = FrequencyTable.from_tsv(frequency_file)
+    folder = tmp_path / "cols"
+
+    for _ in range(3):
+        table.save(folder)
+
+    # the current generation and the one it replaced, plus the manifest
+    assert len(list(folder.iterdir())) == 2 * (len(COLUMNS) + 1) + 1
+    assert FrequencyTable.load(folder).lookup("mouse") == table.lookup("mouse")
+
+
+def test_load_rejects_mismatched_files(frequency_file, tmp_path):
+    table = FrequencyTable.from_tsv(frequency_file)
+    table.save(tmp_path / "cols")
+
+    manifest = json.loads((tmp_path / "cols" / MANIFEST_FILE).read_text())
+    manifest["tokens"] += 1
+    (tmp_path / "cols" / MANIFEST_FILE).write_text(json.dumps(manifest))
+
+    with pytest.raises(ValueError):
+        FrequencyTable.load(tmp_path / "cols")
@@ -0,0 +1,94 @@
+import pytest
+
+from backend.strtable import StringTable
+
+UNICODE_KEYS = sorted(
+    ["", "a", "ab", "abc", "café", "cafe", "caffè", "naïve", "straße", "中文", "中国", "😀"]
+)
+
+
+@pytest.fixture(params=["memory", "file"])
+def make_table(request, tmp_path):
+    def make(keys, values=None, is_sorted=True):
+        if request.param == "memory":
+            return StringTable.from_strings(keys, values=values, is_sorted=is_sorted)
+
+        path = tmp_path / "table.strtab"
+        StringTable.write(path, keys, values=values, is_sorted=is_sorted)
+        return StringTable.open(path)
+
+    return make
+
+
+def test_find_unicode(make_table):
+    table = make_table(UNICODE_KEYS, values=[key.upper() for key in UNICODE_KEYS])
+
+    for idx, key in enumerate(UNICODE_KEYS):
+        assert table.find(key) == idx
+        assert table.key(idx) == key
+        assert table[key] == key.upper()
+
+    for key in ["caf", "cafés", "中", "😀😀", "ß"]:
+        assert table.find(key) == -1
+        assert key not in table
+        assert table.get(key, "missing") == "missing"
+
+
+def test_find_duplicates_returns_first(make_table):
+    table = make_table(["a", "b", "b", "c"])
+
+    assert table.find("b") == 1
+
+
+@pytest.mark.parametrize(
+    "prefix",
+    ["", "a", "ab", "abcd", "caf", "café", "c", "中", "中文", "😀", "ø", "￿"],
+)
+def test_prefix_range_unicode(make_table, prefix):
+    table = make_table(UNICODE_KEYS)
+
+    start, end = table.prefix_range(prefix)
+
+    assert list(table.keys(start, end)) == [
+        key for key in UNICODE_KEYS if key.startswith(prefix)
+    ]
+
+
+def test_empty_table(make_table):
+    table = make_table([], values=[])
+
+    assert len(table) == 0
+    assert table.find("") == -1
+    assert table.find("a") == -1
+    assert "a" not in table
+    assert table.prefix_range("") == (0, 0)
+    assert table.prefix_range("a") == (0, 0)
+    assert list(table.items()) == []
+
+    with pytest.raises(KeyError):
+        table["a"]
+
+
+def test_unsorted_table(make_table):
+    keys = ["b", "a", "é"]
+    table = make_table(keys, values=["2", "1", "3"], is_sorted=False)
+
+    assert list(table.items()) == [("b", "2"), ("a", "1"), ("é", "3")]
+
+    with pytest.raises(ValueError):
+        table.find("a")
+
+    with pytest.raises(ValueError):
+        table.prefix_range("a")
+
+
+def test_unsorted_keys_rejected():
+    with pytest.raises(ValueError):
+        StringTable.from_strings(["b", "a"], is_sorted=True)
+
+
+def test_table_without_values():
+    table = StringTable.from_strings(["a"], is_sorted=True)
+
+    with pytest.raises(ValueError):
+        table.value(0)
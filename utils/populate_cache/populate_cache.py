@@ -1,10 +1,13 @@
 #!/usr/bin/env python
 
 from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 import logging
 import os
-import grequests as grq
+import random
+import time
 import requests as rq
+from requests.adapters import HTTPAdapter
 from tqdm import tqdm
 
 # list of words with which to populate the cache
@@ -15,14 +18,40 @@ CORPUS = os.environ.get('CORPUS', 'abstracts').strip()
 # remove possible trailing slash so we can construct URLs more easily
 SERVER_URL = os.environ.get('SERVER_URL', 'https://api-wl.greenelab.com').rstrip('/')
 
-# RQ_CONCURRENCY is the number of parallel workers that'll be hitting the API
-# it should be at most the number of workers, and ideally a bit less to provide
-# service to user requests, too
+# RQ_CONCURRENCY is the most parallel requests that'll be hitting the API.
+# the number actually in flight is adjusted as we go (see adjust_concurrency()),
+# but never goes above this
 RQ_CONCURRENCY = int(os.environ.get('RQ_CONCURRENCY', 1))
 
-# if true, attempts to read RQ_CONCURRENCY from server meta config block
-# if false, uses the env var RQ_CONCURRENCY or 1 if not provided
-USE_SERVER_CONCURRENCY=False
+# if true, RQ_CONCURRENCY is instead capped by the number of workers the
+# server reports, less WORKER_RESERVE of them to provide service to user
+# requests, too
+USE_SERVER_CONCURRENCY = os.environ.get('USE_SERVER_CONCURRENCY', '').lower() in ('1', 'true', 'yes')
+WORKER_RESERVE = int(os.environ.get('WORKER_RESERVE', 1))
+
+# how often the server's worker count and queue depth are checked to adjust
+# the number of parallel requests
+ADJUST_SECS = float(os.environ.get('ADJUST_SECS', 15))
+
+# if greater than 1, sends words to /neighbors/batch in groups of this size
+# rather than requesting each one from /neighbors. it should be at most the
+# server's MAX_BATCH_SIZE (see the 'config' block returned by SERVER_URL)
+BATCH_SIZE = int(os.environ.get('BATCH_SIZE', 1))
+
+# words that have been cached (by us or anyone else) are appended to this
+# file, and skipped if the script is run again
+CHECKPOINT_FILE = os.environ.get('CHECKPOINT_FILE', f"./populate_cache.{CORPUS}.checkpoint")
+
+# number of parallel /neighbors/cached requests used to skip cached words
+CHECK_CONCURRENCY = int(os.environ.get('CHECK_CONCURRENCY', 16))
+
+# failed requests (other than 4xx responses) are retried this many times,
+# waiting RETRY_BACKOFF_SECS * 2^attempt (plus some jitter) in between
+MAX_RETRIES = int(os.environ.get('MAX_RETRIES', 3))
+RETRY_BACKOFF_SECS = float(os.environ.get('RETRY_BACKOFF_SECS', 5))
+
+# the slowest requests take a while, since they wait on the models
+REQUEST_TIMEOUT_SECS = float(os.environ.get('REQUEST_TIMEOUT_SECS', 30 * 60))
 
 # create logger with 'spam_application'
 logger = logging.getLogger('cache_populator')
@@ -32,47 +61,219 @@ fh = logging.FileHandler('non_200s.log')
 fh.setLevel(logging.DEBUG)
 logger.addHandler(fh)
 
-def main():
-    global RQ_CONCURRENCY
+
+def read_checkpoint():
+    if not os.path.exists(CHECKPOINT_FILE):
+        return set()
+
+    with open(CHECKPOINT_FILE) as fp:
+        return {word.strip() for word in fp if word.strip()}
+
+
+def is_cached(session, word):
+    try:
+        resp = session.get(
+            f"{SERVER_URL}/neighbors/cached",
+            params={"tok": word, "corpus": CORPUS},
+            timeout=60,
+        )
+        return resp.status_code == 200 and resp.json().get("is_cached", False)
+    except rq.RequestException:
+        # we'll find out when we request it
+        return False
+
+
+def server_load(session):
+    """
+    Returns a tuple of (number of workers, number of jobs waiting for a
+    worker) as reported by the server, or None if it couldn't be reached.
+    """
+    try:
+        runtime = session.get(SERVER_URL, timeout=60).json().get('runtime', {})
+    except (rq.RequestException, ValueError):
+        return None
+
+    return runtime.get('total_workers', 0), sum(runtime.get('queued_jobs', {}).values())
+
+
+def adjust_concurrency(concurrency, load):
+    """
+    Returns the number of parallel requests to have in flight next, given the
+    current number and the server's (workers, queued jobs). Backs off quickly
+    when jobs are piling up in the queue, since our requests are then just
+    delaying user requests, and ramps up slowly while the workers keep up.
+    """
+    if load is None:
+        return concurrency
+
+    workers, queued = load
+    ceiling = RQ_CONCURRENCY
 
     if USE_SERVER_CONCURRENCY:
-        # do an initial request for metadata, to set RQ_CONCURRENCY
-        meta = rq.get(SERVER_URL)
-        # print(json.dumps(meta.json(), indent=2))
-        # overwrite RQ_CONCURRENCY with what we found
-        RQ_CONCURRENCY = int(meta.json().get('config', {}).get('RQ_CONCURRENCY', 1))
-        print(f"* Server workers: {RQ_CONCURRENCY}")
+        ceiling = min(ceiling, max(1, workers - WORKER_RESERVE))
+
+    if queued > 0:
+        concurrency = concurrency // 2 if queued >= concurrency else concurrency - 1
+    else:
+        concurrency += 1
+
+    return max(1, min(ceiling, concurrency))
+
+
+def warm(session, words):
+    """
+    Requests 'words' from the server, retrying failures with backoff. Returns a
+    tuple of (status code, latency in seconds of the last attempt), where the
+    status code is None if the server couldn't be reached.
+    """
+    for attempt in range(MAX_RETRIES + 1):
+        start = time.monotonic()
+
+        try:
+            if BATCH_SIZE > 1:
+                resp = session.post(
+                    f"{SERVER_URL}/neighbors/batch",
+                    json={"toks": words, "corpus": CORPUS},
+                    timeout=REQUEST_TIMEOUT_SECS,
+                )
+            else:
+                resp = session.get(
+                    f"{SERVER_URL}/neighbors",
+                    params={"tok": words[0], "corpus": CORPUS},
+                    timeout=REQUEST_TIMEOUT_SECS,
+                )
+            status_code = resp.status_code
+            url = resp.request.url
+        except rq.RequestException as ex:
+            status_code = None
+            url = f"{words} ({ex})"
+
+        latency = time.monotonic() - start
+
+        # client errors (e.g., a bad corpus) won't go away by retrying
+        if status_code == 200 or (status_code is not None and 400 <= status_code < 500):
+            break
+
+        if attempt < MAX_RETRIES:
+            time.sleep(RETRY_BACKOFF_SECS * 2 ** attempt * random.uniform(1, 1.5))
+
+    if status_code != 200:
+        logger.debug(f"{status_code} : {url}\n")
+
+    return status_code, latency
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+def main():
+    # pool enough connections for every thread, so they're reused between requests
+    session = rq.Session()
+    for prefix in ('http://', 'https://'):
+        session.mount(prefix, HTTPAdapter(pool_maxsize=max(RQ_CONCURRENCY, CHECK_CONCURRENCY)))
 
     # print gathered info so far
     print(f"* Server URL: {SERVER_URL}")
-    print(f"* Parallel requests: {RQ_CONCURRENCY}")
+    print(f"* Max parallel requests: {RQ_CONCURRENCY}")
+    print(f"* Use server worker count: {USE_SERVER_CONCURRENCY}")
+    print(f"* Words per request: {BATCH_SIZE}")
+    print(f"* Checkpoint file: {CHECKPOINT_FILE}")
 
-    # build requests to send out
-    print("Building requests set...")
     with open(WORD_LIST) as fp:
-        reqs = [
-            grq.get(f"{SERVER_URL}/neighbors?tok={word.strip()}&corpus={CORPUS}")
-            for word in tqdm(fp.readlines())
-        ]
-    
-    # map out requests, then progress as they're completed
+        words = list(dict.fromkeys(word.strip() for word in fp if word.strip()))
+
+    done = read_checkpoint()
+    words = [word for word in words if word not in done]
+    print(f"Skipping {len(done)} words from the checkpoint, {len(words)} left")
+
+    checkpoint = open(CHECKPOINT_FILE, 'a')
+
+    def mark_done(done_words):
+        checkpoint.write("".join(f"{word}\n" for word in done_words))
+        checkpoint.flush()
+
+    # skip words that are already cached, e.g. by user requests
+    print("Checking for cached words...")
+    with ThreadPoolExecutor(max_workers=CHECK_CONCURRENCY) as pool:
+        cached = list(
+            tqdm(
+                pool.map(lambda word: is_cached(session, word), words),
+                total=len(words),
+                dynamic_ncols=True,
+            )
+        )
+
+    mark_done(word for word, is_word_cached in zip(words, cached) if is_word_cached)
+    words = [word for word, is_word_cached in zip(words, cached) if not is_word_cached]
+    print(f"{sum(cached)} words were already cached, {len(words)} left")
+
+    reqs = [words[i:i + BATCH_SIZE] for i in range(0, len(words), BATCH_SIZE)]
+
     print("Processing requests...")
-    reqs_set = grq.imap(reqs, size=RQ_CONCURRENCY)
-    pbar = tqdm(
-        reqs_set, total=len(reqs),
-        dynamic_ncols=True, smoothing=0.0
-    )
+    pbar = tqdm(total=len(reqs), dynamic_ncols=True, smoothing=0.0)
 
     responses = Counter()
-    for resp in pbar:
-        responses[resp.status_code] += 1
+    latencies = []
+    warmed = 0
+    concurrency = adjust_concurrency(1, server_load(session))
+    last_adjusted = time.monotonic()
+    start = time.monotonic()
+
+    with ThreadPoolExecutor(max_workers=RQ_CONCURRENCY) as pool:
+        pending = {}
+        remaining = iter(reqs)
 
-        if resp.status_code != 200:
-            logger.debug(f"{resp.status_code} : {resp.request.url}\n")
+        while True:
+            if time.monotonic() - last_adjusted > ADJUST_SECS:
+                concurrency = adjust_concurrency(concurrency, server_load(session))
+                last_adjusted = time.monotonic()
 
-        pbar.set_description(
-            ", ".join(f"{x}:{responses[x]}" for x in responses)
+            while len(pending) < concurrency:
+                req_words = next(remaining, None)
+
+                if req_words is None:
+                    break
+
+                pending[pool.submit(warm, session, req_words)] = req_words
+
+            if not pending:
+                break
+
+            finished, _ = wait(pending, timeout=ADJUST_SECS, return_when=FIRST_COMPLETED)
+
+            for future in finished:
+                req_words = pending.pop(future)
+                status_code, latency = future.result()
+                responses[status_code] += 1
+
+                if status_code == 200:
+                    latencies.append(latency)
+                    warmed += len(req_words)
+                    mark_done(req_words)
+
+                pbar.update(1)
+
+            pbar.set_description(
+                f"x{concurrency} " + ", ".join(f"{x}:{responses[x]}" for x in responses)
+            )
+
+    pbar.close()
+    checkpoint.close()
+
+    elapsed = time.monotonic() - start
+
+    print(f"Responses: {dict(responses)}")
+    print(f"Warmed {warmed} words in {elapsed:.0f}s ({warmed / max(elapsed, 1e-9) * 60:.1f} words/min)")
+
+    if latencies:
+        print(
+            "Latency (s): " + ", ".join(
+                f"p{p}={percentile(latencies, p):.2f}" for p in (50, 90, 99)
+            ) + f", max={max(latencies):.2f}"
         )
 
+
 if __name__ == '__main__':
     main()
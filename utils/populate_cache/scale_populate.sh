@@ -42,6 +42,8 @@ echo "...done!"
 # run the cache populater w/the desired number of jobs
 export SERVER_URL="https://api-wl.greenelab.com"
 export RQ_CONCURRENCY=${DESIRED_JOBS}
+# ...but back off if the workers can't keep up
+export USE_SERVER_CONCURRENCY=true
 
 ${UTILS_PYTHON} populate_cache.py
 